@@ -0,0 +1,90 @@
+'''
+VFM - VideoFM
+Benchmark for chorus detection.
+
+Builds synthetic songs (intro, verses, a louder repeated chorus, bridge)
+with known chorus positions, runs chorus.find_chorus on them and reports
+the detection error and the analysis time as a fraction of real time.
+Audio files given on the command line are decoded with ffmpeg and timed too.
+
+Usage:
+    python benchmarks/chorus_benchmark.py [audio files ...] [--songs N] [--clip-duration S]
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import chorus
+
+def chord_section(rng, bars, amplitude, sample_rate):
+    """Render bars of random two-second triads."""
+    t = np.arange(2 * sample_rate) / sample_rate
+    section = []
+    for _ in range(bars):
+        notes = rng.integers(48, 80, 3)
+        tone = sum(np.sin(2 * np.pi * 440 * 2 ** ((note - 69) / 12) * t) for note in notes) / 3
+        section.append((amplitude * tone).astype(np.float32))
+    return np.concatenate(section)
+
+def synthetic_song(seed, sample_rate=chorus.SAMPLE_RATE):
+    """Build a song whose chorus is repeated three times.
+
+    Returns:
+        tuple: (samples, list of chorus start times in seconds)
+    """
+    rng = np.random.default_rng(seed)
+    refrain = chord_section(rng, 8, 0.8, sample_rate)
+    parts = [chord_section(rng, int(rng.integers(2, 6)), 0.2, sample_rate)]
+    starts = []
+    for _ in range(3):
+        parts.append(chord_section(rng, int(rng.integers(6, 10)), 0.3, sample_rate))
+        starts.append(sum(part.size for part in parts) / sample_rate)
+        parts.append(refrain)
+    parts.append(chord_section(rng, 4, 0.2, sample_rate))
+    samples = np.concatenate(parts)
+    samples += 0.02 * rng.standard_normal(samples.size).astype(np.float32)
+    return samples, starts
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chorus detection.")
+    parser.add_argument("files", nargs="*", help="Audio or video files to analyze")
+    parser.add_argument("--songs", type=int, default=20, help="Number of synthetic songs")
+    parser.add_argument("--clip-duration", type=float, default=15, help="Window length in seconds")
+    args = parser.parse_args()
+
+    total_audio = total_time = 0.0
+    hits = 0
+    for seed in range(args.songs):
+        samples, starts = synthetic_song(seed)
+        began = time.perf_counter()
+        found = chorus.find_chorus(samples, args.clip_duration)
+        total_time += time.perf_counter() - began
+        total_audio += samples.size / chorus.SAMPLE_RATE
+        if found is not None and min(abs(found - start) for start in starts) <= 1:
+            hits += 1
+
+    print(f"Synthetic songs: {hits}/{args.songs} choruses found within 1s")
+    print(f"Analysis: {total_time * 1000 / args.songs:.1f} ms per song, "
+          f"{total_time / total_audio:.5f}x real time")
+
+    for path in args.files:
+        began = time.perf_counter()
+        samples = chorus.decode_audio(path)
+        decoded = time.perf_counter()
+        if samples is None:
+            print(f"{path}: could not decode")
+            continue
+        found = chorus.find_chorus(samples, args.clip_duration)
+        finished = time.perf_counter()
+        length = samples.size / chorus.SAMPLE_RATE
+        print(f"{path}: chorus at {found}s, decode {decoded - began:.2f}s + analysis {finished - decoded:.2f}s "
+              f"for {length:.0f}s of audio ({(finished - began) / length:.4f}x real time)")
+
+if __name__ == "__main__":
+    main()
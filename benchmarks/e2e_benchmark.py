@@ -0,0 +1,377 @@
+'''
+VFM - VideoFM
+Offline end-to-end benchmark.
+
+Runs the whole get_top_songs -> search_youtube_video -> download_video ->
+add_text_overlay -> merge_videos flow without network access:
+
+- a local Last.fm stand-in serves user.getrecenttracks from synthetic,
+  reproducible scrobble histories
+- a local YouTube Data API stand-in answers search().list
+- test videos generated with lavfi are served over HTTP to yt-dlp
+
+Each song count runs from a cold cache in its own temporary directory.
+The stages run one after the other, each in its own Python process that
+takes every song through that stage with the stage's usual worker pool, so
+wall time, CPU time (the stage and its ffmpeg children) and peak RSS are
+the stage's own. Results are handed to the next stage through the cache
+and a JSON file. Because stages don't overlap here, the total is longer
+than a pipelined run; the download stage also fetches the video metadata
+again, since the metadata stage's info dicts only live in memory.
+Needs ffmpeg/ffprobe and the packages from requirements.txt.
+
+Usage:
+    python benchmarks/e2e_benchmark.py [--songs 5 10 20] [--codec libx264] [--json results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+import subprocess
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import videofm
+import ffmpeg_jobs
+
+BENCH_YEAR, BENCH_MONTH = 2024, 5
+STAGES = ["lastfm", "search", "metadata", "download", "encode", "merge"]
+VIDEO_PATTERNS = ["testsrc2", "smptehdbars", "rgbtestsrc", "testsrc"]
+
+def synthetic_history(user, scrobbles, catalog_size=300, seed=7):
+    """Build a reproducible scrobble history for the benchmark month.
+
+    Plays follow a Zipf-like distribution over the catalog, so there is a
+    clear top list like in a real account.
+
+    Returns:
+        list: (timestamp, artist, title) tuples, newest first like Last.fm
+    """
+    rng = random.Random(f"{seed}:{user}")
+    catalog = [(f"Artist {i // 3:03d}", f"Song {i:03d}") for i in range(catalog_size)]
+    weights = [1 / (rank + 1) for rank in range(catalog_size)]
+    start = int(time.mktime((BENCH_YEAR, BENCH_MONTH, 1, 0, 0, 0, 0, 0, -1)))
+    end = int(time.mktime((BENCH_YEAR, BENCH_MONTH + 1, 1, 0, 0, 0, 0, 0, -1)))
+    plays = rng.choices(catalog, weights=weights, k=scrobbles)
+    history = [(rng.randrange(start, end), artist, title) for artist, title in plays]
+    return sorted(history, reverse=True)
+
+def video_id_for(artist, title, kind):
+    """Stable 11-character video ID for a search result."""
+    return hashlib.sha1(f"{artist}|{title}|{kind}".encode("utf-8")).hexdigest()[:11]
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves the Last.fm API, the YouTube search API and the test videos."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        url = urllib.parse.urlparse(self.path)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        if url.path.startswith("/2.0"):
+            self.lastfm(params)
+        elif url.path.endswith("/search"):
+            self.youtube_search(params)
+        elif url.path == "/watch":
+            self.video(params.get("v", ""), head)
+        else:
+            self.send_error(404)
+
+    def lastfm(self, params):
+        server = self.server
+        user = params.get("user", "")
+        with server.lock:
+            if user not in server.histories:
+                server.histories[user] = synthetic_history(user, server.scrobbles)
+            history = server.histories[user]
+        start, end = int(params.get("from", 0)), int(params.get("to", 2 ** 31))
+        tracks = [entry for entry in history if start <= entry[0] <= end]
+        limit, page = int(params.get("limit", 50)), int(params.get("page", 1))
+        total_pages = max(1, -(-len(tracks) // limit))
+        self.send_json({"recenttracks": {
+            "track": [
+                {"artist": {"#text": artist}, "name": title, "date": {"uts": str(timestamp)}}
+                for timestamp, artist, title in tracks[(page - 1) * limit:page * limit]
+            ],
+            "@attr": {"user": user, "page": str(page), "totalPages": str(total_pages), "total": str(len(tracks))},
+        }})
+
+    def youtube_search(self, params):
+        query = params.get("q", "")
+        artist, _, rest = query.partition(" - ")
+        title = rest.split(" official")[0].split(" lyrics")[0].strip()
+        self.send_json({"items": [
+            {"id": {"kind": "youtube#video", "videoId": video_id_for(artist, title, "lyrics")},
+             "snippet": {"title": f"{artist} - {title} (Lyrics)", "channelTitle": "Lyric Channel"}},
+            {"id": {"kind": "youtube#video", "videoId": video_id_for(artist, title, "mv")},
+             "snippet": {"title": f"{artist} - {title} (Official Music Video)", "channelTitle": f"{artist}VEVO"}},
+        ]})
+
+    def video(self, video_id, head):
+        videos = self.server.videos
+        path = videos[int(hashlib.sha1(video_id.encode("utf-8")).hexdigest(), 16) % len(videos)]
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            start_text, _, end_text = range_header[6:].partition("-")
+            first = int(start_text or 0)
+            last = min(int(end_text), size - 1) if end_text else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.end_headers()
+        if head:
+            return
+        with open(path, "rb") as f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = f.read(min(1 << 16, remaining))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(chunk)
+
+def generate_videos(directory, count, seconds):
+    """Render the test videos that stand in for YouTube uploads.
+
+    Returns:
+        list: Paths of the generated MP4 files
+    """
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"source_{index}.mp4")
+        pattern = VIDEO_PATTERNS[index % len(VIDEO_PATTERNS)]
+        subprocess.run([
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "lavfi", "-t", str(seconds), "-i", f"{pattern}=s=1280x720:r=30",
+            "-f", "lavfi", "-t", str(seconds), "-i", f"sine=frequency={220 * (index + 1)}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-movflags", "+faststart", "-shortest", path,
+        ], check=True)
+        paths.append(path)
+    return paths
+
+def start_stand_ins(videos, scrobbles):
+    """Start the stand-in HTTP server on a free local port.
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.videos = videos
+    server.scrobbles = scrobbles
+    server.histories = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def point_pipeline_at(base_url, work_dir, codec):
+    """Configure videofm to use the stand-ins and the run's working directory."""
+    videofm.LASTFM_API_URL = f"{base_url}/2.0/"
+    videofm.LASTFM_API_KEY = videofm.YOUTUBE_API_KEY = "benchmark"
+    videofm.YOUTUBE_API_KEYS = []
+    videofm.YOUTUBE_API_ENDPOINT = f"{base_url}/"
+    videofm.YOUTUBE_WATCH_URL = f"{base_url}/watch?v={{video_id}}"
+    videofm.youtube_services.clear()
+
+    videofm.CACHE_DIR = os.path.join(work_dir, "cache")
+    videofm.VIDEO_OUTPUT_DIR = os.path.join(work_dir, "clips")
+    videofm.SCROBBLE_DIR = os.path.join(videofm.CACHE_DIR, "scrobbles")
+    videofm.CACHE_DB = os.path.join(videofm.CACHE_DIR, "cache.db")
+    videofm.PLAY_COUNTS_DB = os.path.join(videofm.CACHE_DIR, "play_counts.db")
+    videofm.cache_backend = videofm.play_counts_db = None
+    os.makedirs(videofm.CACHE_DIR, exist_ok=True)
+    os.makedirs(videofm.VIDEO_OUTPUT_DIR, exist_ok=True)
+
+    # The stand-in videos are short and have no separate audio stream to analyze
+    videofm.CHORUS_START = "00:00:10"
+    videofm.SELECTED_CODEC, videofm.ENCODER_PRESET = codec, None
+
+def usage():
+    """Get the CPU time and peak RSS of this process and its finished children so far."""
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu": own.ru_utime + own.ru_stime,
+        "child_cpu": children.ru_utime + children.ru_stime,
+        # ru_maxrss is in KiB on Linux. For children it is the largest single child, and a
+        # child counts the RSS it inherited when forked, so it is never below this process's
+        "peak_rss_mb": own.ru_maxrss / 1024,
+        "peak_child_rss_mb": children.ru_maxrss / 1024,
+    }
+
+def run_in_pool(pools, stage, fn, items):
+    """Run fn(*item) for every item on a stage's pool and collect the results in order.
+
+    A failing item gets None, like a song the pipeline skips.
+    """
+    def run(item):
+        try:
+            return videofm.run_stage(pools, stage, fn, *item)
+        except Exception as e:
+            print(f"❌ {stage} failed for {item[0]}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, len(items))) as drivers:
+        return list(drivers.map(run, items))
+
+def run_stage(stage, state):
+    """Take every song through one stage, updating the run state in place."""
+    pools = videofm.create_stage_pools()
+    try:
+        if stage == "lastfm":
+            state["songs"] = videofm.get_top_songs(state["user"], BENCH_YEAR, BENCH_MONTH, state["num_songs"])
+        elif stage == "search":
+            urls = run_in_pool(pools, "search", videofm.search_youtube_video, state["songs"])
+            state["songs"] = [(artist, title, url) for (artist, title), url in zip(state["songs"], urls) if url]
+        elif stage == "metadata":
+            state["starts"] = run_in_pool(pools, "metadata", videofm.find_clip_start,
+                                          [(url,) for _, _, url in state["songs"]])
+        elif stage == "download":
+            state["paths"] = [videofm.clip_paths(url, f"{rank}. {artist} - {title}")
+                              for rank, (artist, title, url) in enumerate(state["songs"], 1)]
+            state["seeks"] = run_in_pool(pools, "download", videofm.download_video, [
+                (url, source, start, videofm.CLIP_DURATION)
+                for (_, _, url), (source, _), start in zip(state["songs"], state["paths"], state["starts"])
+            ])
+        elif stage == "encode":
+            renders = [(source, clip, f"{rank}. {artist} - {title}", seek, videofm.CLIP_DURATION)
+                       for rank, ((artist, title, _), (source, clip), seek)
+                       in enumerate(zip(state["songs"], state["paths"], state["seeks"]), 1) if seek is not None]
+            run_in_pool(pools, "encode", videofm.add_text_overlay, renders)
+            # Countdown order, like process_songs()
+            state["clips"] = [clip for _, clip, *_ in reversed(renders) if os.path.exists(clip)]
+        elif stage == "merge" and state["clips"]:
+            title = videofm.compilation_title(state["user"], state["num_songs"], BENCH_YEAR, BENCH_MONTH)
+            videofm.merge_videos(state["clips"], state["final_video"], title)
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+def stage_process(args):
+    """Entry point of a stage process, see run_stage()."""
+    with open(args.state) as f:
+        state = json.load(f)
+    point_pipeline_at(state["base_url"], state["work_dir"], state["codec"])
+    ffmpeg_jobs.configure(videofm.ENCODE_WORKERS, videofm.FFMPEG_THREADS)
+    before = usage()
+    started = time.perf_counter()
+    output = contextlib.nullcontext() if state["verbose"] else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with output:
+        run_stage(args.stage, state)
+    after = usage()
+    state.setdefault("metrics", {})[args.stage] = {
+        "wall": time.perf_counter() - started,
+        "cpu": after["cpu"] - before["cpu"],
+        "child_cpu": after["child_cpu"] - before["child_cpu"],
+        "peak_rss_mb": after["peak_rss_mb"],
+        "peak_child_rss_mb": after["peak_child_rss_mb"],
+    }
+    with open(args.state, "w") as f:
+        json.dump(state, f)
+
+def run_once(server, num_songs, codec, verbose):
+    """Run one cold compilation of num_songs, every stage in a fresh process.
+
+    Returns:
+        dict: Stage metrics and clip counts
+    """
+    with tempfile.TemporaryDirectory(prefix="vfm-bench-") as work_dir:
+        state_path = os.path.join(work_dir, "state.json")
+        state = {
+            "user": f"bench{num_songs}", "num_songs": num_songs, "codec": codec, "verbose": verbose,
+            "base_url": f"http://127.0.0.1:{server.server_address[1]}", "work_dir": work_dir,
+            "final_video": os.path.join(work_dir, "final.mp4"),
+        }
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+        for stage in STAGES:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--stage", stage, "--state", state_path],
+                           check=True)
+        with open(state_path) as f:
+            state = json.load(f)
+        return {
+            "songs": num_songs,
+            "clips": len(state.get("clips", [])),
+            "merged": os.path.exists(state["final_video"]),
+            "stages": state["metrics"],
+        }
+
+def print_result(result):
+    """Print the metrics of one run."""
+    print(f"\n=== {result['songs']} songs: {result['clips']} clips, "
+          f"{'merged' if result['merged'] else 'NOT merged'} ===")
+    print(f"{'stage':<10}{'wall s':>9}{'cpu s':>9}{'child cpu s':>14}{'peak rss MB':>13}{'child rss MB':>15}")
+    for stage, metrics in result["stages"].items():
+        print(f"{stage:<10}{metrics['wall']:>9.2f}{metrics['cpu']:>9.2f}{metrics['child_cpu']:>14.2f}"
+              f"{metrics['peak_rss_mb']:>13.0f}{metrics['peak_child_rss_mb']:>15.0f}")
+    print(f"{'total':<10}{sum(metrics['wall'] for metrics in result['stages'].values()):>9.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the compilation pipeline.")
+    parser.add_argument("--songs", type=int, nargs="+", default=[5, 10, 20], help="Song counts to benchmark")
+    parser.add_argument("--scrobbles", type=int, default=3000, help="Scrobbles in the synthetic month")
+    parser.add_argument("--videos", type=int, default=4, help="Distinct test videos to serve")
+    parser.add_argument("--video-seconds", type=int, default=40, help="Length of each test video")
+    parser.add_argument("--codec", default="libx264", help="Video encoder for the renders")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)  # Set for the stage processes
+    parser.add_argument("--state", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.stage:
+        stage_process(args)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="vfm-media-") as media_dir:
+        print(f"🎞️ Generating {args.videos} test videos...")
+        videos = generate_videos(media_dir, args.videos, args.video_seconds)
+        server = start_stand_ins(videos, args.scrobbles)
+        try:
+            results = []
+            for num_songs in args.songs:
+                result = run_once(server, num_songs, args.codec, args.verbose)
+                print_result(result)
+                results.append(result)
+        finally:
+            server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+if __name__ == "__main__":
+    main()
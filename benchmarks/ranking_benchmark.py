@@ -0,0 +1,186 @@
+'''
+VFM - VideoFM
+Micro-benchmark for YouTube search result ranking.
+
+Replays search().list responses through ranking.rank_candidates and through
+the original per-call implementation, checks that both pick the same video
+and reports the cost per candidate.
+
+Record real responses by running videofm.py with VIDEOFM_RECORD_SEARCHES set
+to a JSONL file. Without recordings, synthetic responses are generated.
+
+Usage:
+    python benchmarks/ranking_benchmark.py [recorded.jsonl ...] [--synthetic N] [--repeat R]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ranking
+
+def legacy_rank(artist, title, responses):
+    """Rank candidates the way search_youtube_video originally did.
+    
+    The indicator table and tier lookup are rebuilt on every call and every
+    indicator is lowercased for every candidate, as in the original code.
+    
+    Args:
+        artist: Artist name
+        title: Song title
+        responses: search().list responses, one per query
+        
+    Returns:
+        tuple: (tier, video id), or (None, None)
+    """
+    quality_indicators = {tier: list(indicators) for tier, indicators in ranking.QUALITY_INDICATORS.items()}
+    
+    def get_match_tier(video_title_lower, channel_title):
+        if "- Topic" in channel_title:
+            return "audio", "- Topic"
+        for tier, indicators in quality_indicators.items():
+            for indicator in indicators:
+                if indicator.lower() in video_title_lower:
+                    return tier, indicator
+        return None, None
+    
+    best_matches = {"music_video": None, "audio": None, "lyrics": None, "other": None}
+    
+    for response in responses:
+        for item in response.get("items", []):
+            video_title_lower = item["snippet"]["title"].lower()
+            channel_title = item["snippet"]["channelTitle"]
+            is_relevant = (title.lower() in video_title_lower) or (artist.lower() in video_title_lower)
+            if not is_relevant:
+                continue
+            tier, indicator = get_match_tier(video_title_lower, channel_title)
+            is_artist_channel = artist.lower() in channel_title.lower()
+            title_exact_match = (
+                f"{artist} - {title}".lower() in video_title_lower or
+                f"{title} - {artist}".lower() in video_title_lower
+            )
+            if 'videoId' in item['id']:
+                tier_key = tier if tier else "other"
+                if not best_matches[tier_key]:
+                    best_matches[tier_key] = item['id']['videoId']
+        if any(best_matches.values()):
+            break
+    
+    for tier in ["music_video", "audio", "lyrics", "other"]:
+        if best_matches[tier]:
+            return tier, best_matches[tier]
+    return None, None
+
+def engine_rank(artist, title, responses):
+    """Rank candidates with the ranking engine, querying like search_youtube_video.
+    
+    Returns:
+        tuple: (tier, video id), or (None, None)
+    """
+    candidates = []
+    tier, match = None, None
+    for response in responses:
+        candidates.extend(response.get("items", []))
+        tier, match = ranking.rank_candidates(artist, title, candidates)
+        if match:
+            break
+    return tier, match['id'] if match else None
+
+def load_recordings(paths):
+    """Group recorded responses by track, keeping query order.
+    
+    Returns:
+        list: (artist, title, [responses]) tuples
+    """
+    tracks = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    tracks.setdefault((record["artist"], record["title"]), []).append(record["response"])
+    return [(artist, title, responses) for (artist, title), responses in tracks.items()]
+
+def synthetic_tracks(count, seed=9):
+    """Generate search responses that exercise every tier and some misses.
+    
+    Returns:
+        list: (artist, title, [responses]) tuples
+    """
+    rng = random.Random(seed)
+    artists = ["fromis_9", "Aimer", "Stromae", "Rosalía", "Би-2", "周杰倫", "Tame Impala", "YOASOBI", "Måneskin", "Burna Boy"]
+    words = ["Love", "Night", "Stay", "夜に駆ける", "Papaoutai", "Malamente", "Feel", "DM", "晴天", "Beggin", "Last", "Dance"]
+    templates = [
+        "{artist} - {title} (Official Music Video)", "{artist} - {title} [Official Audio]",
+        "{artist} '{title}' M/V", "{title} (Lyrics)", "{artist} - {title}", "【MV】{artist}「{title}」",
+        "{title} - {artist} | Lyric Video", "{artist} {title} Live", "Top 10 songs of the year",
+        "{title} cover by someone", "{artist} - {title} 뮤직비디오", "{artist} - {title} video oficial",
+    ]
+    channels = ["{artist}", "{artist} - Topic", "{artist}VEVO", "Lyrics Hub", "Random Covers"]
+    
+    tracks = []
+    for _ in range(count):
+        artist = rng.choice(artists)
+        title = " ".join(rng.sample(words, rng.randint(1, 2)))
+        responses = []
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            items = []
+            for _ in range(8):
+                items.append({
+                    "id": {"videoId": "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789_-") for _ in range(11))},
+                    "snippet": {
+                        "title": rng.choice(templates).format(artist=artist, title=title),
+                        "channelTitle": rng.choice(channels).format(artist=artist),
+                    },
+                })
+            responses.append({"items": items})
+        tracks.append((artist, title, responses))
+    return tracks
+
+def time_ranker(ranker, tracks, repeat):
+    """Run a ranker over all tracks and return the best time per pass in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for artist, title, responses in tracks:
+            ranker(artist, title, responses)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark YouTube search result ranking.")
+    parser.add_argument("recordings", nargs="*", help="JSONL files recorded with VIDEOFM_RECORD_SEARCHES")
+    parser.add_argument("--synthetic", type=int, default=3000, help="Synthetic tracks to generate without recordings")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing passes (the best one is reported)")
+    args = parser.parse_args()
+    
+    tracks = load_recordings(args.recordings) if args.recordings else synthetic_tracks(args.synthetic)
+    responses = sum(len(track_responses) for _, _, track_responses in tracks)
+    candidates = sum(len(r.get("items", [])) for _, _, track_responses in tracks for r in track_responses)
+    print(f"📊 {len(tracks)} tracks, {responses} responses, {candidates} candidates")
+    
+    # The engine must pick exactly the same video as the original code
+    mismatches = [
+        (artist, title) for artist, title, track_responses in tracks
+        if legacy_rank(artist, title, track_responses) != engine_rank(artist, title, track_responses)
+    ]
+    if mismatches:
+        print(f"❌ Ranking differs for {len(mismatches)} tracks, e.g. {mismatches[:5]}")
+    else:
+        print("✅ Ranking identical for all tracks")
+    
+    legacy_time = time_ranker(legacy_rank, tracks, args.repeat)
+    engine_time = time_ranker(engine_rank, tracks, args.repeat)
+    print(f"   Original: {legacy_time / candidates * 1e6:.2f} µs per candidate")
+    print(f"   Engine:   {engine_time / candidates * 1e6:.2f} µs per candidate")
+    print(f"   Speedup:  {legacy_time / engine_time:.1f}x")
+    
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+'''
+VFM - VideoFM
+Benchmark for top-song queries over the play-count rollups.
+
+Builds synthetic scrobble histories (Zipf-distributed tracks over several
+years), rolls them up once and then answers month, year-in-review, artist
+and multi-user top lists both from the rollups and with a Counter over the
+raw scrobbles. Reports the time per query and checks that both rankings
+agree.
+
+Usage:
+    python benchmarks/top_songs_benchmark.py [--users 3] [--scrobbles 150000] [--years 3]
+'''
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import datetime
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import videofm
+import scrobble_store
+
+def synthetic_store(user, scrobbles, years, seed):
+    """Build a synced scrobble store with Zipf-distributed plays.
+
+    Returns:
+        scrobble_store.ScrobbleStore: Store like videofm.load_scrobble_store() returns
+    """
+    rng = random.Random(seed)
+    artists = [f"Artist {i}" for i in range(400)]
+    tracks = [(rng.choice(artists[:40] if i < 200 else artists), f"Track {i}") for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(tracks))]
+
+    end = int(datetime.datetime(datetime.date.today().year, 1, 1).timestamp())
+    start = int(datetime.datetime(datetime.date.today().year - years, 1, 1).timestamp())
+    timestamps = sorted(rng.sample(range(start, end), scrobbles))
+    picks = rng.choices(tracks, weights, k=scrobbles)
+    store = scrobble_store.ScrobbleStore(user, [[start, end]])
+    store.extend([timestamp, artist, title] for timestamp, (artist, title) in zip(timestamps, picks))
+    return store
+
+def counter_top(stores, start_date, end_date, num_songs, artist=None):
+    """Rank songs the way get_top_songs did before the rollups, over scrobbles newest first like Last.fm's pages."""
+    scrobbles = sorted(
+        (scrobble for store in stores for scrobble in videofm.scrobbles_in_range(store, start_date, end_date)),
+        key=lambda scrobble: scrobble[0], reverse=True
+    )
+    counts = Counter(
+        (track_artist, title) for _, track_artist, title in scrobbles
+        if artist is None or track_artist.casefold() == artist.casefold()
+    )
+    return [song for song, _ in counts.most_common(num_songs)]
+
+def timed(fn, *args, repeat=5):
+    """Run fn repeat times and return (result, best time in milliseconds)."""
+    best = float("inf")
+    for _ in range(repeat):
+        began = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - began)
+    return result, best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark top-song queries over the play-count rollups.")
+    parser.add_argument("--users", type=int, default=3, help="Number of synthetic users")
+    parser.add_argument("--scrobbles", type=int, default=150000, help="Scrobbles per user")
+    parser.add_argument("--years", type=int, default=3, help="Years of history per user")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="videofm-top-")
+    videofm.PLAY_COUNTS_DB = os.path.join(work_dir, "play_counts.db")
+    videofm.play_counts_db = None
+
+    stores = [synthetic_store(f"user{i}", args.scrobbles, args.years, seed=i) for i in range(args.users)]
+    began = time.perf_counter()
+    for store in stores:
+        videofm.update_play_counts(store)
+    print(f"Rolled up {args.users} x {args.scrobbles} scrobbles in {time.perf_counter() - began:.2f}s "
+          f"({os.path.getsize(videofm.PLAY_COUNTS_DB) / 1e6:.1f} MB)")
+
+    year = datetime.date.today().year - 1
+    queries = [
+        ("month, 1 user, top 10", stores[:1], videofm.period_range(year, 5), 10, None),
+        ("year, 1 user, top 50", stores[:1], videofm.period_range(year), 50, None),
+        ("year, 1 user, artist", stores[:1], videofm.period_range(year), 10, "artist 3"),
+        (f"year, {args.users} users, top 50", stores, videofm.period_range(year), 50, None),
+        (f"{args.years} years, {args.users} users", stores,
+         (videofm.period_range(year - args.years + 1)[0], videofm.period_range(year)[1]), 50, None),
+    ]
+
+    print(f"{'query':<28}{'rollups ms':>12}{'counter ms':>12}{'speedup':>9}  same")
+    for label, query_stores, (start_date, end_date), num_songs, artist in queries:
+        fast, fast_ms = timed(videofm.top_songs, query_stores, start_date, end_date, num_songs, artist)
+        slow, slow_ms = timed(counter_top, query_stores, start_date, end_date, num_songs, artist, repeat=2)
+        print(f"{label:<28}{fast_ms:>12.1f}{slow_ms:>12.1f}{slow_ms / fast_ms:>8.0f}x  {'yes' if fast == slow else 'NO'}")
+
+if __name__ == "__main__":
+    main()
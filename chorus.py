@@ -0,0 +1,146 @@
+'''
+VFM - VideoFM
+Chorus detection: find the most repeated high-energy window of a track.
+'''
+
+import subprocess
+
+SAMPLE_RATE = 11025   # Mono decode rate - plenty for chroma up to ~5 kHz
+FRAME_SIZE = 4096     # FFT window (~0.37 s at SAMPLE_RATE)
+HOP_SECONDS = 0.25    # Feature resolution
+MIN_LAG_SECONDS = 10  # Repeats closer than this are sustained notes, not a chorus
+MAX_SECONDS = 600     # Longer videos (live sets, mixes) are only analyzed this far
+DECODE_TIMEOUT = 60   # Seconds a decode may take before it is given up on (a stalled stream, say)
+LAG_BAND = 256        # Lags scored at a time, bounds the memory of the time-lag matrix
+FRAME_BLOCK = 256     # Frames transformed at a time, bounds the memory of the spectrum
+MIN_FREQUENCY = 55    # A1
+MAX_FREQUENCY = 5000
+
+def decode_audio(source, sample_rate=SAMPLE_RATE, max_seconds=MAX_SECONDS, headers=None, timeout=DECODE_TIMEOUT):
+    """Decode an audio stream to mono float samples with ffmpeg.
+
+    Args:
+        source: Local path or URL ffmpeg can read
+        sample_rate: Output sample rate
+        max_seconds: Stop decoding after this many seconds
+        headers: HTTP headers to request a URL with, e.g. a yt-dlp format's http_headers
+        timeout: Seconds before the decode is stopped
+
+    Returns:
+        numpy.ndarray: float32 samples, or None if decoding failed
+    """
+    import numpy as np
+    cmd = ["ffmpeg", "-v", "error", "-nostdin", "-t", str(max_seconds)]
+    if headers:
+        cmd += ["-headers", "".join(f"{key}: {value}\r\n" for key, value in headers.items())]
+    cmd += ["-i", source, "-vn", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-"]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    samples = np.frombuffer(result.stdout, dtype=np.float32)
+    return samples if samples.size else None
+
+def chroma_features(samples, sample_rate=SAMPLE_RATE):
+    """Compute per-frame chroma vectors and RMS energy.
+
+    Args:
+        samples: Mono float samples
+        sample_rate: Sample rate of the samples
+
+    Returns:
+        tuple: (chroma of shape (frames, 12) with unit-length rows, energy of shape (frames,))
+    """
+    import numpy as np
+    hop = int(sample_rate * HOP_SECONDS)
+    if samples.size < FRAME_SIZE:
+        samples = np.pad(samples, (0, FRAME_SIZE - samples.size))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::hop]
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+
+    # Fold the FFT bins in range onto the 12 pitch classes with one matrix product
+    freqs = np.fft.rfftfreq(FRAME_SIZE, 1 / sample_rate)
+    in_range = (freqs >= MIN_FREQUENCY) & (freqs <= MAX_FREQUENCY)
+    pitch_class = np.round(12 * np.log2(freqs[in_range] / 440) + 69).astype(int) % 12
+    fold = np.zeros((in_range.sum(), 12), dtype=np.float32)
+    fold[np.arange(pitch_class.size), pitch_class] = 1
+
+    energy = np.empty(len(frames), dtype=np.float32)
+    chroma = np.empty((len(frames), 12), dtype=np.float32)
+    for first in range(0, len(frames), FRAME_BLOCK):
+        block = frames[first:first + FRAME_BLOCK]
+        energy[first:first + FRAME_BLOCK] = np.sqrt(np.mean(block ** 2, axis=1))
+        spectrum = np.abs(np.fft.rfft(block * window, axis=1)[:, in_range]) ** 2
+        chroma[first:first + FRAME_BLOCK] = spectrum @ fold
+
+    chroma /= np.linalg.norm(chroma, axis=1, keepdims=True) + 1e-9
+    return chroma, energy
+
+def moving_average(values, width, axis=-1):
+    """Average over every run of `width` consecutive values along an axis.
+
+    Returns an array that is width - 1 shorter along that axis.
+    """
+    import numpy as np
+    cumsum = np.cumsum(values, axis=axis, dtype=np.float64)
+    cumsum = np.concatenate([np.zeros_like(np.take(cumsum, [0], axis=axis)), cumsum], axis=axis)
+    upper = np.take(cumsum, np.arange(width, cumsum.shape[axis]), axis=axis)
+    lower = np.take(cumsum, np.arange(0, cumsum.shape[axis] - width), axis=axis)
+    return (upper - lower) / width
+
+def find_chorus(samples, clip_duration, sample_rate=SAMPLE_RATE):
+    """Find the start of the most repeated, loudest window of a track.
+
+    Every window of clip_duration seconds is scored by how closely it is
+    repeated somewhere else in the track (mean chroma similarity along the
+    matching diagonal of the self-similarity matrix) times its loudness.
+    The time-lag matrix is scored LAG_BAND lags at a time, so memory stays
+    small however long the track is.
+
+    Args:
+        samples: Mono float samples from decode_audio()
+        clip_duration: Window length in seconds
+        sample_rate: Sample rate of the samples
+
+    Returns:
+        float: Window start in seconds, or None if the track is too short
+    """
+    import numpy as np
+    chroma, energy = chroma_features(samples, sample_rate)
+    frames = chroma.shape[0]
+    width = int(round(clip_duration / HOP_SECONDS))
+    min_lag = int(round(MIN_LAG_SECONDS / HOP_SECONDS))
+    if frames < width + min_lag:
+        return None
+
+    similarity = chroma @ chroma.T
+    lags = np.arange(min_lag, frames - width + 1)
+    starts = np.arange(frames)
+    window_count = frames - width + 1
+    windows = np.arange(window_count)
+    best_later = np.zeros(window_count, dtype=np.float32)
+    best_earlier = np.zeros(window_count, dtype=np.float32)
+
+    for first in range(0, lags.size, LAG_BAND):
+        band = lags[first:first + LAG_BAND]
+
+        # Time-lag band: lagged[lag, i] is the similarity of frame i and frame i + lag
+        later = starts[None, :] + band[:, None]
+        lagged = np.where(later < frames, similarity[starts[None, :], np.minimum(later, frames - 1)], 0)
+
+        # Smooth along each diagonal: how well the window at i matches the one at i + lag
+        window_match = moving_average(lagged, width, axis=1).astype(np.float32)
+
+        # A window repeats if it matches a later window or an earlier one
+        np.maximum(best_later, window_match.max(axis=0), out=best_later)
+        earlier_start = windows[None, :] - band[:, None]
+        np.maximum(best_earlier, np.where(
+            earlier_start >= 0, window_match[np.arange(band.size)[:, None], np.maximum(earlier_start, 0)], 0
+        ).max(axis=0), out=best_earlier)
+    repetition = np.maximum(best_later, best_earlier)
+
+    loudness = moving_average(energy, width)[:window_count]
+    loudness /= loudness.max() + 1e-9
+
+    score = repetition * np.sqrt(loudness)
+    return float(np.argmax(score) * HOP_SECONDS)
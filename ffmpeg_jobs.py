@@ -0,0 +1,206 @@
+'''
+VFM - VideoFM
+Managed ffmpeg jobs: argument vectors, live progress, timeouts and cancellation.
+'''
+
+import subprocess
+import threading
+import time
+import itertools
+from collections import deque
+
+import tracing
+
+MAX_JOBS = 1  # Heavy jobs (encodes) allowed to run at the same time, see configure()
+THREADS = 0   # Filter threads per job, 0 lets ffmpeg decide
+STOP_GRACE = 2  # Seconds a stopped job gets to exit before it is killed
+
+job_slots = threading.BoundedSemaphore(MAX_JOBS)
+cancel_event = threading.Event()  # Set by cancel_all() to stop every running and queued job
+jobs_lock = threading.Lock()
+active_jobs = {}  # Job number -> latest progress of every running job
+job_numbers = itertools.count(1)
+
+class FFmpegJobError(Exception):
+    """An ffmpeg job exited with an error.
+
+    Attributes:
+        stderr: Last lines ffmpeg wrote to stderr
+    """
+    def __init__(self, message, stderr=""):
+        super().__init__(message)
+        self.stderr = stderr
+
+    def __str__(self):
+        message = super().__str__()
+        return f"{message}\n{self.stderr}" if self.stderr else message
+
+class FFmpegJobTimeout(FFmpegJobError):
+    """An ffmpeg job ran longer than its timeout and was stopped."""
+
+class FFmpegJobCancelled(FFmpegJobError):
+    """An ffmpeg job was stopped by cancel_all()."""
+
+def configure(max_jobs, threads=0):
+    """Set how many heavy jobs may run at once and how many threads each gets.
+
+    Must be called before any job is started.
+
+    Args:
+        max_jobs: Maximum number of concurrent heavy jobs
+        threads: Filter/encoder threads per job, 0 lets ffmpeg decide
+    """
+    global MAX_JOBS, THREADS, job_slots
+    MAX_JOBS = max(1, max_jobs)
+    THREADS = max(0, threads)
+    job_slots = threading.BoundedSemaphore(MAX_JOBS)
+
+def cancel_all():
+    """Stop every running ffmpeg job and refuse new ones."""
+    cancel_event.set()
+
+def status():
+    """Get the latest progress of every running job.
+
+    Returns:
+        list: Progress dicts with description, out_time, fps and speed
+    """
+    with jobs_lock:
+        return [dict(progress) for progress in active_jobs.values()]
+
+def command_args(job):
+    """Turn a job into an ffmpeg argument vector with progress reporting.
+
+    Args:
+        job: ffmpeg-python output stream, or an argument list starting with "ffmpeg"
+
+    Returns:
+        list: Arguments for subprocess
+    """
+    args = job.compile() if hasattr(job, "compile") else list(job)
+    options = ["-hide_banner", "-nostdin", "-nostats", "-loglevel", "error", "-progress", "pipe:1"]
+    if THREADS:
+        options += ["-filter_threads", str(THREADS)]
+    return args[:1] + options + args[1:]
+
+def stop_process(process):
+    """Ask ffmpeg to stop, killing it if it doesn't exit in time."""
+    process.terminate()
+    try:
+        process.wait(timeout=STOP_GRACE)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def read_progress(stream, progress, bar):
+    """Parse ffmpeg's -progress key=value blocks into the progress dict."""
+    block = {}
+    for line in stream:
+        key, _, value = line.strip().partition("=")
+        block[key] = value
+        if key != "progress":
+            continue
+        try:
+            if block.get("out_time_us", "N/A") != "N/A":
+                progress["out_time"] = max(0.0, int(block["out_time_us"]) / 1e6)
+            progress["frame"] = int(block.get("frame", progress["frame"]))
+            # ffmpeg reports 0 fps in the last block of short jobs, keep the last real value
+            progress["fps"] = float(block.get("fps", 0)) or progress["fps"]
+            speed = block.get("speed", "N/A").rstrip("x").strip()
+            if speed != "N/A":
+                progress["speed"] = float(speed)
+        except ValueError:
+            pass
+        block = {}
+        if bar is not None:
+            bar.n = min(bar.total, round(progress["out_time"], 1))
+            bar.set_postfix(fps=f"{progress['fps']:.0f}", speed=f"{progress['speed']:.1f}x")
+
+def run(job, description, duration=None, timeout=None, heavy=True):
+    """Run an ffmpeg job and wait for it to finish.
+
+    Heavy jobs wait for one of MAX_JOBS slots first, so parallel renders never
+    oversubscribe the CPU. While the job runs, its -progress output is parsed
+    into live frame/fps/speed numbers (shown as a progress bar when the
+    output duration is known).
+
+    Args:
+        job: ffmpeg-python output stream, or an argument list starting with "ffmpeg"
+        description: Short name shown in progress and errors
+        duration: Expected output duration in seconds, for the progress bar
+        timeout: Seconds after which the job is stopped, None for no limit
+        heavy: Whether the job needs an encode slot (stream copies don't)
+
+    Returns:
+        dict: Final progress with frame, fps, speed, out_time and elapsed seconds
+
+    Raises:
+        FFmpegJobError: ffmpeg failed
+        FFmpegJobTimeout: The job ran longer than timeout
+        FFmpegJobCancelled: cancel_all() was called
+    """
+    args = command_args(job)
+    slot = job_slots if heavy else None
+    if slot is not None:
+        # Poll so a queued job notices a cancellation too
+        while not slot.acquire(timeout=0.2):
+            if cancel_event.is_set():
+                raise FFmpegJobCancelled(f"{description} cancelled")
+    try:
+        with tracing.span("ffmpeg", "ffmpeg", job=description) as span:
+            progress = run_process(args, description, duration, timeout)
+            span.update(frames=progress["frame"], fps=progress["fps"], speed=progress["speed"])
+        return progress
+    finally:
+        if slot is not None:
+            slot.release()
+
+def run_process(args, description, duration, timeout):
+    """Run the ffmpeg process of a job, see run()."""
+    from tqdm import tqdm
+    if cancel_event.is_set():
+        raise FFmpegJobCancelled(f"{description} cancelled")
+
+    number = next(job_numbers)
+    progress = {"description": description, "frame": 0, "fps": 0.0, "speed": 0.0, "out_time": 0.0}
+    bar = tqdm(total=duration, desc=description, unit="s", leave=False) if duration else None
+    stderr_tail = deque(maxlen=20)
+    started = time.monotonic()
+
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace")
+    readers = [
+        threading.Thread(target=read_progress, args=(process.stdout, progress, bar), daemon=True),
+        threading.Thread(target=lambda: stderr_tail.extend(line.rstrip() for line in process.stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    with jobs_lock:
+        active_jobs[number] = progress
+
+    try:
+        while True:
+            try:
+                process.wait(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if cancel_event.is_set():
+                stop_process(process)
+                raise FFmpegJobCancelled(f"{description} cancelled")
+            if timeout is not None and time.monotonic() - started > timeout:
+                stop_process(process)
+                raise FFmpegJobTimeout(f"{description} timed out after {timeout}s", "\n".join(stderr_tail))
+    finally:
+        for reader in readers:
+            reader.join(timeout=5)
+        with jobs_lock:
+            active_jobs.pop(number, None)
+        if bar is not None:
+            bar.close()
+
+    progress["elapsed"] = time.monotonic() - started
+    if not progress["fps"] and progress["elapsed"]:
+        progress["fps"] = progress["frame"] / progress["elapsed"]  # Job ended before its first report
+    if process.returncode != 0:
+        raise FFmpegJobError(f"{description} failed with exit code {process.returncode}", "\n".join(stderr_tail))
+    return progress
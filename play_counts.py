@@ -0,0 +1,255 @@
+'''
+VFM - VideoFM
+Per-day play-count rollups of the scrobble stores, for fast top lists over any period.
+'''
+
+import bisect
+import datetime
+import sqlite3
+import threading
+import contextlib
+from collections import Counter, defaultdict
+
+DAY, MONTH, YEAR = 0, 1, 2  # Rollup levels
+
+def day_number(timestamp):
+    """Map a UNIX timestamp to its local calendar day (a proleptic Gregorian ordinal).
+
+    Days are local, like the month boundaries of the compilations, so a
+    period that starts and ends at local midnight covers whole days.
+    """
+    return datetime.date.fromtimestamp(timestamp).toordinal()
+
+def day_start(day):
+    """Get the UNIX timestamp of the local midnight that starts a day, see day_number()."""
+    return int(datetime.datetime.combine(datetime.date.fromordinal(day), datetime.time()).timestamp())
+
+def day_periods(day):
+    """Get the day, month and year rollup periods a day counts towards.
+
+    Returns:
+        tuple: (level, period) pairs - the day's ordinal, year * 12 + month - 1 and the year
+    """
+    date = datetime.date.fromordinal(day)
+    return (DAY, day), (MONTH, date.year * 12 + date.month - 1), (YEAR, date.year)
+
+def split_days(first_day, end_day):
+    """Cover a run of days with as few rollup periods as possible.
+
+    Whole years are read from the year rollups and whole months from the
+    month rollups, so only the days before the first and after the last
+    whole month are read day by day.
+
+    Args:
+        first_day: First day (inclusive)
+        end_day: Day after the last one (exclusive)
+
+    Returns:
+        list: [level, first period, end period] ranges
+    """
+    ranges = []
+    day = first_day
+    while day < end_day:
+        date = datetime.date.fromordinal(day)
+        next_month = datetime.date(date.year + date.month // 12, date.month % 12 + 1, 1).toordinal()
+        next_year = datetime.date(date.year + 1, 1, 1).toordinal()
+        if date.month == 1 and date.day == 1 and next_year <= end_day:
+            level, period, day = YEAR, date.year, next_year
+        elif date.day == 1 and next_month <= end_day:
+            level, period, day = MONTH, date.year * 12 + date.month - 1, next_month
+        else:
+            level, period, day = DAY, day, day + 1
+        if ranges and ranges[-1][0] == level and ranges[-1][2] == period:
+            ranges[-1][2] = period + 1
+        else:
+            ranges.append([level, period, period + 1])
+    return ranges
+
+class PlayCounts:
+    """Daily (artist, track) play counts per user in an SQLite database.
+
+    Scrobbles are added once per synced time range and the covered ranges
+    are recorded with them, so adding is idempotent and counts never drift
+    from the scrobble store. Every play is also counted towards its month
+    and year, so a top list for any run of days, users and artist is a
+    single aggregate over a few rows per track instead of a pass over every
+    scrobble.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY,
+            artist TEXT NOT NULL,
+            title TEXT NOT NULL,
+            artist_key TEXT NOT NULL,
+            UNIQUE (artist, title)
+        );
+        CREATE INDEX IF NOT EXISTS track_artist ON tracks (artist_key);
+        CREATE TABLE IF NOT EXISTS rollups (
+            user TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            track_id INTEGER NOT NULL,
+            plays INTEGER NOT NULL,
+            last_played INTEGER NOT NULL,
+            PRIMARY KEY (user, level, period, track_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS coverage (
+            user TEXT NOT NULL,
+            range_from INTEGER NOT NULL,
+            range_to INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS coverage_user ON coverage (user, range_from);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.track_ids = {}  # (artist, title) -> track ID, filled as tracks are seen
+        conn = self.connection()
+        if "first_played" in [column[1] for column in conn.execute("PRAGMA table_info(rollups)")]:
+            # Rollups from before ties were broken by the latest play, they are counted again from the stores
+            conn.executescript("DROP TABLE rollups; DROP TABLE coverage;")
+        conn.executescript(self.SCHEMA)
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run statements under the database write lock."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            self.track_ids.clear()  # May hold IDs of tracks that were rolled back
+            raise
+        conn.execute("COMMIT")
+
+    def coverage(self, user):
+        """Get the time ranges of a user whose scrobbles are counted.
+
+        Returns:
+            list: Sorted [from, to) ranges
+        """
+        rows = self.connection().execute(
+            "SELECT range_from, range_to FROM coverage WHERE user = ? ORDER BY range_from", (user.lower(),)
+        )
+        return [list(row) for row in rows]
+
+    def track_id(self, conn, artist, title):
+        """Get the ID of a track, adding it on first sight."""
+        track_id = self.track_ids.get((artist, title))
+        if track_id is None:
+            conn.execute("INSERT OR IGNORE INTO tracks (artist, title, artist_key) VALUES (?, ?, ?)",
+                         (artist, title, artist.casefold()))
+            track_id = conn.execute("SELECT id FROM tracks WHERE artist = ? AND title = ?",
+                                    (artist, title)).fetchone()[0]
+            self.track_ids[(artist, title)] = track_id
+        return track_id
+
+    def add(self, user, timestamps, track_ids, tracks, range_from, range_to):
+        """Count the scrobbles of a completely synced time range.
+
+        Plays are counted a day at a time over the store's integer track IDs,
+        so only the distinct tracks of each day are ever looked up by name.
+
+        Args:
+            user: Last.fm username
+            timestamps: Timestamp of every scrobble of the range, sorted
+            track_ids: The scrobble store's track ID of every scrobble
+            tracks: The store's track ID -> (artist, title)
+            range_from: Range start as a UNIX timestamp (inclusive)
+            range_to: Range end as a UNIX timestamp (exclusive)
+
+        Returns:
+            bool: False if part of the range was already counted (nothing is added then)
+        """
+        user = user.lower()
+        totals = defaultdict(lambda: [0, 0])  # (level, period, store track ID) -> [plays, last played]
+        lo = 0
+        while lo < len(timestamps):
+            day = day_number(timestamps[lo])
+            hi = bisect.bisect_left(timestamps, day_start(day + 1), lo)
+            day_ids = track_ids[lo:hi]
+            plays = Counter(day_ids)
+            lasts = dict(zip(day_ids, timestamps[lo:hi]))  # Latest play wins
+            for level, period in day_periods(day):
+                for track_id, count in plays.items():
+                    entry = totals[(level, period, track_id)]
+                    entry[0] += count
+                    entry[1] = max(entry[1], lasts[track_id])
+            lo = hi
+
+        with self.transaction() as conn:
+            overlap = conn.execute(
+                "SELECT 1 FROM coverage WHERE user = ? AND range_from < ? AND range_to > ? LIMIT 1",
+                (user, range_to, range_from)
+            ).fetchone()
+            if overlap:
+                return False
+            conn.executemany(
+                """INSERT INTO rollups (user, level, period, track_id, plays, last_played) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (user, level, period, track_id) DO UPDATE SET
+                       plays = plays + excluded.plays,
+                       last_played = MAX(last_played, excluded.last_played)""",
+                [(user, level, period, self.track_id(conn, *tracks[track_id]), plays, last)
+                 for (level, period, track_id), (plays, last) in totals.items()]
+            )
+            conn.execute("INSERT INTO coverage (user, range_from, range_to) VALUES (?, ?, ?)",
+                         (user, range_from, range_to))
+        return True
+
+    def top(self, users, first_day, end_day, limit=None, artist=None):
+        """Rank tracks by their plays over a run of days.
+
+        The days are covered with year, month and day rollups, see
+        split_days(). Ties go to the track played most recently, the same order a
+        Counter over the scrobbles newest first (Last.fm's page order) gives.
+
+        Args:
+            users: Usernames whose plays are added up
+            first_day: First day, see day_number() (inclusive)
+            end_day: Day after the last one (exclusive)
+            limit: Number of tracks to return, None for all
+            artist: Only count this artist's tracks (case-insensitive)
+
+        Returns:
+            list: (artist, title, plays, last played timestamp) tuples, most played first
+        """
+        users = [user.lower() for user in users]
+        placeholders = ",".join("?" * len(users))
+        parts, params = [], []
+        for level, first_period, end_period in split_days(first_day, end_day):
+            parts.append(f"SELECT track_id, plays, last_played FROM rollups "
+                         f"WHERE user IN ({placeholders}) AND level = ? AND period >= ? AND period < ?")
+            params += [*users, level, first_period, end_period]
+        if not parts:
+            return []
+
+        where = ""
+        if artist is not None:
+            where = "WHERE track_id IN (SELECT id FROM tracks WHERE artist_key = ?)"
+            params.append(artist.casefold())
+        limit_clause = ""
+        if limit is not None:
+            limit_clause = "LIMIT ?"
+            params.append(limit)
+        # Aggregate on track IDs first, and only look up the names of the tracks that made the list
+        query = f"""
+            SELECT t.artist, t.title, ranked.total, ranked.last FROM (
+                SELECT track_id, SUM(plays) AS total, MAX(last_played) AS last
+                FROM ({" UNION ALL ".join(parts)}) {where}
+                GROUP BY track_id ORDER BY total DESC, last DESC {limit_clause}
+            ) ranked JOIN tracks t ON t.id = ranked.track_id
+            ORDER BY ranked.total DESC, ranked.last DESC
+        """
+        return self.connection().execute(query, params).fetchall()
@@ -0,0 +1,151 @@
+'''
+VFM - VideoFM
+Ranking of YouTube search results for a track.
+'''
+
+import re
+
+WATCH_URL = "https://www.youtube.com/watch?v={video_id}"
+
+# Group indicators by priority tiers (1 = highest, 3 = lowest)
+QUALITY_INDICATORS = {
+    # Tier 1: Official music videos (highest priority)
+    "music_video": [
+        # Universal
+        "official music video", "official video", "mv", "m/v", "vevo", "music video",
+        # Korean
+        "뮤직비디오", "official mv", "performance video",
+        # Japanese
+        "ミュージックビデオ", "pv", "オフィシャル",
+        # Spanish
+        "video oficial",
+        # Portuguese 
+        "vídeo oficial", "clipe oficial",
+        # French
+        "clip officiel", "vidéo officielle",
+        # Chinese
+        "官方完整版", "官方版", "官方高清", "官方网易云", "MV超清", "官方MV", "完整版",
+        # Hindi/Indian
+        "official video song", "full video song",
+        # Russian/Slavic
+        "официальное видео", "официальный клип", "официальная премьера", "музыкальный клип",
+        # German
+        "offizielles video", "offizielles musikvideo", "offizieller musikfilm",
+        # Arabic
+        "فيديو كليب رسمي", "الفيديو الرسمي",
+        # Italian
+        "video ufficiale", "videoclip ufficiale",
+        # Turkish
+        "resmi video", "resmi müzik video", "official video klip",
+        # Thai
+        "เอ็มวี", "มิวสิควิดีโอ",
+        # Indonesian/Malay
+        "video klip resmi", "video rasmi", "musik video"
+    ],
+
+    # Tier 2: Topic channels and official audio (medium priority)
+    "audio": [
+        # Official audio indicators
+        "official audio", "audio oficial", "audio ufficiale", 
+        # Generic Topic channel indicators
+        "topic", "studio", "audio", "- Topic"
+    ],
+
+    # Tier 3: Lyric videos (lowest priority)
+    "lyrics": [
+        "lyric video", "lyrics", "with lyrics", "letra", "paroles",
+        "लिरिक्स", "lirik video", "official visualizer", "visualizer"
+    ]
+}
+
+# Tiers from best to worst; "other" holds relevant videos without an indicator
+TIER_ORDER = ["music_video", "audio", "lyrics", "other"]
+
+# Each tier's indicators compiled once into a single case-folded pattern
+TIER_PATTERNS = [
+    (tier, re.compile("|".join(re.escape(indicator.lower()) for indicator in indicators)))
+    for tier, indicators in QUALITY_INDICATORS.items()
+]
+
+def get_match_tier(video_title_lower, channel_title):
+    """Check what tier a video belongs to.
+    
+    Args:
+        video_title_lower: Lowercased video title
+        channel_title: Channel name
+        
+    Returns:
+        tuple: (tier, matched indicator), or (None, None) if no indicator matches
+    """
+    # Check for Topic channels specifically
+    if "- Topic" in channel_title:
+        return "audio", "- Topic"
+    
+    # Check each tier from highest to lowest
+    for tier, pattern in TIER_PATTERNS:
+        match = pattern.search(video_title_lower)
+        if match:
+            return tier, match.group(0)
+    
+    # No specific tier found
+    return None, None
+
+def rank_candidates(artist, title, items, watch_url=WATCH_URL):
+    """Pick the best video for a track from search results.
+    
+    Candidates must mention the artist or the title. The first candidate of
+    the highest tier wins, so results from several queries can be ranked
+    together by passing their items in the order they were returned.
+    
+    Args:
+        artist: Artist name
+        title: Song title
+        items: search().list result items
+        watch_url: Template for the video URL, with a {video_id} field
+        
+    Returns:
+        tuple: (tier, video data dict), or (None, None) if nothing is relevant
+    """
+    artist_lower = artist.lower()
+    title_lower = title.lower()
+    exact_titles = (f"{artist} - {title}".lower(), f"{title} - {artist}".lower())
+    
+    best_matches = {}
+    for item in items:
+        video_id = item["id"].get("videoId")
+        if not video_id:
+            continue
+        
+        video_title = item["snippet"]["title"]
+        video_title_lower = video_title.lower()
+        
+        # Basic relevance check - need either title or artist in the video title
+        if title_lower not in video_title_lower and artist_lower not in video_title_lower:
+            continue
+        
+        channel_title = item["snippet"]["channelTitle"]
+        tier, indicator = get_match_tier(video_title_lower, channel_title)
+        tier_key = tier or "other"
+        
+        # Keep only the first video of each tier
+        if tier_key in best_matches:
+            continue
+        
+        best_matches[tier_key] = {
+            'id': video_id,
+            'url': watch_url.format(video_id=video_id),
+            'title': video_title,
+            'channel': channel_title,
+            'exact_match': any(exact in video_title_lower for exact in exact_titles),
+            'artist_channel': artist_lower in channel_title.lower(),
+            'indicator': indicator
+        }
+        
+        # Nothing can beat the first music video
+        if tier_key == "music_video":
+            break
+    
+    for tier in TIER_ORDER:
+        if tier in best_matches:
+            return tier, best_matches[tier]
+    return None, None
@@ -0,0 +1,155 @@
+'''
+VFM - VideoFM
+Compact per-user scrobble store: a track dictionary plus packed (timestamp, track ID) integers.
+'''
+
+import os
+import sys
+import json
+import mmap
+import bisect
+import struct
+from array import array
+from operator import itemgetter
+
+MAGIC = b"VFMSCROBBLES1\n"
+ALIGNMENT = 8  # The packed plays start at a multiple of this many bytes
+
+class ScrobbleStore:
+    """Every scrobble fetched so far for one user, sorted by timestamp.
+
+    Artist/title pairs are interned in a track dictionary, and the plays
+    are one flat array of unsigned 32-bit integers: timestamp, track ID,
+    timestamp, track ID... On disk that array follows a small JSON header
+    (synced ranges and the dictionary), so opening a store only parses the
+    header and memory-maps the plays, however long the history is.
+
+    Attributes:
+        user: Last.fm username
+        synced: Sorted, non-overlapping [from, to) ranges known to be complete
+        tracks: Track ID -> (artist, title)
+    """
+
+    def __init__(self, user, synced=None, tracks=None, plays=None):
+        self.user = user
+        self.synced = synced or []
+        self.tracks = [tuple(track) for track in tracks or []]
+        self.track_index = None  # (artist, title) -> track ID, built when tracks are added
+        self.mapping = None
+        self.set_plays(plays if plays is not None else array("I"))
+
+    @classmethod
+    def load(cls, path, user):
+        """Open a store file.
+
+        Args:
+            path: Path written by save()
+            user: Last.fm username
+
+        Returns:
+            ScrobbleStore: The store
+
+        Raises:
+            ValueError: The file is not a complete store
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a scrobble store")
+            header_size, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_size))
+            offset = -(-(len(MAGIC) + 4 + header_size) // ALIGNMENT) * ALIGNMENT
+            size = os.fstat(f.fileno()).st_size
+
+            mapping = None
+            if os.name == "nt" or header["byteorder"] != sys.byteorder or size == offset:
+                # Windows can't replace a mapped file on the next save, so read it there instead
+                f.seek(offset)
+                plays = array("I")
+                plays.frombytes(f.read())
+                if header["byteorder"] != sys.byteorder:
+                    plays.byteswap()
+            else:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                plays = memoryview(mapping)[offset:].cast("I")
+
+        if len(plays) != 2 * header["count"]:
+            raise ValueError(f"{path} is truncated")
+        store = cls(user, header["synced"], header["tracks"], plays)
+        store.mapping = mapping
+        return store
+
+    def save(self, path):
+        """Write the store to a file, atomically replacing any previous version."""
+        header = json.dumps({
+            "user": self.user, "synced": self.synced, "tracks": self.tracks,
+            "count": len(self), "byteorder": sys.byteorder,
+        }).encode("utf-8")
+        padding = -(len(MAGIC) + 4 + len(header)) % ALIGNMENT
+
+        # Write to a temporary file first so a crash never leaves a truncated store
+        with open(path + ".tmp", "wb") as f:
+            f.write(MAGIC + struct.pack("<I", len(header)) + header + b"\0" * padding)
+            f.write(self.plays)
+        self.set_plays(array("I", self.plays))  # Let go of the old file before replacing it
+        os.replace(path + ".tmp", path)
+
+    def set_plays(self, plays):
+        """Switch to a new plays array, unmapping the old file if there was one."""
+        previous = self.mapping
+        self.mapping = None
+        self.plays = memoryview(plays)
+        self.timestamps = self.plays[0::2]
+        self.track_ids = self.plays[1::2]
+        if previous is not None:
+            try:
+                previous.close()
+            except BufferError:
+                pass  # Still viewed elsewhere, it is unmapped once that view is gone
+
+    def __len__(self):
+        return len(self.plays) // 2
+
+    def track_id(self, artist, title):
+        """Get the ID of a track, adding it to the dictionary on first sight."""
+        if self.track_index is None:
+            self.track_index = {track: track_id for track_id, track in enumerate(self.tracks)}
+        track = (artist, title)
+        track_id = self.track_index.get(track)
+        if track_id is None:
+            track_id = self.track_index[track] = len(self.tracks)
+            self.tracks.append(track)
+        return track_id
+
+    def extend(self, scrobbles):
+        """Add scrobbles, keeping the store sorted by timestamp.
+
+        Args:
+            scrobbles: [timestamp, artist, title] entries
+        """
+        added = [(int(timestamp), self.track_id(artist, title)) for timestamp, artist, title in scrobbles]
+        if not added:
+            return
+        pairs = sorted([*zip(self.timestamps, self.track_ids), *added], key=itemgetter(0))
+        plays = array("I")
+        for pair in pairs:
+            plays.extend(pair)
+        self.set_plays(plays)
+
+    def bounds(self, start_date, end_date):
+        """Find the positions of the scrobbles between start_date (inclusive) and end_date (exclusive).
+
+        Returns:
+            tuple: (first position, end position)
+        """
+        lo = bisect.bisect_left(self.timestamps, start_date)
+        return lo, bisect.bisect_left(self.timestamps, end_date, lo)
+
+    def scrobbles(self, start_date, end_date):
+        """Decode the scrobbles between start_date (inclusive) and end_date (exclusive).
+
+        Returns:
+            list: [timestamp, artist, title] entries
+        """
+        lo, hi = self.bounds(start_date, end_date)
+        return [[timestamp, *self.tracks[track_id]]
+                for timestamp, track_id in zip(self.timestamps[lo:hi], self.track_ids[lo:hi])]
@@ -0,0 +1,66 @@
+import datetime
+from collections import Counter
+
+import pytest
+
+import play_counts
+import scrobble_store
+import videofm
+
+START = int(datetime.datetime(2024, 5, 1).timestamp())
+END = int(datetime.datetime(2024, 6, 1).timestamp())
+DAY = 24 * 3600
+
+# Two plays each, "Older" last played on May 3rd and "Newer" on May 9th
+SCROBBLES = [
+    [START + 1 * DAY, "Artist", "Older"],
+    [START + 2 * DAY, "Artist", "Newer"],
+    [START + 3 * DAY, "Artist", "Older"],
+    [START + 9 * DAY, "Artist", "Newer"],
+    [START + 10 * DAY, "Artist", "Single"],
+]
+
+@pytest.fixture
+def counts(tmp_path, monkeypatch):
+    db = play_counts.PlayCounts(str(tmp_path / "play_counts.db"))
+    monkeypatch.setattr(videofm, "play_counts_db", db)
+    return db
+
+def make_store(synced):
+    store = scrobble_store.ScrobbleStore("alice", synced)
+    store.extend(SCROBBLES)
+    return store
+
+def baseline_ranking():
+    """The ranking of the original Counter, which saw Last.fm's pages newest first."""
+    newest_first = sorted(SCROBBLES, key=lambda scrobble: scrobble[0], reverse=True)
+    return [song for song, _ in Counter((artist, title) for _, artist, title in newest_first).most_common()]
+
+def test_rollup_ties_go_to_the_most_recently_played_song(counts):
+    store = make_store([[START, END]])
+    videofm.update_play_counts(store)
+
+    ranking = videofm.top_songs([store], START, END, 3)
+
+    assert ranking == [("Artist", "Newer"), ("Artist", "Older"), ("Artist", "Single")]
+    assert ranking == baseline_ranking()
+
+def test_uncounted_scrobbles_break_ties_the_same_way(counts):
+    store = make_store([])  # Nothing synced, so nothing is rolled up
+
+    assert videofm.top_songs([store], START, END, 3) == baseline_ranking()
+
+def test_rollups_from_the_old_schema_are_rebuilt(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = play_counts.sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE rollups (user TEXT, level INTEGER, period INTEGER, track_id INTEGER,
+                              plays INTEGER, first_played INTEGER, PRIMARY KEY (user, level, period, track_id));
+        CREATE TABLE coverage (user TEXT, range_from INTEGER, range_to INTEGER);
+        INSERT INTO coverage VALUES ('alice', 0, 1);
+    """)
+    conn.close()
+
+    db = play_counts.PlayCounts(path)
+
+    assert db.coverage("alice") == []
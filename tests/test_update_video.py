@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import videofm
+
+SONGS = [("Artist A", "First"), ("Artist B", "Second"), ("Artist C", "Third")]
+NEW_URL = "https://www.youtube.com/watch?v=replacement"
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Run update_video against a temporary cache with the network and ffmpeg stages stubbed out."""
+    monkeypatch.setattr(videofm, "VIDEO_OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(videofm, "cache_backend", videofm.SqliteCache(str(tmp_path / "cache.db")))
+    monkeypatch.setattr(videofm, "find_clip_start", lambda url: 42)
+
+    def download_video(url, path, start_time=None, duration=None):
+        with open(path, "wb") as f:
+            f.write(b"source")
+        return 3
+
+    def add_text_overlay(source, clip, text, start_time=None, duration=None):
+        with open(clip, "w") as f:
+            f.write(text)
+
+    monkeypatch.setattr(videofm, "download_video", download_video)
+    monkeypatch.setattr(videofm, "add_text_overlay", add_text_overlay)
+    return tmp_path
+
+def answer(monkeypatch, *answers):
+    replies = iter(answers)
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(replies))
+
+def test_replaces_the_clip_of_the_chosen_song(pipeline, monkeypatch):
+    run = "run"
+    # Countdown order: the least played song first, the most played last
+    video_clips = [str(pipeline / f"old_{rank}.mp4") for rank in (3, 2, 1)]
+    answer(monkeypatch, "yes", "1", NEW_URL, "no")
+
+    videofm.update_video(SONGS, video_clips, run)
+
+    _, new_clip = videofm.clip_paths(NEW_URL, "1. Artist A - First")
+    assert video_clips == [str(pipeline / "old_3.mp4"), str(pipeline / "old_2.mp4"), new_clip]
+    with open(new_clip) as f:
+        assert f.read() == "1. Artist A - First"
+
+    manifest = videofm.cache_get("run_manifest.json", run)
+    key = videofm.song_key("Artist A", "First", 1)
+    assert list(manifest["songs"]) == [key]
+    assert manifest["songs"][key]["url"] == NEW_URL
+    assert manifest["songs"][key]["clip"]["path"] == new_clip
+    assert videofm.load_checkpoint(run, "Artist A", "First", 1)["clip"]["path"] == new_clip
+
+def test_finds_the_clip_when_other_songs_were_skipped(pipeline, monkeypatch):
+    run = "run"
+    # The third song was skipped, so positions no longer follow from the rank
+    video_clips = [str(pipeline / "old_2.mp4"), str(pipeline / "old_1.mp4")]
+    for path in video_clips:
+        with open(path, "w") as f:
+            f.write(os.path.basename(path))
+    videofm.save_checkpoint(run, "Artist B", "Second", 2, clip=videofm.artifact_record(video_clips[0]))
+    answer(monkeypatch, "yes", "2", NEW_URL, "no")
+
+    videofm.update_video(SONGS, video_clips, run)
+
+    _, new_clip = videofm.clip_paths(NEW_URL, "2. Artist B - Second")
+    assert video_clips == [new_clip, str(pipeline / "old_1.mp4")]
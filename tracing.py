@@ -0,0 +1,150 @@
+'''
+VFM - VideoFM
+Run instrumentation: timed spans per stage, counters, Chrome trace export.
+'''
+
+import os
+import json
+import time
+import threading
+import contextlib
+from collections import Counter, defaultdict
+
+enabled = False
+trace_lock = threading.Lock()
+spans = []          # Finished spans as Chrome trace "complete" events
+counters = Counter()
+thread_names = {}   # Thread id -> name, for the trace viewer
+local = threading.local()
+origin = time.perf_counter()
+
+def enable():
+    """Start recording spans and counters for this run."""
+    global enabled, origin
+    with trace_lock:
+        spans.clear()
+        counters.clear()
+        thread_names.clear()
+        origin = time.perf_counter()
+        enabled = True
+
+@contextlib.contextmanager
+def span(name, category="stage", **args):
+    """Time a block of work as one span.
+
+    The yielded dict holds the span's arguments; anything added to it (or
+    through annotate() from code running inside the block) ends up in the
+    trace, for example bytes downloaded or whether a cache was hit.
+
+    Args:
+        name: Span name, e.g. "download"
+        category: Trace category, e.g. "stage" or "api"
+        **args: Initial span arguments
+    """
+    if not enabled:
+        yield args
+        return
+
+    stack = local.__dict__.setdefault("stack", [])
+    stack.append(args)
+    started = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        ended = time.perf_counter()
+        stack.pop()
+        thread = threading.current_thread()
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": (started - origin) * 1e6, "dur": (ended - started) * 1e6,
+            "pid": os.getpid(), "tid": thread.ident, "args": args,
+        }
+        with trace_lock:
+            spans.append(event)
+            thread_names[thread.ident] = thread.name
+
+def annotate(**args):
+    """Add arguments to the innermost open span of the calling thread."""
+    if not enabled:
+        return
+    stack = local.__dict__.get("stack")
+    if stack:
+        stack[-1].update(args)
+
+def count(name, value=1):
+    """Add to a run-wide counter, e.g. API units spent or cache hits."""
+    if not enabled:
+        return
+    with trace_lock:
+        counters[name] += value
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summary():
+    """Summarize the run so far.
+
+    Returns:
+        dict: "stages" (per span name: count, total/mean/p50/p95/max seconds,
+            summed numeric arguments) and "counters"
+    """
+    with trace_lock:
+        events = list(spans)
+        totals = dict(counters)
+
+    durations = defaultdict(list)
+    sums = defaultdict(Counter)
+    for event in events:
+        durations[event["name"]].append(event["dur"] / 1e6)
+        for key, value in event["args"].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                sums[event["name"]][key] += value
+
+    stages = {}
+    for name, values in durations.items():
+        values.sort()
+        stages[name] = {
+            "count": len(values),
+            "total": sum(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "max": values[-1],
+            "sums": dict(sums[name]),
+        }
+    return {"stages": stages, "counters": totals}
+
+def print_summary():
+    """Print the per-stage timing table and the counters."""
+    metrics = summary()
+    print("\n📊 Run metrics")
+    print(f"   {'stage':<22}{'count':>6}{'total s':>10}{'mean s':>9}{'p95 s':>9}{'max s':>9}")
+    for name, stage in sorted(metrics["stages"].items(), key=lambda item: -item[1]["total"]):
+        print(f"   {name:<22}{stage['count']:>6}{stage['total']:>10.2f}{stage['mean']:>9.2f}"
+              f"{stage['p95']:>9.2f}{stage['max']:>9.2f}")
+    for name, value in sorted(metrics["counters"].items()):
+        print(f"   {name}: {value:g}")
+
+def export_chrome_trace(path):
+    """Write the recorded spans as a Chrome trace (chrome://tracing, Perfetto).
+
+    The metrics summary is stored alongside the events under "metrics".
+
+    Args:
+        path: Output JSON path
+    """
+    with trace_lock:
+        events = list(spans)
+        names = dict(thread_names)
+
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+        for tid, name in names.items()
+    ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms", "metrics": summary()}, f, default=str)
@@ -4,50 +4,154 @@ Create video compilations of your top songs from Last.fm.
 '''
 
 import os
-import requests
-import yt_dlp
-import ffmpeg
 import json
 import time
 import datetime
 import calendar
 import re
 import sys
-from dotenv import load_dotenv
-from collections import Counter
-from tqdm import tqdm
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import threading
+import sqlite3
+import contextlib
+import unicodedata
+import hashlib
+import zoneinfo
+import argparse
+import copy
+import random
+import urllib.parse
+import platform
+import subprocess
+from collections import Counter, deque
 from shutil import which
-
-
-load_dotenv()
+from concurrent.futures import ThreadPoolExecutor
+from ranking import rank_candidates
+import chorus
+import ffmpeg_jobs
+import tracing
+import work_queue
+import play_counts
+import scrobble_store
+from ffmpeg_jobs import FFmpegJobError
+
+# Heavy dependencies (requests, yt_dlp, ffmpeg, googleapiclient, tqdm, dotenv, numpy) are
+# imported inside the functions that use them, so importing this module is
+# instant and has no side effects.
 
 # ==== Configuration ====
 LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
+# Extra keys (comma-separated) used once the previous ones run out of quota
+YOUTUBE_API_KEYS = [key.strip() for key in os.getenv("YOUTUBE_API_KEYS", "").split(",") if key.strip()]
 VIDEO_OUTPUT_DIR = "clips"
 CACHE_DIR = "cache"
-CHORUS_START = "00:01:00"  # Approximate start time of the chorus
+SCROBBLE_DIR = os.path.join(CACHE_DIR, "scrobbles")  # Per-user local scrobble stores
+SCROBBLE_SETTLE_TIME = 14 * 24 * 3600  # Last.fm accepts scrobbles this late, so newer ones are fetched every run
+PLAY_COUNTS_DB = os.path.join(CACHE_DIR, "play_counts.db")  # Per-day play counts rolled up from the stores
+CACHE_BACKEND = "sqlite"  # "sqlite", or "json" for the original one-file-per-cache layout
+CACHE_DB = os.path.join(CACHE_DIR, "cache.db")
+CACHE_MAX_ENTRIES = 50000  # Per cache; least recently updated entries are evicted beyond this
+RESOLUTION_TTL = 30 * 24 * 3600  # How long a found track -> video match is reused
+NOT_FOUND_TTL = 3 * 24 * 3600    # How long a track with no match is skipped
+MEDIA_INDEX_TTL = 30 * 24 * 3600  # How long video metadata (duration, size) is reused
+CHORUS_START = "00:01:00"  # Clip start used when the chorus can't be detected
+CHORUS_DETECTION = True  # Start clips at the detected chorus (needs numpy)
 CLIP_DURATION = 15  # Duration of each clip in seconds
+RANGE_DOWNLOADS = True  # Fetch only the clip window instead of the whole video
+KEYFRAME_MARGIN = 5  # Extra seconds fetched on each side so the cut can land on a keyframe
+
+# Output profile every clip is rendered to
+OUTPUT_WIDTH = 1920
+OUTPUT_HEIGHT = 1080
+OUTPUT_FPS = 30
+OUTPUT_SAMPLE_RATE = 44100
+SEGMENT_PRESET = "slow"  # Preset of every stream-copied segment when ENCODER_PRESET is unset, so their headers match
+
+# Download format selection, see select_formats()
+DEFAULT_FORMAT = 'bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/best'  # Used when a video lists no usable formats
+VIDEO_CODEC_PREFERENCE = ("avc1", "vp09", "vp9", "av01")  # Cheapest to decode first
+MIN_AUDIO_BITRATE = 128  # kbps, clips are re-encoded to 192k AAC so lower would be audible
 
 # ===== USER CONFIGURATION =====
 # Codec selection - Change this value to use a different encoder
 # Available options:
+# - "auto": Benchmark the encoders this machine has and use the fastest good one
 # - "h264_videotoolbox": Hardware accelerated H.264 (Mac)
 # - "libx264": Software H.264 (compatible with all systems)
 # - "h264_nvenc": NVIDIA GPU accelerated H.264
 # - "h264_amf": AMD GPU accelerated H.264
 # - "h264_qsv": Intel QuickSync hardware accelerated H.264
-# - "copy": Copy codec (fastest, no re-encoding)
-SELECTED_CODEC = "h264_videotoolbox"  # Default codec - change this line if needed
-
-import os
-import sys
-from shutil import which
-
-# Check if ffmpeg is installed
-if not which("ffmpeg"):
+SELECTED_CODEC = "auto"  # Default codec - change this line if needed
+ENCODER_PRESET = None    # Preset for SELECTED_CODEC, picked by the benchmark in "auto" mode
+ALLOW_MANUAL_YOUTUBE = False  # Ask for a YouTube URL when a search finds nothing
+
+# Encoder benchmark used by SELECTED_CODEC = "auto"
+ENCODER_CANDIDATES = {  # Encoder -> presets to try (None = encoder default)
+    "h264_videotoolbox": [None],
+    "h264_nvenc": ["p1", "p4"],
+    "h264_qsv": ["veryfast", "medium"],
+    "h264_amf": [None],
+    "libx264": ["veryfast", "faster", "medium"],
+}
+FALLBACK_ENCODER = ("libx264", "medium")  # Used when no candidate meets the target
+BENCHMARK_SECONDS = 2           # Length of the synthetic test clip
+MIN_PSNR = 38.0                 # Quality target in dB against the test source
+MAX_BITRATE = 12_000_000        # Bitrate target in bits per second
+ENCODER_CACHE_TTL = 30 * 24 * 3600  # How long a machine's benchmark result is reused
+
+# Pipeline concurrency - how many songs each stage may work on at the same time
+SEARCH_WORKERS = 8    # YouTube searches (network)
+METADATA_WORKERS = 8  # yt-dlp metadata lookups (network)
+DOWNLOAD_WORKERS = 4  # Video downloads (network/disk)
+ENCODE_WORKERS = max(1, (os.cpu_count() or 1) // 4)  # Clip renders (CPU) - also caps concurrent ffmpeg encodes
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // ENCODE_WORKERS)  # Threads per ffmpeg encode
+FFMPEG_TIMEOUT = 600  # Seconds a single clip render may take before it is stopped
+
+# Worker mode (--queue) - songs are rendered by worker processes, possibly on other hosts
+ARTIFACT_DIR = "artifacts"  # Shared directory workers publish finished clips to
+WORKER_TASKS = 8            # Songs one worker process works on at the same time
+
+# Last.fm fetching
+LASTFM_API_URL = "http://ws.audioscrobbler.com/2.0/"
+LASTFM_WORKERS = 4     # Pages fetched in parallel
+LASTFM_RATE_LIMIT = 5  # Maximum requests per second
+
+# HTTP clients - Last.fm goes through one keep-alive session, YouTube through one connection per worker
+HTTP_TIMEOUT = 30        # Seconds before a stalled request is given up on
+HTTP_RETRIES = 4         # Retries after a 429/5xx response or a connection error
+HTTP_BACKOFF = 1.0       # The first retry waits up to this many seconds, doubling after every retry
+HTTP_BACKOFF_MAX = 30.0  # Longest wait before a retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# YouTube endpoints - only changed to point the pipeline at local stand-ins (see benchmarks/)
+YOUTUBE_API_ENDPOINT = None  # Data API root, None for Google's
+YOUTUBE_WATCH_URL = "https://www.youtube.com/watch?v={video_id}"  # Video page handed to yt-dlp
+
+# YouTube quota accounting
+YOUTUBE_DAILY_QUOTA = 10000  # Quota units per key per day
+SEARCH_QUOTA_COST = 100      # Units charged for one search.list call
+YOUTUBE_RATE_LIMIT = 5       # Maximum requests per second across all keys
+QUOTA_EXHAUSTED_POLICY = "skip"  # When every key is out: "skip" the song or "wait" for the reset
+QUOTA_ERROR_REASONS = ("quotaExceeded", "dailyLimitExceeded")  # 403 reasons meaning a key is out for the day
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")  # 403 reasons that only mean "slow down"
+# Append every search().list response to this JSONL file (used by benchmarks/ranking_benchmark.py)
+SEARCH_RECORD_FILE = os.getenv("VIDEOFM_RECORD_SEARCHES")
+
+def load_environment():
+    """Load API keys and settings from a .env file and the environment."""
+    global LASTFM_API_KEY, YOUTUBE_API_KEY, YOUTUBE_API_KEYS, SEARCH_RECORD_FILE
+    from dotenv import load_dotenv
+    load_dotenv()
+    LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
+    YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
+    YOUTUBE_API_KEYS = [key.strip() for key in os.getenv("YOUTUBE_API_KEYS", "").split(",") if key.strip()]
+    SEARCH_RECORD_FILE = os.getenv("VIDEOFM_RECORD_SEARCHES")
+
+def ensure_ffmpeg():
+    """Check if ffmpeg is installed and try to download it if not."""
+    if which("ffmpeg"):
+        return
+    
     print("FFmpeg not found. Attempting to download...")
     try:
         import ffmpeg_downloader as ffdl
@@ -60,217 +164,950 @@ if not which("ffmpeg"):
         print("Please install FFmpeg manually: https://ffmpeg.org/download.html")
         sys.exit(1)
 
-# Validate API keys before proceeding
-if not LASTFM_API_KEY:
-    print("❌ Error: LASTFM_API_KEY environment variable is not set")
-    print("Please create a .env file with your Last.fm API key or set it in your environment")
-    sys.exit(1)
-    
-if not YOUTUBE_API_KEY:
-    print("❌ Error: YOUTUBE_API_KEY environment variable is not set")
-    print("Please create a .env file with your YouTube API key or set it in your environment")
-    sys.exit(1)
-
-# Create necessary directories
-os.makedirs(CACHE_DIR, exist_ok=True)
-os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+def check_api_keys():
+    """Validate API keys before proceeding."""
+    if not LASTFM_API_KEY:
+        print("❌ Error: LASTFM_API_KEY environment variable is not set")
+        print("Please create a .env file with your Last.fm API key or set it in your environment")
+        sys.exit(1)
+        
+    if not YOUTUBE_API_KEY and not YOUTUBE_API_KEYS:
+        print("❌ Error: YOUTUBE_API_KEY environment variable is not set")
+        print("Please create a .env file with your YouTube API key or set it in your environment")
+        sys.exit(1)
 
-def get_youtube_service():
-    """Creates and returns a YouTube API service with the current API key."""
-    return build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
+# Locks shared by the pipeline workers
+cache_lock = threading.RLock()   # Guards the cache backend and JSON cache files
+prompt_lock = threading.Lock()   # Keeps interactive prompts from interleaving
+quota_lock = threading.Lock()    # Guards YouTube quota accounting and rate limiting
+shared_work_lock = threading.Lock()  # Guards the memoized stage results shared between jobs
+merge_lock = threading.Lock()    # Lets only one compilation be stitched at a time
+scrobble_locks = {}              # Username -> lock guarding that user's scrobble store
+media_lock = threading.Lock()    # Guards the in-memory yt-dlp info dicts and download totals
+manifest_lock = threading.Lock() # Guards read-modify-write updates of run manifests
+encoder_lock = threading.Lock()  # Lets only one thread pick the encoder for SELECTED_CODEC = "auto"
+video_infos = {}                 # Video ID -> yt-dlp info dict, kept until the video is downloaded
+download_totals = Counter()      # Bytes downloaded and saved by format selection this run
+youtube_bucket = {"tokens": YOUTUBE_RATE_LIMIT, "updated": time.monotonic()}
+rejected_keys = {}               # API key -> reason YouTube rejected it for, skipped for the rest of the run
+thread_state = threading.local()
+http_lock = threading.Lock()     # Guards creation of the shared HTTP clients below
+http_session = None              # Keep-alive requests.Session shared by every thread
+youtube_services = {}            # API key -> YouTube service, built once per process
+
+def get_youtube_service(api_key=None):
+    """Creates and returns a YouTube API service for an API key.
+    
+    The service is built from the discovery document bundled with
+    google-api-python-client, so no request is made to build it.
+    
+    Args:
+        api_key: Key to use, defaults to YOUTUBE_API_KEY
+    """
+    from googleapiclient.discovery import build
+    client_options = {"api_endpoint": YOUTUBE_API_ENDPOINT} if YOUTUBE_API_ENDPOINT else None
+    return build("youtube", "v3", developerKey=api_key or YOUTUBE_API_KEY, client_options=client_options,
+                 static_discovery=True)
 
-# Initialize YouTube service
-youtube = get_youtube_service()
+def youtube_service(api_key):
+    """Return the shared YouTube service for an API key.
+    
+    Services are only built once per key. They are safe to share because
+    every request is executed on the calling thread's own connection, see
+    youtube_http().
+    """
+    with http_lock:
+        if api_key not in youtube_services:
+            youtube_services[api_key] = get_youtube_service(api_key)
+        return youtube_services[api_key]
 
-def load_cache(filename):
-    """Load a JSON cache file from the cache directory.
+def youtube_http():
+    """Return this thread's keep-alive connection for YouTube API requests.
+    
+    httplib2 connections are not thread-safe, so every pipeline worker has
+    its own. It is reused across API keys, so a key rotation doesn't open a
+    new connection.
+    """
+    http = getattr(thread_state, "http", None)
+    if http is None:
+        import httplib2
+        http = thread_state.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return http
+
+def get_http_session():
+    """Return the keep-alive requests session shared by all threads.
+    
+    The connection pool is sized for the Last.fm workers, so parallel page
+    fetches reuse their connections instead of handshaking every time.
+    """
+    global http_session
+    with http_lock:
+        if http_session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(LASTFM_WORKERS, 4))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_session = session
+        return http_session
+
+def backoff_delay(attempt, retry_after=None):
+    """Get how long to wait before retrying a request.
+    
+    Uses exponential backoff with full jitter, so workers that failed
+    together don't retry together. A Retry-After header takes precedence.
     
     Args:
-        filename: Name of the cache file to load
+        attempt: Number of retries already made
+        retry_after: Value of the response's Retry-After header, if any
         
     Returns:
-        dict: Loaded cache data, or empty dict if file doesn't exist
+        float: Seconds to wait
     """
-    path = os.path.join(CACHE_DIR, filename)
-    if os.path.exists(path):
-        with open(path, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_cache(data, filename):
-    """Save data to a JSON cache file in the cache directory.
+    try:
+        if retry_after is not None:
+            return min(HTTP_BACKOFF_MAX, max(0.0, float(retry_after)))
+    except ValueError:
+        pass  # An HTTP date rather than seconds
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+def http_get(url, params=None, throttle=None):
+    """GET a URL on the shared session, retrying 429/5xx responses and connection errors.
     
     Args:
-        data: Data to save
-        filename: Name of the cache file to save to
+        url: URL to fetch
+        params: Query parameters
+        throttle: Called before every attempt, e.g. to wait for a rate limiter
+        
+    Returns:
+        requests.Response: The successful response
+        
+    Raises:
+        requests.exceptions.RequestException: The request still failed after HTTP_RETRIES retries
     """
-    path = os.path.join(CACHE_DIR, filename)
-    with open(path, "w") as f:
-        json.dump(data, f, indent=4)
+    import requests
+    for attempt in range(HTTP_RETRIES + 1):
+        if throttle:
+            throttle()
+        try:
+            response = get_http_session().get(url, params=params, timeout=HTTP_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == HTTP_RETRIES:
+                raise
+            reason, delay = type(e).__name__, backoff_delay(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                response.raise_for_status()
+                return response
+            reason, delay = f"HTTP {response.status_code}", backoff_delay(attempt, response.headers.get("Retry-After"))
+        
+        tracing.count("http.retries")
+        print(f"⏳ {reason} from {urllib.parse.urlsplit(url).netloc}, retrying in {delay:.1f}s...")
+        time.sleep(delay)
 
-# Load cached data
-video_cache = load_cache("video_cache.json")
-progress = load_cache("progress.json")
-lastfm_cache = load_cache("lastfm_cache.json")
+class JsonCache:
+    """Cache backend keeping every cache in its own JSON file in the cache directory.
+    
+    Every write rewrites the whole file, so this is only meant for small
+    caches or for inspecting the cache by hand.
+    """
+    
+    EXPIRES_KEY = "__expires__"  # Per-key expiry timestamps stored alongside the data
+    
+    def __init__(self, directory):
+        self.directory = directory
+    
+    def path(self, namespace):
+        return os.path.join(self.directory, f"{namespace}.json")
+    
+    def read(self, namespace):
+        path = self.path(namespace)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return json.load(f)
+        return {}
+    
+    def write(self, namespace, data):
+        with open(self.path(namespace), "w") as f:
+            json.dump(data, f, indent=4)
+    
+    def load(self, namespace):
+        with cache_lock:
+            data = self.read(namespace)
+        expires = data.pop(self.EXPIRES_KEY, {})
+        now = time.time()
+        return {key: value for key, value in data.items() if expires.get(key, now + 1) > now}
+    
+    def get(self, namespace, key):
+        return self.load(namespace).get(key)
+    
+    def set(self, namespace, key, value, ttl=None):
+        with cache_lock:
+            data = self.read(namespace)
+            expires = data.pop(self.EXPIRES_KEY, {})
+            data[key] = value
+            if ttl:
+                expires[key] = time.time() + ttl
+            else:
+                expires.pop(key, None)
+            if expires:
+                data[self.EXPIRES_KEY] = expires
+            self.write(namespace, data)
+    
+    def delete(self, namespace, key):
+        with cache_lock:
+            data = self.read(namespace)
+            data.pop(key, None)
+            data.get(self.EXPIRES_KEY, {}).pop(key, None)
+            self.write(namespace, data)
+    
+    def add(self, namespace, key, amount, limit, ttl=None):
+        with cache_lock:
+            data = self.read(namespace)
+            expires = data.pop(self.EXPIRES_KEY, {})
+            now = time.time()
+            # An expired entry counts as 0 and starts a new expiry period
+            fresh = key not in data or expires.get(key, now + 1) <= now
+            total = amount + (0 if fresh else data[key])
+            if total > limit:
+                return False
+            data[key] = total
+            if fresh and ttl:
+                expires[key] = now + ttl
+            elif fresh:
+                expires.pop(key, None)
+            if expires:
+                data[self.EXPIRES_KEY] = expires
+            self.write(namespace, data)
+            return True
+    
+    def replace(self, namespace, data):
+        with cache_lock:
+            self.write(namespace, data)
+    
+    def clear(self, namespace):
+        with cache_lock:
+            if os.path.exists(self.path(namespace)):
+                os.remove(self.path(namespace))
+    
+    def batch(self):
+        return cache_lock
 
-# Save caches to ensure they exist
-save_cache(video_cache, "video_cache.json") 
-save_cache(progress, "progress.json")  
-save_cache(lastfm_cache, "lastfm_cache.json") 
+class SqliteCache:
+    """Cache backend storing every entry as a row in an indexed SQLite database.
+    
+    Writes are single-row upserts. Each thread gets its own connection, and the
+    database runs in WAL mode so concurrent runs don't corrupt each other.
+    Entries can expire, and each cache is capped at max_entries rows.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            expires_at REAL,
+            PRIMARY KEY (namespace, key)
+        );
+        CREATE INDEX IF NOT EXISTS cache_age ON cache (namespace, updated_at);
+        CREATE INDEX IF NOT EXISTS cache_expiry ON cache (expires_at);
+    """
+    
+    EVICT_EVERY = 500  # Writes between size checks
+    
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+        
+        conn = self.connection()
+        conn.executescript(self.SCHEMA)
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        conn.commit()
+    
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.batch_depth = 0
+        return conn
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """Group writes into a single commit."""
+        conn = self.connection()
+        self.local.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.local.batch_depth -= 1
+            if self.local.batch_depth == 0:
+                conn.commit()
+    
+    def commit(self):
+        if self.local.batch_depth == 0:
+            self.connection().commit()
+    
+    def load(self, namespace):
+        rows = self.connection().execute(
+            "SELECT key, value FROM cache WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, time.time())
+        )
+        return {key: json.loads(value) for key, value in rows}
+    
+    def get(self, namespace, key):
+        row = self.connection().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        conn = self.connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, updated_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), now, now + ttl if ttl else None)
+        )
+        
+        with cache_lock:
+            self.writes += 1
+            evict = self.writes % self.EVICT_EVERY == 0
+        if evict:
+            self.evict(namespace)
+        self.commit()
+    
+    def evict(self, namespace):
+        """Drop the least recently updated entries beyond max_entries."""
+        self.connection().execute(
+            """DELETE FROM cache WHERE namespace = ? AND key IN (
+                SELECT key FROM cache WHERE namespace = ?
+                ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (namespace, namespace, self.max_entries)
+        )
+    
+    def delete(self, namespace, key):
+        self.connection().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+        self.commit()
+    
+    def add(self, namespace, key, amount, limit, ttl=None):
+        """Add to a numeric entry in one statement, so concurrent processes can't lose an update."""
+        if amount > limit:
+            return False
+        now = time.time()
+        # An expired entry counts as 0 and starts a new expiry period
+        current = "CASE WHEN cache.expires_at <= excluded.updated_at THEN 0 ELSE CAST(cache.value AS INTEGER) END"
+        cursor = self.connection().execute(
+            f"""INSERT INTO cache (namespace, key, value, updated_at, expires_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (namespace, key) DO UPDATE SET
+                    value = {current} + excluded.value,
+                    updated_at = excluded.updated_at,
+                    expires_at = CASE WHEN cache.expires_at <= excluded.updated_at
+                                 THEN excluded.expires_at ELSE cache.expires_at END
+                WHERE {current} + excluded.value <= ?""",
+            (namespace, key, json.dumps(amount), now, now + ttl if ttl else None, limit)
+        )
+        self.commit()
+        return cursor.rowcount == 1
+    
+    def replace(self, namespace, data):
+        with self.batch():
+            self.clear(namespace)
+            for key, value in data.items():
+                self.set(namespace, key, value)
+    
+    def clear(self, namespace):
+        self.connection().execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+        self.commit()
 
-# ==== User Configuration ====
+# Cache files from the JSON layout that are imported into the database once
+LEGACY_CACHE_FILES = ["video_cache.json", "progress.json", "compilation_manifest.json"]
 
-# Get Last.fm username
-LASTFM_USER = input("Enter your Last.fm username: ").strip()
+def import_json_caches(backend):
+    """Move existing JSON cache files into a database backend.
+    
+    Imported files are renamed to *.imported so this only happens once.
+    
+    Args:
+        backend: Cache backend to import into
+    """
+    for filename in LEGACY_CACHE_FILES:
+        path = os.path.join(CACHE_DIR, filename)
+        if not os.path.exists(path):
+            continue
+        
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not import {filename}: {e}")
+            continue
+        
+        namespace = os.path.splitext(filename)[0]
+        with backend.batch():
+            for key, value in data.items():
+                backend.set(namespace, key, value)
+        os.replace(path, path + ".imported")
+        print(f"📦 Imported {len(data)} entries from {filename}")
 
-# Get target year and month
-TARGET_YEAR = input("Enter the target year (YYYY): ").strip()
-TARGET_MONTH = input("Enter the target month (MM): ").strip()
+cache_backend = None
 
-# Get number of songs to include
-while True:
-    num_songs_input = input("Enter the number of top songs to include (1-50): ").strip()
+def get_cache_backend():
+    """Open the configured cache backend on first use.
     
-    if num_songs_input.isdigit():
-        num_songs = int(num_songs_input)
-        if 1 <= num_songs <= 50:
-            NUM_SONGS = num_songs
-            break
-        else:
-            print("❌ Please enter a number between 1 and 50.")
-    else:
-        print("❌ Invalid input. Please enter a valid number.")
+    Returns:
+        JsonCache or SqliteCache: The shared backend
+    """
+    global cache_backend
+    with cache_lock:
+        if cache_backend is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            if CACHE_BACKEND == "json":
+                cache_backend = JsonCache(CACHE_DIR)
+            else:
+                cache_backend = SqliteCache(CACHE_DB)
+                import_json_caches(cache_backend)
+    return cache_backend
 
-# Display the selected codec to the user
-print(f"\n🎬 Using video codec: {SELECTED_CODEC}")
+def cache_namespace(filename):
+    """Map a cache file name like "progress.json" to its namespace."""
+    return os.path.splitext(filename)[0]
 
-# Ask if user wants to manually input YouTube URLs for missing videos
-manual_youtube_input = input(
-    "❓ Do you want to manually input YouTube URLs if a search fails? (yes/no): "
-).strip().lower()
+def load_cache(filename):
+    """Load a whole cache.
+    
+    Args:
+        filename: Name of the cache to load
+        
+    Returns:
+        dict: Loaded cache data, or empty dict if the cache doesn't exist
+    """
+    return get_cache_backend().load(cache_namespace(filename))
 
-ALLOW_MANUAL_YOUTUBE = manual_youtube_input == "yes"
+def save_cache(data, filename):
+    """Replace a whole cache with new data.
+    
+    Prefer cache_set() for single entries - this rewrites every key.
+    
+    Args:
+        data: Data to save
+        filename: Name of the cache to save to
+    """
+    get_cache_backend().replace(cache_namespace(filename), data)
 
-# Set up final video filename
-FINAL_VIDEO = f"{LASTFM_USER}_top{NUM_SONGS}_{TARGET_YEAR}_{TARGET_MONTH}.mp4"
+def cache_get(filename, key):
+    """Get a single cache entry.
+    
+    Args:
+        filename: Name of the cache
+        key: Entry key
+        
+    Returns:
+        The cached value, or None if it's missing or expired
+    """
+    value = get_cache_backend().get(cache_namespace(filename), key)
+    tracing.count(f"cache.{cache_namespace(filename)}.{'miss' if value is None else 'hit'}")
+    return value
 
-# Validate inputs
-if not TARGET_YEAR.isdigit() or len(TARGET_YEAR) != 4:
-    print("❌ Invalid year format. Please enter a valid year (YYYY).")
-    sys.exit(1)
+def cache_set(filename, key, value, ttl=None):
+    """Insert or update a single cache entry.
+    
+    Args:
+        filename: Name of the cache
+        key: Entry key
+        value: JSON-serializable value
+        ttl: Seconds until the entry expires, or None to keep it
+    """
+    get_cache_backend().set(cache_namespace(filename), key, value, ttl)
 
-if not TARGET_MONTH.isdigit() or not (1 <= int(TARGET_MONTH) <= 12):
-    print("❌ Invalid month format. Please enter a number between 1 and 12.")
-    sys.exit(1)
+def cache_clear(filename):
+    """Remove every entry of a cache.
+    
+    Args:
+        filename: Name of the cache
+    """
+    get_cache_backend().clear(cache_namespace(filename))
 
-def get_top_songs():
-    """Fetch top songs for the specified month and year from Last.fm.
+def cache_delete(filename, key):
+    """Remove a single cache entry.
     
-    Uses cached data when available. Otherwise, fetches all scrobbles for the 
-    month and calculates the top songs.
+    Args:
+        filename: Name of the cache
+        key: Entry key
+    """
+    get_cache_backend().delete(cache_namespace(filename), key)
+
+def cache_add(filename, key, amount, limit, ttl=None):
+    """Atomically add to a numeric cache entry, unless the total would exceed limit.
     
+    Args:
+        filename: Name of the cache
+        key: Entry key
+        amount: Number to add, a missing or expired entry counts as 0
+        limit: Largest total allowed
+        ttl: Seconds until a new entry expires, or None to keep it
+        
     Returns:
-        list: List of tuples containing (artist, title) for the top songs
+        bool: True if the amount was added
     """
-    cache = load_cache("lastfm_cache.json")
-    month_key = f"{LASTFM_USER}_{TARGET_YEAR}-{int(TARGET_MONTH):02d}"
-    current_time = int(time.time())
+    return get_cache_backend().add(cache_namespace(filename), key, amount, limit, ttl)
 
-    # Check cache first (valid for 6 hours)
-    if month_key in cache and current_time - cache[month_key].get("last_fetched", 0) < 6 * 3600:
-        print(f"✅ Using cached data for {month_key}")
-        return [
-            artist_title
-            for artist_title, _ in Counter(map(tuple, cache[month_key]["scrobbles"])).most_common(NUM_SONGS)
-        ]
-
-    # Determine timestamp range for the target month
-    start_date = int(datetime.datetime(int(TARGET_YEAR), int(TARGET_MONTH), 1).timestamp())
+def cache_batch():
+    """Group several cache writes into one commit.
     
-    # Calculate end date (first day of next month)
-    if int(TARGET_MONTH) < 12:
-        end_date = int(datetime.datetime(int(TARGET_YEAR), int(TARGET_MONTH) + 1, 1).timestamp())
-    else:
-        end_date = int(datetime.datetime(int(TARGET_YEAR) + 1, 1, 1).timestamp())
+    Returns:
+        Context manager
+    """
+    return get_cache_backend().batch()
+
+# Shared Last.fm rate limiter state
+lastfm_rate_lock = threading.Lock()
+lastfm_next_request = 0.0
+
+def wait_for_lastfm_slot():
+    """Block until another Last.fm request fits under LASTFM_RATE_LIMIT."""
+    global lastfm_next_request
+    with lastfm_rate_lock:
+        now = time.monotonic()
+        wait = max(0.0, lastfm_next_request - now)
+        lastfm_next_request = max(now, lastfm_next_request) + 1.0 / LASTFM_RATE_LIMIT
+    if wait:
+        time.sleep(wait)
+
+def fetch_lastfm_page(user, page, start_date, end_date):
+    """Fetch one page of scrobbles between start_date and end_date.
+    
+    Args:
+        user: Last.fm username
+        page: Page number (1-based)
+        start_date: Range start as a UNIX timestamp (inclusive)
+        end_date: Range end as a UNIX timestamp (exclusive)
+        
+    Returns:
+        dict: Parsed JSON response
+    """
+    params = {
+        "method": "user.getrecenttracks",
+        "user": user,
+        "api_key": LASTFM_API_KEY,
+        "format": "json",
+        "limit": 1000,
+        "page": page,
+        "from": start_date,
+        "to": end_date,
+    }
+    with tracing.span("lastfm.page", "api", page=page) as span:
+        response = http_get(LASTFM_API_URL, params, throttle=wait_for_lastfm_slot)
+        span["bytes"] = len(response.content)
+    tracing.count("lastfm.requests")
+    return response.json()
 
-    all_tracks = []
-    page = 1
-    found_earliest = False  # Flag to track when we've found the earliest track for the month
+class LastfmAPIError(Exception):
+    """Raised when Last.fm answers with an error, e.g. for an unknown user or API key."""
 
-    # Fetch all scrobbles from Last.fm API
-    while not found_earliest:
-        print(f"📥 Fetching page {page} from Last.fm...")
+def get_page_tracks(data):
+    """Validate a getrecenttracks response and return its tracks.
+    
+    Args:
+        data: Parsed JSON response
+        
+    Returns:
+        list: Track dicts, or None if the response is malformed
+        
+    Raises:
+        LastfmAPIError: If Last.fm reported an error
+    """
+    # Check for API errors - raised, so a batch only loses the job it happened in
+    if "error" in data:
+        raise LastfmAPIError(f"Last.fm API error: {data.get('message', data['error'])}")
+
+    # Validate response structure
+    if 'recenttracks' not in data or 'track' not in data['recenttracks']:
+        print("❌ Error: Invalid API response. The expected data structure is missing.")
+        print("Response:", data)
+        return None
+    
+    tracks = data["recenttracks"]["track"]
+    # A page with a single track comes back as a dict instead of a list
+    return [tracks] if isinstance(tracks, dict) else tracks
 
-        url = f"http://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks&user={LASTFM_USER}&api_key={LASTFM_API_KEY}&format=json&limit=1000&page={page}"
+def fetch_scrobbles(user, start_date, end_date):
+    """Fetch all scrobbles between start_date and end_date from Last.fm.
+    
+    Only the requested range is asked for. After page 1 reports totalPages,
+    the remaining pages are fetched concurrently under LASTFM_RATE_LIMIT,
+    in order and with a bounded number in flight.
+    
+    Args:
+        user: Last.fm username
+        start_date: Range start as a UNIX timestamp (inclusive)
+        end_date: Range end as a UNIX timestamp (exclusive)
         
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            data = response.json()
-
-            # Check for API errors
-            if "error" in data:
-                print(f"❌ Last.fm API error: {data['message']}")
-                sys.exit(1)
-
-            # Validate response structure
-            if 'recenttracks' not in data or 'track' not in data['recenttracks']:
-                print("❌ Error: Invalid API response. The expected data structure is missing.")
-                print("Response:", data)
-                break
+    Returns:
+        tuple: (list of [timestamp, artist, title], True if every page was fetched)
+        
+    Raises:
+        LastfmAPIError: If Last.fm reported an error
+    """
+    import requests
+    scrobbles = []
+
+    def collect(tracks):
+        for track in tracks:
+            # Skip currently playing track (no timestamp)
+            if "date" in track:
+                timestamp = int(track["date"]["uts"])
+                if start_date <= timestamp < end_date:
+                    scrobbles.append([timestamp, track["artist"]["#text"], track["name"]])
+
+    # The first page tells us how many pages the range has
+    print("📥 Fetching page 1 from Last.fm...")
+    try:
+        data = fetch_lastfm_page(user, 1, start_date, end_date)
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Error fetching data: {e}")
+        data = None
+    
+    tracks = get_page_tracks(data) if data else None
+    total_pages = 1
+    if tracks:
+        collect(tracks)
+        total_pages = int(data["recenttracks"].get("@attr", {}).get("totalPages", 1))
+    
+    complete = tracks is not None
+    if total_pages > 1:
+        print(f"📥 Fetching pages 2-{total_pages} from Last.fm with {LASTFM_WORKERS} workers...")
+        pages = iter(range(2, total_pages + 1))
+        with ThreadPoolExecutor(max_workers=LASTFM_WORKERS, thread_name_prefix="lastfm") as pool:
+            in_flight = deque(
+                pool.submit(fetch_lastfm_page, user, page, start_date, end_date)
+                for page, _ in zip(pages, range(LASTFM_WORKERS * 2))
+            )
+            while in_flight:
+                try:
+                    tracks = get_page_tracks(in_flight.popleft().result())
+                    if tracks is None:
+                        complete = False
+                    else:
+                        collect(tracks)
+                except requests.exceptions.RequestException as e:
+                    print(f"❌ Error fetching data: {e}")
+                    complete = False
+                
+                next_page = next(pages, None)
+                if next_page is not None:
+                    in_flight.append(pool.submit(fetch_lastfm_page, user, next_page, start_date, end_date))
+    
+    return scrobbles, complete
 
-            tracks = data["recenttracks"]["track"]
-            if not tracks:
-                break  # No more tracks to fetch
-
-            for track in tracks:
-                # Skip currently playing track (no timestamp)
-                if "date" in track:
-                    timestamp = int(track["date"]["uts"])
-
-                    if start_date <= timestamp < end_date:
-                        # Track belongs to our target month
-                        artist = track["artist"]["#text"]
-                        title = track["name"]
-                        all_tracks.append((artist, title))
-                    elif timestamp < start_date:
-                        # We've reached tracks before our target month
-                        print(f"✅ Found earliest track for {TARGET_YEAR}-{int(TARGET_MONTH):02d}, stopping fetch.")
-                        found_earliest = True
-                        break
+def missing_ranges(synced, start_date, end_date):
+    """Find the parts of [start_date, end_date) not covered by synced ranges.
+    
+    Args:
+        synced: Sorted, non-overlapping list of [from, to) ranges
+        start_date: Range start as a UNIX timestamp
+        end_date: Range end as a UNIX timestamp
+        
+    Returns:
+        list: (from, to) tuples that still need to be fetched
+    """
+    missing = []
+    cursor = start_date
+    for range_from, range_to in synced:
+        if range_to <= cursor:
+            continue
+        if range_from >= end_date:
+            break
+        if range_from > cursor:
+            missing.append((cursor, range_from))
+        cursor = max(cursor, range_to)
+    if cursor < end_date:
+        missing.append((cursor, end_date))
+    return missing
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching [from, to) ranges.
+    
+    Args:
+        ranges: List of [from, to) ranges
+        
+    Returns:
+        list: Sorted, non-overlapping list of [from, to] ranges
+    """
+    merged = []
+    for range_from, range_to in sorted(ranges):
+        if merged and range_from <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_to)
+        else:
+            merged.append([range_from, range_to])
+    return merged
 
-            if found_earliest:
-                break
+def scrobble_store_path(user):
+    """Get the path of a user's scrobble store file."""
+    return os.path.join(SCROBBLE_DIR, f"{user.lower()}.scrobbles")
 
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Error fetching data: {e}")
-            break
+def load_scrobble_store(user):
+    """Load a user's local scrobble store.
+    
+    The store keeps every scrobble fetched so far, sorted by timestamp,
+    together with the time ranges that are known to be complete. Its plays
+    are memory-mapped, so loading costs about the same for any history.
+    A JSON store from an earlier version is converted on first use.
+    
+    Args:
+        user: Last.fm username
+        
+    Returns:
+        scrobble_store.ScrobbleStore: The store
+    """
+    path = scrobble_store_path(user)
+    if os.path.exists(path):
+        try:
+            return scrobble_store.ScrobbleStore.load(path, user)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Scrobble store of {user} is unreadable, syncing it again: {e}")
+            return scrobble_store.ScrobbleStore(user)
+    
+    legacy_path = os.path.join(SCROBBLE_DIR, f"{user.lower()}.json")
+    if not os.path.exists(legacy_path):
+        return scrobble_store.ScrobbleStore(user)
+    
+    with open(legacy_path, "r") as f:
+        legacy = json.load(f)
+    store = scrobble_store.ScrobbleStore(user, legacy["synced"])
+    store.extend(legacy["scrobbles"])
+    save_scrobble_store(store)
+    os.replace(legacy_path, legacy_path + ".imported")
+    print(f"📦 Converted {len(store)} scrobbles of {user} to the compact store")
+    return store
+
+def save_scrobble_store(store):
+    """Save a user's local scrobble store.
+    
+    Args:
+        store: Store returned by load_scrobble_store()
+    """
+    os.makedirs(SCROBBLE_DIR, exist_ok=True)
+    store.save(scrobble_store_path(store.user))
+
+def sync_scrobbles(user, start_date, end_date):
+    """Make sure the local store covers [start_date, end_date).
+    
+    Only the parts of the range that were never synced are fetched, so
+    after the first run a compilation normally just pulls the scrobbles of
+    the last SCROBBLE_SETTLE_TIME, and past months cost no Last.fm calls.
+    
+    Args:
+        user: Last.fm username
+        start_date: Range start as a UNIX timestamp (inclusive)
+        end_date: Range end as a UNIX timestamp (exclusive)
+        
+    Returns:
+        scrobble_store.ScrobbleStore: The updated store
+    """
+    with shared_work_lock:
+        user_lock = scrobble_locks.setdefault(user.lower(), threading.Lock())
+    
+    # Jobs for the same user share one store file, so they sync one at a time
+    with user_lock:
+        return sync_scrobble_store(user, start_date, end_date)
 
-        page += 1
-        time.sleep(0.5)  # Prevent API rate-limiting
+def sync_scrobble_store(user, start_date, end_date):
+    """Fetch the unsynced parts of [start_date, end_date) into the local store.
+    
+    Callers must hold the user's lock, see sync_scrobbles().
+    
+    Args:
+        user: Last.fm username
+        start_date: Range start as a UNIX timestamp (inclusive)
+        end_date: Range end as a UNIX timestamp (exclusive)
+        
+    Returns:
+        scrobble_store.ScrobbleStore: The updated store
+    """
+    store = load_scrobble_store(user)
+    
+    # Nothing after "now" can exist yet, and it must be fetched again next time
+    now = int(time.time())
+    end_date = min(end_date, now)
+    missing = missing_ranges(store.synced, start_date, end_date)
+    # Late (offline) scrobbles can still land after this, so that part is never marked synced
+    settled = now - SCROBBLE_SETTLE_TIME
+    
+    if not missing:
+        print(f"✅ Using local scrobbles for {user}")
+        update_play_counts(store)
+        return store
+    
+    partial = []  # Scrobbles from unsettled ranges or ranges with missing pages - used now, not persisted
+    for range_from, range_to in missing:
+        scrobbles, complete = fetch_scrobbles(user, range_from, range_to)
+        if not complete:
+            print("⚠️ Some pages could not be fetched. This range will be fetched again next time.")
+            partial.extend(scrobbles)
+            continue
+        synced_to = min(range_to, max(range_from, settled))
+        store.extend([scrobble for scrobble in scrobbles if int(scrobble[0]) < synced_to])
+        partial.extend(scrobble for scrobble in scrobbles if int(scrobble[0]) >= synced_to)
+        if synced_to > range_from:
+            store.synced = merge_ranges(store.synced + [[range_from, synced_to]])
+    
+    save_scrobble_store(store)
+    update_play_counts(store)
+    store.extend(partial)
+    return store
 
-    # Count occurrences of each song and get the most-played ones
-    track_counts = Counter(all_tracks).most_common(NUM_SONGS)
+def scrobbles_in_range(store, start_date, end_date):
+    """Get the scrobbles of a store between start_date and end_date.
+    
+    Args:
+        store: Store returned by load_scrobble_store()
+        start_date: Range start as a UNIX timestamp (inclusive)
+        end_date: Range end as a UNIX timestamp (exclusive)
+        
+    Returns:
+        list: [timestamp, artist, title] entries
+    """
+    return store.scrobbles(start_date, end_date)
 
-    # Save results to cache
-    cache[month_key] = {
-        "last_fetched": int(time.time()),
-        "scrobbles": all_tracks
-    }
-    save_cache(cache, "lastfm_cache.json") 
+play_counts_db = None
 
-    return [song[0] for song in track_counts]
+def get_play_counts():
+    """Open the play-count rollup database on first use.
+    
+    Returns:
+        play_counts.PlayCounts: The shared rollups
+    """
+    global play_counts_db
+    with cache_lock:
+        if play_counts_db is None:
+            os.makedirs(os.path.dirname(PLAY_COUNTS_DB) or ".", exist_ok=True)
+            play_counts_db = play_counts.PlayCounts(PLAY_COUNTS_DB)
+    return play_counts_db
+
+def update_play_counts(store):
+    """Roll up the synced scrobbles of a store that aren't counted yet.
+    
+    Runs after every sync, so the rollups follow the store. Stores from
+    before the rollups existed are counted the first time they are used.
+    Callers must hold the user's lock, see sync_scrobbles().
+    
+    Args:
+        store: Store returned by load_scrobble_store()
+    """
+    counts = get_play_counts()
+    counted = counts.coverage(store.user)
+    for synced_from, synced_to in store.synced:
+        for range_from, range_to in missing_ranges(counted, synced_from, synced_to):
+            lo, hi = store.bounds(range_from, range_to)
+            counts.add(store.user, store.timestamps[lo:hi], store.track_ids[lo:hi], store.tracks,
+                       range_from, range_to)
+
+def period_range(year, month=None):
+    """Get the timestamps bounding a month, or a whole year if month is None.
+    
+    Returns:
+        tuple: (start, end) UNIX timestamps of local midnights, end exclusive
+    """
+    year = int(year)
+    if month is None:
+        return (int(datetime.datetime(year, 1, 1).timestamp()),
+                int(datetime.datetime(year + 1, 1, 1).timestamp()))
+    
+    month = int(month)
+    start_date = int(datetime.datetime(year, month, 1).timestamp())
+    # Calculate end date (first day of next month)
+    if month < 12:
+        end_date = int(datetime.datetime(year, month + 1, 1).timestamp())
+    else:
+        end_date = int(datetime.datetime(year + 1, 1, 1).timestamp())
+    return start_date, end_date
 
-def load_progress():
-    """Load progress data from cache."""
-    return load_cache("progress.json")
+def split_users(user):
+    """Split a comma-separated list of Last.fm usernames."""
+    return [name.strip() for name in str(user).split(",") if name.strip()]
 
-def save_progress(progress):
-    """Save progress data to cache."""
-    save_cache(progress, "progress.json")
+def get_top_songs(user, year, month, num_songs, artist=None):
+    """Fetch top songs for the specified month and year from Last.fm.
+    
+    Scrobbles come from the user's local store, which is first brought up to
+    date with whatever part of the period hasn't been synced yet. The
+    ranking itself is read from the play-count rollups, see top_songs().
+    
+    Args:
+        user: Last.fm username, or several separated by commas to add up their plays
+        year: Target year
+        month: Target month (1-12), or None for the whole year
+        num_songs: Number of songs to return
+        artist: Only rank this artist's songs
+    
+    Returns:
+        list: List of tuples containing (artist, title) for the top songs
+    """
+    start_date, end_date = period_range(year, month)
+    
+    stores = []
+    for name in split_users(user):
+        with tracing.span("lastfm.sync", user=name):
+            stores.append(sync_scrobbles(name, start_date, end_date))
+    
+    with tracing.span("top_songs", users=len(stores)):
+        return top_songs(stores, start_date, end_date, num_songs, artist)
 
-# Load previous progress
-progress = load_progress()
+def top_songs(stores, start_date, end_date, num_songs, artist=None):
+    """Rank the songs played between start_date and end_date.
+    
+    Counts come from the per-day rollups. Scrobbles the rollups don't cover
+    yet (ranges with pages that failed to sync) are counted from the stores
+    and added on top.
+    
+    Args:
+        stores: Synced stores of the users whose plays are added up
+        start_date: Range start as a UNIX timestamp of a local midnight (inclusive)
+        end_date: Range end as a UNIX timestamp of a local midnight (exclusive)
+        num_songs: Number of songs to return
+        artist: Only rank this artist's songs (case-insensitive)
+        
+    Returns:
+        list: (artist, title) tuples, most played first
+    """
+    counts = get_play_counts()
+    uncounted = {}  # (artist, title) -> [plays, last played]
+    for store in stores:
+        counted = counts.coverage(store.user)
+        for range_from, range_to in missing_ranges(counted, start_date, end_date):
+            lo, hi = store.bounds(range_from, range_to)
+            track_ids = store.track_ids[lo:hi]
+            lasts = dict(zip(track_ids, store.timestamps[lo:hi]))  # Latest play wins
+            for track_id, plays in Counter(track_ids).items():
+                track_artist, title = store.tracks[track_id]
+                if artist is None or track_artist.casefold() == artist.casefold():
+                    entry = uncounted.setdefault((track_artist, title), [0, lasts[track_id]])
+                    entry[0] += plays
+                    entry[1] = max(entry[1], lasts[track_id])
+    
+    users = [store.user for store in stores]
+    first_day, end_day = play_counts.day_number(start_date), play_counts.day_number(end_date)
+    if not uncounted:
+        return [(track_artist, title) for track_artist, title, _, _ in
+                counts.top(users, first_day, end_day, num_songs, artist)]
+    
+    totals = {(track_artist, title): [plays, last] for track_artist, title, plays, last in
+              counts.top(users, first_day, end_day, None, artist)}
+    for song, (plays, last) in uncounted.items():
+        total = totals.setdefault(song, [0, last])
+        total[0] += plays
+        total[1] = max(total[1], last)
+    
+    # Most played first, ties to the song played most recently (like Last.fm's newest-first order)
+    ranked = sorted(totals.items(), key=lambda item: (-item[1][0], -item[1][1]))
+    return [song for song, _ in ranked[:num_songs]]
 
 def clean_query(text):
     """Remove special characters from text for YouTube search.
@@ -283,131 +1120,178 @@ def clean_query(text):
     """
     return re.sub(r"[^\w\s-]", "", text)  # Removes punctuation except spaces and hyphens
 
-def update_youtube_api_key():
-    """Prompt user for a new YouTube API key and update the service globally."""
-    global YOUTUBE_API_KEY, youtube
-    print("⚠️ API quota exceeded. Try again tomorrow, or enter a new API key:")
-    YOUTUBE_API_KEY = input("Enter new API key: ").strip()
-    youtube = get_youtube_service()
+# How much a match of each tier is trusted (an exact "Artist - Title" adds 0.1)
+TIER_CONFIDENCE = {"music_video": 0.9, "audio": 0.8, "lyrics": 0.6, "other": 0.4}
 
-def search_youtube_video(artist, title):
-    """Search for a YouTube video matching the artist and title.
+def resolution_key(artist, title):
+    """Build the resolution cache key for a track.
     
-    Optimized for all languages and international music while
-    being efficient with API usage. Prioritizes official music videos
-    over lyric videos and other content.
+    Case, Unicode width/compatibility forms, punctuation and extra whitespace
+    are normalized away, so spelling variants share one entry.
     
     Args:
         artist: Artist name
         title: Song title
         
     Returns:
-        str: YouTube URL if found, None if not found
+        str: Normalized key: artist and title separated by a tab
     """
-    global youtube
-    artist, title = str(artist), str(title)
-    
-    # Use a less aggressive cleaning function for non-Latin scripts
-    def gentle_clean(text):
-        # Remove only problematic characters but preserve non-Latin characters
-        return re.sub(r'[#<>:"?*|/\\]', "", text)
+    def normalize(text):
+        text = unicodedata.normalize("NFKC", str(text)).casefold()
+        text = re.sub(r"[^\w\s]", " ", text)
+        return " ".join(text.split())
     
-    # Create query with minimal cleaning to preserve non-Latin characters
-    query = f"{gentle_clean(artist)} - {gentle_clean(title)}"
+    return f"{normalize(artist)}\t{normalize(title)}"
 
-    # Check progress cache for previously processed queries
-    if query in progress:
-        print(f"🔁 Using cached result for: {query}")
-        return progress[query]
+def save_resolution(artist, title, url, tier=None, confidence=0.0, ttl=RESOLUTION_TTL, **details):
+    """Store a track -> video resolution shared by all users and runs.
+    
+    Args:
+        artist: Artist name
+        title: Song title
+        url: YouTube URL, or None to remember that nothing was found
+        tier: Match tier ("music_video", "audio", "lyrics", "other" or "manual")
+        confidence: How much the match is trusted, from 0 to 1
+        ttl: Seconds until the entry expires, or None to keep it
+        **details: Extra match information (video title, channel, ...)
+    """
+    entry = dict(details, url=url, tier=tier, confidence=confidence, resolved_at=int(time.time()))
+    cache_set("resolutions.json", resolution_key(artist, title), entry, ttl=ttl)
 
-    # Define search queries with international terms
-    # These terms are common across many languages
-    search_queries = [
-        # First try: Artist - Title (exact match)
-        f"{artist} - {title}",
+class QuotaExhaustedError(Exception):
+    """Raised when no YouTube API key has enough quota left for a request."""
+    
+    def __init__(self, retry_after):
+        super().__init__(f"All YouTube API keys are out of quota for today (resets in {retry_after / 3600:.1f}h)")
+        self.retry_after = retry_after
+
+class YouTubeKeyError(Exception):
+    """Raised when YouTube has rejected every API key for a reason other than its quota."""
+    
+    def __init__(self, rejected):
+        keys = ", ".join(f"...{api_key[-4:]} ({reason})" for api_key, reason in rejected.items())
+        super().__init__(f"YouTube rejected every API key: {keys}. Check their settings")
+        self.rejected = dict(rejected)
+
+def http_error_reason(error):
+    """Get the reason of a Google API error, e.g. "quotaExceeded", or None if it has none."""
+    try:
+        return json.loads(error.content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def youtube_api_keys():
+    """Get the pool of YouTube API keys, in the order they are used.
+    
+    Returns:
+        list: YOUTUBE_API_KEY followed by any extra keys from YOUTUBE_API_KEYS
+    """
+    keys = [YOUTUBE_API_KEY] + YOUTUBE_API_KEYS
+    return [key for i, key in enumerate(keys) if key and key not in keys[:i]]
+
+def quota_day():
+    """Get the current YouTube quota day and the time until it resets.
+    
+    YouTube resets daily quotas at midnight Pacific Time.
+    
+    Returns:
+        tuple: (day as YYYY-MM-DD, seconds until the next reset)
+    """
+    try:
+        pacific = zoneinfo.ZoneInfo("America/Los_Angeles")
+    except zoneinfo.ZoneInfoNotFoundError:
+        pacific = datetime.timezone(datetime.timedelta(hours=-8))
+    now = datetime.datetime.now(pacific)
+    tomorrow = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return now.strftime("%Y-%m-%d"), (tomorrow - now).total_seconds()
+
+def quota_key(api_key, day):
+    """Build the cache key holding a key's usage for a day (never the key itself)."""
+    return f"{day}:{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+
+def acquire_youtube_key(cost):
+    """Reserve quota units on the first key in the pool that can afford them.
+    
+    Keys are rotated before they run out, based on the units already spent
+    today. Requests are also paced by a token bucket of YOUTUBE_RATE_LIMIT
+    requests per second.
+    
+    Args:
+        cost: Quota units the request will use
         
-        # Second try: Add universal terms for official content
-        f"{artist} - {title} official MV"
-    ]
+    Returns:
+        str: API key to use for the request
+        
+    Raises:
+        YouTubeKeyError: If YouTube has rejected every key in the pool
+        QuotaExhaustedError: If no other key has enough quota left today
+    """
+    with quota_lock:
+        day, reset_in = quota_day()
+        usable = [api_key for api_key in youtube_api_keys() if api_key not in rejected_keys]
+        if not usable:
+            raise YouTubeKeyError(rejected_keys)
+        for api_key in usable:
+            # One atomic update, so batch and worker processes sharing the cache never overspend a key
+            if cache_add("youtube_quota.json", quota_key(api_key, day), cost, YOUTUBE_DAILY_QUOTA, ttl=2 * 24 * 3600):
+                break
+        else:
+            raise QuotaExhaustedError(reset_in)
     
-    # Group indicators by priority tiers (1 = highest, 3 = lowest)
-    quality_indicators = {
-        # Tier 1: Official music videos (highest priority)
-        "music_video": [
-            # Universal
-            "official music video", "official video", "mv", "m/v", "vevo", "music video",
-            # Korean
-            "뮤직비디오", "official mv", "performance video",
-            # Japanese
-            "ミュージックビデオ", "pv", "オフィシャル",
-            # Spanish
-            "video oficial",
-            # Portuguese 
-            "vídeo oficial", "clipe oficial",
-            # French
-            "clip officiel", "vidéo officielle",
-            # Chinese
-            "官方完整版", "官方版", "官方高清", "官方网易云", "MV超清", "官方MV", "完整版",
-            # Hindi/Indian
-            "official video song", "full video song",
-            # Russian/Slavic
-            "официальное видео", "официальный клип", "официальная премьера", "музыкальный клип",
-            # German
-            "offizielles video", "offizielles musikvideo", "offizieller musikfilm",
-            # Arabic
-            "فيديو كليب رسمي", "الفيديو الرسمي",
-            # Italian
-            "video ufficiale", "videoclip ufficiale",
-            # Turkish
-            "resmi video", "resmi müzik video", "official video klip",
-            # Thai
-            "เอ็มวี", "มิวสิควิดีโอ",
-            # Indonesian/Malay
-            "video klip resmi", "video rasmi", "musik video"
-        ],
-        
-        # Tier 2: Topic channels and official audio (medium priority)
-        "audio": [
-            # Official audio indicators
-            "official audio", "audio oficial", "audio ufficiale", 
-            # Generic Topic channel indicators
-            "topic", "studio", "audio", "- Topic"
-        ],
-        
-        # Tier 3: Lyric videos (lowest priority)
-        "lyrics": [
-            "lyric video", "lyrics", "with lyrics", "letra", "paroles",
-            "लिरिक्स", "lirik video", "official visualizer", "visualizer"
-        ]
-    }
+    # Token bucket: refill at YOUTUBE_RATE_LIMIT per second, burst of the same size
+    while True:
+        with quota_lock:
+            now = time.monotonic()
+            youtube_bucket["tokens"] = min(
+                YOUTUBE_RATE_LIMIT,
+                youtube_bucket["tokens"] + (now - youtube_bucket["updated"]) * YOUTUBE_RATE_LIMIT
+            )
+            youtube_bucket["updated"] = now
+            if youtube_bucket["tokens"] >= 1:
+                youtube_bucket["tokens"] -= 1
+                return api_key
+            wait = (1 - youtube_bucket["tokens"]) / YOUTUBE_RATE_LIMIT
+        time.sleep(wait)
+
+def mark_key_exhausted(api_key):
+    """Record that YouTube rejected a key for quota, so it is skipped until the reset.
     
-    # Function to check what tier a video belongs to
-    def get_match_tier(video_title_lower, channel_title):
-        # Check for Topic channels specifically
-        if "- Topic" in channel_title:
-            return "audio", "- Topic"
-            
-        # Check each tier from highest to lowest
-        for tier, indicators in quality_indicators.items():
-            for indicator in indicators:
-                if indicator.lower() in video_title_lower:
-                    return tier, indicator
-                    
-        # No specific tier found
-        return None, None
-    
-    # Try each query
-    best_matches = {
-        "music_video": None,  # Best music video match
-        "audio": None,        # Best audio match
-        "lyrics": None,       # Best lyric video match
-        "other": None         # Fallback match
-    }
+    Args:
+        api_key: The exhausted key
+    """
+    day, _ = quota_day()
+    cache_set("youtube_quota.json", quota_key(api_key, day), YOUTUBE_DAILY_QUOTA, ttl=2 * 24 * 3600)
+
+def execute_search(search_query):
+    """Run one YouTube search on the key pool.
     
-    for search_query in search_queries:
+    When every key is exhausted, QUOTA_EXHAUSTED_POLICY decides whether to
+    wait for the daily reset or to give up on this search.
+    
+    Args:
+        search_query: Text to search for
+        
+    Returns:
+        dict: search().list response, or None if no quota is available
+        
+    Raises:
+        YouTubeKeyError: If YouTube has rejected every key in the pool
+    """
+    from googleapiclient.errors import HttpError
+    while True:
+        try:
+            api_key = acquire_youtube_key(SEARCH_QUOTA_COST)
+        except QuotaExhaustedError as e:
+            if QUOTA_EXHAUSTED_POLICY != "wait":
+                print(f"⚠️ {e}. Skipping search.")
+                return None
+            print(f"⏳ {e}. Waiting for the reset...")
+            time.sleep(e.retry_after + 60)
+            continue
+        
         try:
             print(f"🔍 Searching: {search_query}...")
-            request = youtube.search().list(
+            request = youtube_service(api_key).search().list(
                 part="snippet",
                 q=search_query,
                 type="video",
@@ -415,127 +1299,372 @@ def search_youtube_video(artist, title):
                 order="relevance",
                 videoCategoryId="10"  # Music category
             )
-            response = request.execute()
-            
-            # First pass: Categorize all videos by tier and find the best in each
-            for item in response.get("items", []):
-                video_title = item["snippet"]["title"]
-                video_title_lower = video_title.lower()
-                channel_title = item["snippet"]["channelTitle"]
-                
-                # Basic relevance check - need either title or artist in the video title
-                is_relevant = (title.lower() in video_title_lower) or (artist.lower() in video_title_lower)
-                
-                # Skip if not even relevant
-                if not is_relevant:
-                    continue
-                    
-                # Get the tier of this video
-                tier, indicator = get_match_tier(video_title_lower, channel_title)
-                
-                # If no specific tier, check other quality signals
-                is_artist_channel = artist.lower() in channel_title.lower()
-                title_exact_match = (
-                    f"{artist} - {title}".lower() in video_title_lower or 
-                    f"{title} - {artist}".lower() in video_title_lower
-                )
-                
-                # Store the video in its tier if we don't have one yet for this tier
-                if 'videoId' in item['id']:  # Add this check
-                    video_id = item['id']['videoId']
-                    video_data = {
-                        'id': video_id,
-                        'url': f"https://www.youtube.com/watch?v={video_id}",
-                        'title': video_title,
-                        'channel': channel_title,
-                        'exact_match': title_exact_match,
-                        'artist_channel': is_artist_channel,
-                        'indicator': indicator
-                    }
-                    
-                    # High-quality perfect match
-                    if title_exact_match or (is_artist_channel and title.lower() in video_title_lower):
-                        # Put in appropriate tier, or "other" if no specific tier
-                        tier_key = tier if tier else "other"
-                        if not best_matches[tier_key]:
-                            best_matches[tier_key] = video_data
-                    elif is_relevant:
-                        # Less perfect but still relevant match
-                        tier_key = tier if tier else "other"
-                        if not best_matches[tier_key]:
-                            best_matches[tier_key] = video_data
-            
-            # If we found at least one good match, stop searching
-            if any(best_matches.values()):
-                break
-                
+            with tracing.span("youtube.search", "api", units=SEARCH_QUOTA_COST):
+                tracing.count("youtube.quota_units", SEARCH_QUOTA_COST)
+                # The client retries 429/5xx and rate-limit 403s with jittered exponential backoff
+                return request.execute(http=youtube_http(), num_retries=HTTP_RETRIES)
         except HttpError as e:
-            if e.resp.status == 403:
-                # API quota exceeded, ask for a new key
-                update_youtube_api_key()
+            reason = http_error_reason(e)
+            if e.resp.status == 403 and reason in QUOTA_ERROR_REASONS:
+                # API quota exceeded, rotate to the next key
+                print(f"⚠️ YouTube API key ending in {api_key[-4:]} is out of quota, rotating keys")
+                mark_key_exhausted(api_key)
+            elif e.resp.status in (400, 403) and reason not in RATE_LIMIT_REASONS:
+                # A misconfigured key (invalid, API not enabled, referrer blocked...) won't work on a retry
+                print(f"⚠️ YouTube rejected the API key ending in {api_key[-4:]} ({reason or e.resp.status}), "
+                      f"skipping it for this run")
+                with quota_lock:
+                    rejected_keys[api_key] = reason or e.resp.status
             else:
                 raise
+
+def record_search(artist, title, search_query, response):
+    """Append a search response to SEARCH_RECORD_FILE, if recording is enabled.
+    
+    Args:
+        artist: Artist name
+        title: Song title
+        search_query: Query that was sent
+        response: search().list response
+    """
+    if not SEARCH_RECORD_FILE:
+        return
+    record = {"artist": artist, "title": title, "query": search_query, "response": response}
+    with cache_lock:
+        with open(SEARCH_RECORD_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def search_youtube_video(artist, title):
+    """Search for a YouTube video matching the artist and title.
+    
+    Optimized for all languages and international music while
+    being efficient with API usage. Prioritizes official music videos
+    over lyric videos and other content.
+    
+    Args:
+        artist: Artist name
+        title: Song title
+        
+    Returns:
+        str: YouTube URL if found, None if not found
+    """
+    artist, title = str(artist), str(title)
+    
+    # Use a less aggressive cleaning function for non-Latin scripts
+    def gentle_clean(text):
+        # Remove only problematic characters but preserve non-Latin characters
+        return re.sub(r'[#<>:"?*|/\\]', "", text)
+    
+    # Create query with minimal cleaning to preserve non-Latin characters
+    query = f"{gentle_clean(artist)} - {gentle_clean(title)}"
+
+    # Check progress cache for previously processed queries
+    cached_url = cache_get("progress.json", query)
+    if cached_url:
+        print(f"🔁 Using cached result for: {query}")
+        tracing.annotate(source="progress cache")
+        return cached_url
+
+    # Check the long-lived resolution cache shared by all users and runs
+    resolution = cache_get("resolutions.json", resolution_key(artist, title))
+    if resolution and resolution.get("url"):
+        print(f"🔁 Using resolved {resolution.get('tier') or 'video'} for: {query}")
+        cache_set("progress.json", query, resolution["url"])
+        tracing.annotate(source="resolution cache")
+        return resolution["url"]
+
+    # Define search queries with international terms
+    # These terms are common across many languages
+    search_queries = [
+        # First try: Artist - Title (exact match)
+        f"{artist} - {title}",
+        
+        # Second try: Add universal terms for official content
+        f"{artist} - {title} official MV"
+    ]
+    
+    # Tracks recently found to have no video are not searched again
+    known_missing = resolution is not None
+    if known_missing:
+        print(f"⏭️ No video was found for {query} recently, skipping search")
+        search_queries = []
+    quota_error = False
+    
+    # Try each query, ranking all candidates seen so far
+    candidates = []
+    tier, match = None, None
+    
+    for search_query in search_queries:
+        response = execute_search(search_query)
+        if response is None:
+            # No API key has quota left for this search
+            quota_error = True
+            break
+        
+        record_search(artist, title, search_query, response)
+        candidates.extend(response.get("items", []))
+        tier, match = rank_candidates(artist, title, candidates, YOUTUBE_WATCH_URL)
+        
+        # If we found at least one good match, stop searching
+        if match:
+            break
     
     # Return the best match based on priority tier
-    for tier in ["music_video", "audio", "lyrics", "other"]:
-        if best_matches[tier]:
-            match = best_matches[tier]
-            
-            # Determine the match type description
-            if tier == "music_video":
-                match_type = "music video"
-            elif tier == "audio":
-                match_type = "audio" if match['indicator'] != "- Topic" else "topic channel"
-            elif tier == "lyrics":
-                match_type = "lyric video"
-            else:
-                match_type = "relevant video"
-                
-            print(f"✅ Found {match_type}: {match['url']}")
-            print(f"   Title: '{match['title']}'")
-            print(f"   Channel: {match['channel']}")
-            
-            # Save results in both caches
-            video_cache[query] = match['url']
-            save_cache(video_cache, "video_cache.json")
-            progress[query] = match['url']
-            save_progress(progress)
+    if match:
+        # Determine the match type description
+        if tier == "music_video":
+            match_type = "music video"
+        elif tier == "audio":
+            match_type = "audio" if match['indicator'] != "- Topic" else "topic channel"
+        elif tier == "lyrics":
+            match_type = "lyric video"
+        else:
+            match_type = "relevant video"
             
-            return match['url']
+        print(f"✅ Found {match_type}: {match['url']}")
+        print(f"   Title: '{match['title']}'")
+        print(f"   Channel: {match['channel']}")
+        
+        # Save results in both caches
+        with cache_batch():
+            save_resolution(
+                artist, title, match['url'], tier=tier,
+                confidence=min(1.0, TIER_CONFIDENCE[tier] + (0.1 if match['exact_match'] else 0.0)),
+                video_id=match['id'], video_title=match['title'], channel=match['channel']
+            )
+            cache_set("progress.json", query, match['url'])
+        
+        tracing.annotate(source="search", tier=tier)
+        return match['url']
     
     # No matches found through automatic search
     print(f"❌ No valid video found for {artist} - {title}")
     
+    # Remember the miss for a while, unless the search itself was cut short
+    if not known_missing and not quota_error:
+        save_resolution(artist, title, None, ttl=NOT_FOUND_TTL)
+    
     # Allow user manual input if enabled
     if ALLOW_MANUAL_YOUTUBE:
-        user_input = input(f"❌ No valid video found for {artist} - {title}. Enter a manual YouTube URL (or press Enter to skip): ").strip()
+        with prompt_lock:
+            user_input = input(f"❌ No valid video found for {artist} - {title}. Enter a manual YouTube URL (or press Enter to skip): ").strip()
         
         if user_input.startswith("https://www.youtube.com/watch"):
+            save_resolution(artist, title, user_input, tier="manual", confidence=1.0, ttl=None)
             return user_input
     
     return None
 
+def download_range(info, ydl_opts, range_start, range_end):
+    """Download only a time window of a video using yt-dlp's range support.
+    
+    Args:
+        info: yt-dlp info dict of the video, from fetch_video_info()
+        ydl_opts: yt-dlp options used for a regular download
+        range_start: Start of the window in seconds
+        range_end: End of the window in seconds
+        
+    Returns:
+        float: Position of range_start inside the downloaded file in seconds,
+            or None if the format doesn't allow range downloads
+    """
+    import yt_dlp
+    tmp_path = ydl_opts['outtmpl']
+    range_opts = dict(
+        ydl_opts,
+        download_ranges=yt_dlp.utils.download_range_func(None, [(range_start, range_end)])
+    )
+    
+    print(f"📥 Downloading window {range_start:.0f}s-{range_end:.0f}s only...")
+    try:
+        with yt_dlp.YoutubeDL(range_opts) as ydl:
+            ydl.process_ie_result(copy.deepcopy(info), download=True)
+    except yt_dlp.utils.DownloadError as e:
+        print(f"⚠️ Range download not possible for this format: {e}")
+    
+    if os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+        offset = range_offset(tmp_path, range_start, range_end)
+        if offset is not None:
+            return offset
+    
+    # Remove any partial leftovers so the full download starts clean
+    for file_path in [tmp_path, tmp_path + ".part"]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    return None
+
+def range_offset(path, range_start, range_end):
+    """Find where range_start is inside a range-downloaded file.
+    
+    The window is stream-copied, so it really starts at the keyframe before
+    range_start. Depending on the ffmpeg version that lead-in is hidden by
+    an edit list or kept at the start of the timeline, so the timeline is
+    anchored at its end instead, which is cut at range_end either way.
+    
+    Args:
+        path: Downloaded file
+        range_start: Requested start of the window in seconds
+        range_end: End of the window in seconds, at most the video's duration
+        
+    Returns:
+        float: Position of range_start in seconds, or None if the file can't be probed
+    """
+    import ffmpeg
+    try:
+        probe = ffmpeg.probe(path)
+        timing = next((stream for stream in probe["streams"] if stream.get("codec_type") == "video"
+                       and "duration" in stream), probe["format"])
+        end = float(timing.get("start_time") or 0) + float(timing["duration"])
+    except (ffmpeg.Error, KeyError, ValueError) as e:
+        print(f"⚠️ Could not probe the downloaded window: {e}")
+        return None
+    return max(0.0, end - (range_end - range_start))
+
+def format_size(fmt, duration):
+    """Estimate the size of a yt-dlp format in bytes, or None if it isn't known."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 125 * duration  # kbit/s -> bytes
+    return size
+
+def video_format_key(fmt, duration):
+    """Sort key preferring frame rates within OUTPUT_FPS, cheap codecs and then small files.
+    
+    Args:
+        fmt: yt-dlp format dict
+        duration: Video duration in seconds, so bitrate-only formats are compared by their full size
+    """
+    codec = (fmt.get('vcodec') or "").split(".")[0]
+    codec_rank = VIDEO_CODEC_PREFERENCE.index(codec) if codec in VIDEO_CODEC_PREFERENCE else len(VIDEO_CODEC_PREFERENCE)
+    return ((fmt.get('fps') or 0) > OUTPUT_FPS, codec_rank, format_size(fmt, duration) or float('inf'))
+
+def select_formats(info):
+    """Pick the cheapest formats that still fill the output profile.
+    
+    Every clip is scaled down to OUTPUT_WIDTH x OUTPUT_HEIGHT at OUTPUT_FPS,
+    so anything bigger or faster is downloaded and decoded only to be thrown
+    away. This takes the smallest video stream that reaches the output size
+    (or the biggest one if none does), then prefers frame rates within
+    OUTPUT_FPS, H.264 over VP9 over AV1 (cheapest to decode first) and the
+    smaller file. Audio is the smallest stream of at least MIN_AUDIO_BITRATE,
+    AAC first.
+    
+    Args:
+        info: yt-dlp info dict
+    
+    Returns:
+        tuple: (selected format dicts, format dicts DEFAULT_FORMAT would pick),
+            or None if the video lists no formats with a known resolution (and
+            audio, when there is no separate audio stream)
+    """
+    duration = info.get('duration')
+    formats = [f for f in info.get('formats') or [] if not f.get('has_drm')]
+    videos = [f for f in formats if f.get('vcodec') != 'none' and f.get('height')]
+    audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    if not audios:
+        # Nothing to add the audio from, so the video stream has to carry it
+        videos = [f for f in videos if f.get('acodec') not in (None, 'none')]
+    if not videos:
+        return None
+    
+    def fills(fmt):
+        return (fmt.get('width') or 0) >= OUTPUT_WIDTH or fmt['height'] >= OUTPUT_HEIGHT
+    
+    if any(fills(f) for f in videos):
+        video = min((f for f in videos if fills(f)), key=lambda f: (f['height'], *video_format_key(f, duration)))
+    else:
+        video = min(videos, key=lambda f: (-f['height'], *video_format_key(f, duration)))
+    selected = [video]
+    
+    if video.get('acodec') in (None, 'none'):
+        good = [f for f in audios if (f.get('abr') or 0) >= MIN_AUDIO_BITRATE]
+        selected.append(
+            min(good, key=lambda f: (f.get('ext') != 'm4a', f.get('abr'))) if good
+            else max(audios, key=lambda f: f.get('abr') or 0)
+        )
+    
+    # yt-dlp lists formats worst to best, so the last match is what DEFAULT_FORMAT downloads
+    default = [f for f in formats if f.get('vcodec') != 'none' and f.get('ext') == 'mp4'][-1:]
+    if default and default[0].get('acodec') in (None, 'none'):
+        default += [f for f in audios if f.get('ext') == 'm4a'][-1:]
+    return selected, default
+
+def estimate_saved_bytes(selection, duration, downloaded):
+    """Estimate how many bytes DEFAULT_FORMAT would have added to a download.
+    
+    The selected and default formats are compared by their listed sizes, and
+    the ratio is applied to what was actually downloaded, so a range download
+    is compared with the same window of the default formats.
+    
+    Args:
+        selection: Result of select_formats()
+        duration: Video duration in seconds, for formats that only list a bitrate
+        downloaded: Bytes downloaded with the selected formats
+        
+    Returns:
+        int: Estimated bytes saved, 0 if unknown
+    """
+    if not selection:
+        return 0
+    selected, default = selection
+    sizes = [[format_size(f, duration) for f in formats] for formats in (selected, default)]
+    if not all(sizes[0] + sizes[1]) or not sizes[1]:
+        return 0
+    return max(0, int(downloaded * (sum(sizes[1]) / sum(sizes[0]) - 1)))
+
+def print_download_savings():
+    """Report the download bytes format selection saved this run."""
+    with media_lock:
+        downloaded, saved = download_totals["bytes"], download_totals["saved"]
+    if downloaded:
+        print(f"📉 Downloaded {downloaded / 1e6:.1f} MB, about {saved / 1e6:.1f} MB less "
+              f"than the best available formats would have been")
+
 def download_video(video_url, output_path, start_time=None, duration=None):
-    """Download a video and optionally extract a precise clip.
+    """Download a video, or only the window needed for a clip.
+    
+    When a clip is requested, only the window around it (plus KEYFRAME_MARGIN on
+    each side) is fetched. The window is stream-copied, so it starts at a
+    keyframe and the clip's offset inside it is measured, see range_offset().
+    Formats that can't be range-downloaded fall back to downloading the full
+    video. Nothing is re-encoded here; add_text_overlay cuts the clip out of
+    the downloaded file in its single render pass.
+    
+    The video's info dict from the metadata stage is reused, so the download
+    doesn't ask YouTube for the same metadata again.
     
     Args:
         video_url: YouTube URL to download
-        output_path: Path to save the output video
-        start_time: Start time for clip extraction (string HH:MM:SS or seconds)
+        output_path: Path to save the downloaded video
+        start_time: Start time of the clip (string HH:MM:SS or seconds)
         duration: Duration of clip in seconds
         
     Returns:
-        bool: True if successful, False otherwise
+        float: Position of start_time inside the downloaded file in seconds
+            (0 if no clip was requested), or None if the download failed
     """
-    # Temporary paths for processing
+    import yt_dlp
+    from tqdm import tqdm
+    
+    # Temporary path while downloading
     tmp_path = output_path.replace(".mp4", "_full.mp4")
-    tmp_clip_path = output_path.replace(".mp4", "_tmp.mp4")
+    
+    # Convert start_time to seconds if it's in HH:MM:SS format
+    start_seconds = None
+    if start_time is not None and duration is not None:
+        if isinstance(start_time, str) and ":" in start_time:
+            h, m, s = map(int, start_time.split(":"))
+            start_seconds = h * 3600 + m * 60 + s
+        else:
+            start_seconds = float(start_time)
     
     # Create progress bar for download
-    progress_bar = tqdm(total=100, desc="Downloading", unit="%", position=0, leave=True)
+    progress_bar = tqdm(total=100, desc=f"Downloading {os.path.basename(output_path)}", unit="%", leave=True)
 
     def progress_hook(d):
         """Update progress bar during download."""
+        if ffmpeg_jobs.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Run cancelled")
         if d['status'] == 'downloading' and 'downloaded_bytes' in d and 'total_bytes' in d:
             percentage = (d['downloaded_bytes'] / d['total_bytes']) * 100
             progress_bar.n = percentage
@@ -545,88 +1674,68 @@ def download_video(video_url, output_path, start_time=None, duration=None):
             progress_bar.close()
     
     ydl_opts = {
-        'format': 'bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/best',
+        'format': DEFAULT_FORMAT,
+        'merge_output_format': 'mp4',
         'outtmpl': tmp_path,
         'progress_hooks': [progress_hook]
     }
     
     try:
-        # Step 1: Download the video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
-        
-        # Step 2: Extract clip if needed
-        if start_time is not None and duration is not None and os.path.exists(tmp_path):
-            # Convert start_time to seconds if it's in HH:MM:SS format
-            if isinstance(start_time, str) and ":" in start_time:
-                h, m, s = map(int, start_time.split(":"))
-                start_seconds = h * 3600 + m * 60 + s
+        info = fetch_video_info(video_url)
+        
+        # Only fetch what the output profile can show, see select_formats()
+        selection = select_formats(info)
+        video_format = info
+        if selection:
+            selected, default = selection
+            video_format = selected[0]
+            ydl_opts['format'] = "+".join(f['format_id'] for f in selected)
+            print(f"🎞️ Using {video_format['height']}p {video_format.get('vcodec') or 'video'} "
+                  f"at {video_format.get('fps') or '?'} fps for {os.path.basename(output_path)}")
+        
+        # Download the clip window, or the whole video if that isn't possible
+        seek_seconds = start_seconds or 0
+        downloaded_range = False
+        if RANGE_DOWNLOADS and start_seconds is not None:
+            range_start = max(0, start_seconds - KEYFRAME_MARGIN)
+            range_end = start_seconds + duration + KEYFRAME_MARGIN
+            if info.get('duration'):
+                range_end = min(range_end, info['duration'])
+            offset = download_range(info, ydl_opts, range_start, range_end)
+            downloaded_range = offset is not None
+            if downloaded_range:
+                seek_seconds = offset + start_seconds - range_start
             else:
-                start_seconds = int(start_time)
-            
-            # Format time for ffmpeg
-            start_time_str = str(datetime.timedelta(seconds=start_seconds))
-            
-            print(f"✂️ Extracting {duration}s clip starting at {start_time_str}")
-            
-            try:
-                # Method 1: Direct extraction with selected codec
-                os.system(f'ffmpeg -i "{tmp_path}" -ss {start_time_str} -t {duration} -c:v {SELECTED_CODEC} -c:a aac -b:a 192k -r 30 -vsync cfr "{output_path}" -y -loglevel warning')
-                
-                # Check if successful
-                if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                    print(f"✅ Clip extracted successfully to {output_path}")
-                else:
-                    print("⚠️ Clip extraction failed with method 1, trying method 2...")
-                    # Method 2: Two-pass with segment extraction
-                    os.system(f'ffmpeg -i "{tmp_path}" -ss {start_time_str} -t {duration} -c copy "{tmp_clip_path}" -y -loglevel warning')
-                    if os.path.exists(tmp_clip_path) and os.path.getsize(tmp_clip_path) > 0:
-                        os.system(f'ffmpeg -i "{tmp_clip_path}" -c:v {SELECTED_CODEC} -c:a aac -b:a 192k -r 30 -vsync cfr "{output_path}" -y -loglevel warning')
-                        print(f"✅ Clip extracted successfully with method 2 to {output_path}")
-                    else:
-                        print("⚠️ Clip extraction failed with method 2, trying method 3...")
-                        # Method 3: Fallback to copy codec
-                        os.system(f'ffmpeg -i "{tmp_path}" -ss {start_time_str} -t {duration} -c copy "{output_path}" -y -loglevel warning')
-                        print(f"✅ Clip extracted with basic method to {output_path}")
-            
-            except Exception as e:
-                print(f"❌ Error during clip extraction: {e}")
-                # Use full video as fallback
-                if os.path.exists(tmp_path):
-                    import shutil
-                    shutil.copy(tmp_path, output_path)
-                    print("⚠️ Using full video as fallback due to extraction error")
-            
-            # Clean up temporary files
-            for file_path in [tmp_path, tmp_clip_path]:
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except Exception as e:
-                        print(f"⚠️ Could not remove temporary file {file_path}: {e}")
-        
-        elif not os.path.exists(tmp_path):
+                print("⚠️ Falling back to full video download...")
+        
+        if not downloaded_range:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.process_ie_result(copy.deepcopy(info), download=True)
+        
+        if not os.path.exists(tmp_path):
             print(f"❌ Download failed: {tmp_path} does not exist")
-            return False
+            return None
         
-        else:
-            # If no clip extraction needed, just rename the file
-            if os.path.exists(tmp_path):
-                os.rename(tmp_path, output_path)
-                
-        return os.path.exists(output_path)
+        os.replace(tmp_path, output_path)
+        downloaded = os.path.getsize(output_path)
+        saved = estimate_saved_bytes(selection, info.get('duration'), downloaded)
+        tracing.annotate(bytes=downloaded, saved_bytes=saved, range=downloaded_range)
+        tracing.count("download.bytes", downloaded)
+        tracing.count("download.saved_bytes", saved)
+        with media_lock:
+            download_totals["bytes"] += downloaded
+            download_totals["saved"] += saved
+        index_file(output_path, video_id=info.get('id'), width=video_format.get('width'),
+                   height=video_format.get('height'), fps=video_format.get('fps'))
+        
+        # The stream URLs in the info dict expire, so it's only kept until the download
+        with media_lock:
+            video_infos.pop(youtube_video_id(video_url) or info.get('id'), None)
+        return seek_seconds
     
     except Exception as e:
-        print(f"❌ Error during video processing: {e}")
-        # Try to salvage by renaming if possible
-        if os.path.exists(tmp_path) and not os.path.exists(output_path):
-            try:
-                os.rename(tmp_path, output_path)
-                return True
-            except Exception as rename_error:
-                print(f"❌ Could not rename temp file: {rename_error}")
-        
-        return False
+        print(f"❌ Error during video download: {e}")
+        return None
 
 def get_video_duration(video_path):
     """Get the duration of a video in seconds.
@@ -637,149 +1746,303 @@ def get_video_duration(video_path):
     Returns:
         float: Duration in seconds, or None if error
     """
+    return probe_file(video_path)["duration"]
+
+def resolve_encoder():
+    """Replace SELECTED_CODEC = "auto" with the encoder select_encoder() picks.
+    
+    Runs on first use, so code that imports this module and renders without
+    going through run_cli() never hands "auto" to ffmpeg.
+    
+    Returns:
+        tuple: (encoder, preset or None)
+    """
+    global SELECTED_CODEC, ENCODER_PRESET
+    with encoder_lock:
+        if SELECTED_CODEC == "auto":
+            SELECTED_CODEC, ENCODER_PRESET = select_encoder()
+    return SELECTED_CODEC, ENCODER_PRESET
+
+def encoder_args(default_preset=None):
+    """Get the ffmpeg output arguments for the selected video encoder.
+    
+    Args:
+        default_preset: Preset to use when the encoder has none configured
+        
+    Returns:
+        dict: Keyword arguments for ffmpeg.output()
+    """
+    resolve_encoder()
+    args = {"vcodec": SELECTED_CODEC, "threads": FFMPEG_THREADS}
+    preset = ENCODER_PRESET or default_preset
+    if preset:
+        args["preset"] = preset
+    return args
+
+def list_encoders():
+    """List the video encoders this ffmpeg build provides.
+    
+    Returns:
+        set: Encoder names
+    """
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+    return set(re.findall(r"^\s*V\S*\s+(\S+)", result.stdout, re.MULTILINE))
+
+def benchmark_encoder(codec, preset):
+    """Encode a synthetic test clip in the output profile and measure it.
+    
+    Args:
+        codec: ffmpeg encoder name
+        preset: Encoder preset, or None for the encoder default
+        
+    Returns:
+        tuple: (seconds taken, PSNR in dB, bitrate in bits/s), or None if the
+            encoder doesn't work on this machine
+    """
+    import ffmpeg
+    # Moving test pattern with fixed-seed noise, so every run encodes the same frames
+    source = (f"testsrc2=s={OUTPUT_WIDTH}x{OUTPUT_HEIGHT}:r={OUTPUT_FPS},"
+              f"noise=alls=3:allf=t:all_seed=1,format=yuv420p")
+    output_path = os.path.join(CACHE_DIR, "encoder_benchmark.mp4")
+    output_args = {"vcodec": codec, "pix_fmt": "yuv420p"}
+    if preset:
+        output_args["preset"] = preset
+    
     try:
-        probe = ffmpeg.probe(video_path)
-        duration = float(probe["format"]["duration"])
-        return duration
+        started = time.perf_counter()
+        ffmpeg.input(source, f="lavfi", t=BENCHMARK_SECONDS).output(
+            output_path, **output_args
+        ).overwrite_output().run(quiet=True)
+        elapsed = time.perf_counter() - started
+        
+        bitrate = os.path.getsize(output_path) * 8 / BENCHMARK_SECONDS
+        _, stderr = ffmpeg.filter(
+            [ffmpeg.input(output_path).video, ffmpeg.input(source, f="lavfi", t=BENCHMARK_SECONDS).video], "psnr"
+        ).output("-", f="null").run(quiet=True)
     except ffmpeg.Error:
         return None
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    
+    match = re.search(r"average:(inf|[\d.]+)", stderr.decode("utf-8", "replace"))
+    if not match:
+        return None
+    return elapsed, float(match.group(1)), bitrate
 
-def prepare_black_screen():
-    """Generate a black screen with title text and silent audio.
+def select_encoder():
+    """Pick the fastest available encoder and preset that meets the quality target.
+    
+    Every candidate in ENCODER_CANDIDATES that this ffmpeg build lists is
+    benchmarked on a synthetic clip. A candidate qualifies if it reaches
+    MIN_PSNR within MAX_BITRATE. The result is cached per machine and
+    output profile, so the benchmark only runs once.
     
     Returns:
-        str: Path to the black screen video file
+        tuple: (encoder, preset or None)
     """
-    BLACK_SCREEN_WITH_TEXT = os.path.join(VIDEO_OUTPUT_DIR, "black_screen_with_text.mp4")
-    BLACK_SCREEN_FINAL = os.path.join(VIDEO_OUTPUT_DIR, "black_screen_final.mp4")
+    version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n", 1)[0]
+    machine_key = (f"{platform.node()}|{platform.machine()}|{version}|"
+                   f"{OUTPUT_WIDTH}x{OUTPUT_HEIGHT}@{OUTPUT_FPS}|{MIN_PSNR}|{MAX_BITRATE}")
+    cached = cache_get("encoders.json", machine_key)
+    if cached:
+        return cached["encoder"], cached["preset"]
     
-    # Generate black screen with text overlay
-    MONTH_NAME = calendar.month_name[int(TARGET_MONTH)]
-    black_screen_text = f"{LASTFM_USER}'s Top {NUM_SONGS} songs of {MONTH_NAME} {TARGET_YEAR}"
+    available = list_encoders()
+    print("⏱️ Benchmarking video encoders (only needed once on this machine)...")
+    best = None
+    for codec, presets in ENCODER_CANDIDATES.items():
+        if codec not in available:
+            continue
+        for preset in presets:
+            result = benchmark_encoder(codec, preset)
+            if result is None:
+                print(f"   {codec}: not usable here")
+                break  # Other presets of an unusable encoder won't work either
+            elapsed, psnr, bitrate = result
+            meets_target = psnr >= MIN_PSNR and bitrate <= MAX_BITRATE
+            print(f"   {codec} {preset or 'default'}: {elapsed:.2f}s, {psnr:.1f} dB, "
+                  f"{bitrate / 1e6:.1f} Mbit/s{'' if meets_target else ' (below target)'}")
+            if meets_target and (best is None or elapsed < best[0]):
+                best = (elapsed, codec, preset)
     
-    if not os.path.exists(BLACK_SCREEN_WITH_TEXT):
-        print("✏️ Generating black screen with text...")
-        
-        # Determine font path for different operating systems
-        font_path = "/System/Library/Fonts/Supplemental/Arial Unicode.ttf"  # Mac path
+    encoder, preset = (best[1], best[2]) if best else FALLBACK_ENCODER
+    cache_set("encoders.json", machine_key, {"encoder": encoder, "preset": preset}, ttl=ENCODER_CACHE_TTL)
+    return encoder, preset
+
+def find_font_path():
+    """Determine font path for different operating systems.
+    
+    Returns:
+        str: Path to a Unicode-capable font, or None to let ffmpeg use its default
+    """
+    font_path = "/System/Library/Fonts/Supplemental/Arial Unicode.ttf"  # Mac path
+    if not os.path.exists(font_path):
+        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"  # Linux fallback
         if not os.path.exists(font_path):
-            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"  # Linux fallback
+            font_path = "C:\\Windows\\Fonts\\arialuni.ttf"  # Windows Unicode font
             if not os.path.exists(font_path):
-                font_path = "C:\\Windows\\Fonts\\arialuni.ttf"  # Windows Unicode font
+                font_path = "C:\\Windows\\Fonts\\arial.ttf"  # Windows regular Arial
                 if not os.path.exists(font_path):
-                    font_path = "C:\\Windows\\Fonts\\arial.ttf"  # Windows regular Arial
-                    if not os.path.exists(font_path):
-                        font_path = None  # Let ffmpeg use default font
+                    font_path = None  # Let ffmpeg use default font
+    return font_path
+
+def normalize_streams(source):
+    """Conform an ffmpeg input to the output profile.
+    
+    Scales and pads the video to OUTPUT_WIDTH x OUTPUT_HEIGHT at OUTPUT_FPS and
+    resamples the audio to OUTPUT_SAMPLE_RATE, so every clip can be joined
+    without another encode.
+    
+    Args:
+        source: ffmpeg-python input stream
         
-        try:
-            # Generate a 3-second black video with text
-            text_filter = {
-                "text": black_screen_text,
-                "fontsize": 50,
-                "fontcolor": "white",
-                "x": "(w-text_w)/2",
-                "y": "(h-text_h)/2"
-            }
-            
-            if font_path:
-                text_filter["fontfile"] = font_path
-                
-            # Create a black video source and add text
-            ffmpeg.input('color=c=black:s=1920x1080:r=30', f='lavfi', t=3).filter(
-                "drawtext", **text_filter
-            ).output(
-                BLACK_SCREEN_WITH_TEXT, 
-                vcodec=SELECTED_CODEC,
-                vsync="cfr",
-                r=30
-            ).run()
-        except ffmpeg.Error as e:
-            print(f"❌ Error creating black screen: {e}")
-            return None
+    Returns:
+        tuple: (video, audio) filtered streams
+    """
+    video = (
+        source.video
+        .filter('scale', OUTPUT_WIDTH, OUTPUT_HEIGHT, force_original_aspect_ratio='decrease')
+        .filter('pad', OUTPUT_WIDTH, OUTPUT_HEIGHT, '(ow-iw)/2', '(oh-ih)/2')
+        .filter('setsar', 1)
+        .filter('fps', fps=OUTPUT_FPS)
+    )
+    audio = source.audio.filter('aresample', OUTPUT_SAMPLE_RATE)
+    return video, audio
+
+def period_name(year, month=None):
+    """Name a compilation period, e.g. "May 2024", or "2024" for a whole year."""
+    return f"{calendar.month_name[int(month)]} {year}" if month else str(year)
+
+def compilation_title(user, num_songs, year, month, artist=None):
+    """Build the title shown on the black screen before the clips.
+    
+    Args:
+        user: Last.fm username, or several separated by commas
+        num_songs: Number of songs in the compilation
+        year: Target year
+        month: Target month (1-12), or None for the whole year
+        artist: Artist the compilation is limited to
+        
+    Returns:
+        str: Title text
+    """
+    songs = f"{artist} songs" if artist else "songs"
+    return f"{' & '.join(split_users(user))}'s Top {num_songs} {songs} of {period_name(year, month)}"
+
+def default_output(user, num_songs, year, month, artist=None):
+    """Build the default file name of a compilation.
+    
+    Returns:
+        str: e.g. "alice_top10_2024_05.mp4", or "alice+bob_top10_2024_Radiohead.mp4"
+    """
+    name = f"{'+'.join(split_users(user))}_top{num_songs}_{year}"
+    if month:
+        name += f"_{int(month):02d}"
+    if artist:
+        name += "_" + re.sub(r'[\\/:*?"<>|\s]+', "_", artist).strip("_")
+    return f"{name}.mp4"
+
+def prepare_black_screen(black_screen_text):
+    """Generate a black screen with title text and silent audio.
+    
+    Args:
+        black_screen_text: Title to show, from compilation_title()
+    
+    Returns:
+        str: Path to the black screen video file
+    """
+    import ffmpeg
+    # One card per title, so compilations built in the same run don't share one
+    title_id = hashlib.sha1(black_screen_text.encode("utf-8")).hexdigest()[:16]
+    BLACK_SCREEN_FINAL = os.path.join(VIDEO_OUTPUT_DIR, f"black_screen_{title_id}.mp4")
     
-    # Add silent audio track to ensure compatibility
     if not os.path.exists(BLACK_SCREEN_FINAL):
-        print("🔇 Adding silent audio track to black screen...")
+        print("✏️ Generating black screen with text...")
+        font_path = find_font_path()
+        
         try:
-            # Create two separate inputs
-            video = ffmpeg.input(BLACK_SCREEN_WITH_TEXT)
-            audio = ffmpeg.input('anullsrc=r=44100:cl=stereo', f='lavfi', t=3)
+            # Generate a 3-second black video with text
+            text_filter = {
+                "text": black_screen_text,
+                "fontsize": 50,
+                "fontcolor": "white",
+                "x": "(w-text_w)/2",
+                "y": "(h-text_h)/2"
+            }
+            
+            if font_path:
+                text_filter["fontfile"] = font_path
             
-            # Combine video and audio streams
-            ffmpeg.output(
+            # Create a black video source with text and a silent audio track
+            # in the same output profile as the clips
+            video = ffmpeg.input(
+                f'color=c=black:s={OUTPUT_WIDTH}x{OUTPUT_HEIGHT}:r={OUTPUT_FPS}', f='lavfi', t=3
+            ).filter("drawtext", **text_filter)
+            audio = ffmpeg.input(f'anullsrc=r={OUTPUT_SAMPLE_RATE}:cl=stereo', f='lavfi', t=3)
+            
+            ffmpeg_jobs.run(ffmpeg.output(
                 video,
                 audio,
                 BLACK_SCREEN_FINAL,
-                vcodec=SELECTED_CODEC,
+                **encoder_args(default_preset=SEGMENT_PRESET),
                 acodec="aac",
+                audio_bitrate="192k",
+                pix_fmt="yuv420p",
                 shortest=None
-            ).run()
-        except ffmpeg.Error as e:
-            print(f"❌ Error adding silent audio: {e}")
-            print(f"Detailed error: {str(e)}")
-            # Use version with text as fallback
-            if os.path.exists(BLACK_SCREEN_WITH_TEXT):
-                import shutil
-                shutil.copy(BLACK_SCREEN_WITH_TEXT, BLACK_SCREEN_FINAL)
-                print("⚠️ Using black screen without audio as fallback")
+            ).overwrite_output(), "title card", duration=3, timeout=FFMPEG_TIMEOUT)
+        except FFmpegJobError as e:
+            print(f"❌ Error creating black screen: {e}")
+            return None
     
     return BLACK_SCREEN_FINAL
     
-def add_text_overlay(input_clip, output_clip, text):
-    """Add text overlay to video clip with consistent sizing and positioning.
+def add_text_overlay(input_clip, output_clip, text, start_time=None, duration=None):
+    """Render a finished clip: cut, normalize to the output profile and caption it.
+    
+    Seeking, scaling/padding, audio resampling and the text overlay all run in a
+    single ffmpeg filter graph, so each clip is decoded and encoded exactly once.
     
     Args:
-        input_clip: Path to input video
+        input_clip: Path to the downloaded source video
         output_clip: Path to save output video
         text: Text to overlay
+        start_time: Where the clip starts inside input_clip, in seconds
+        duration: Duration of the clip in seconds
     """
-    # Get video dimensions using ffprobe
-    try:
-        probe = ffmpeg.probe(input_clip)
-        width = int(probe['streams'][0]['width'])
-        height = int(probe['streams'][0]['height'])
-        
-        # Base font size as percentage of video height
-        base_fontsize = int(height * 0.05)  # 5% of video height
-        
-        # Adjust font size based on text length to ensure it fits
-        # Calculate approximate character width (varies by font)
-        char_width_factor = 0.6  # Approximate width of a character relative to font size
-        
-        # Estimate width of text in pixels
-        estimated_text_width = len(text) * base_fontsize * char_width_factor
-        
-        # If estimated width is too large, scale down the font size
-        if estimated_text_width > width * 0.85:  # Allow text to use 85% of width
-            fontsize = int(base_fontsize * (width * 0.85) / estimated_text_width)
-        else:
-            fontsize = base_fontsize
-        
-        # Scale shadow size based on resolution
-        shadowx = max(2, int(width * 0.002))
-        shadowy = max(2, int(height * 0.002))
-        
-        # Calculate position from bottom as percentage of height
-        bottom_margin = int(height * 0.08)  # 8% from bottom
-        y_position = f"h-{bottom_margin}"
-    except Exception as e:
-        print(f"⚠️ Could not determine video dimensions: {e}")
-        # Fallback values
-        fontsize = 36
-        shadowx = 2
-        shadowy = 2
-        y_position = "h-100"
-    
-    # Determine font path for different operating systems
-    font_path = "/System/Library/Fonts/Supplemental/Arial Unicode.ttf"  # Mac path
-    if not os.path.exists(font_path):
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"  # Linux fallback
-        if not os.path.exists(font_path):
-            font_path = "C:\\Windows\\Fonts\\arialuni.ttf"  # Windows Unicode font
-            if not os.path.exists(font_path):
-                font_path = "C:\\Windows\\Fonts\\arial.ttf"  # Windows regular Arial
-                if not os.path.exists(font_path):
-                    font_path = None  # Let ffmpeg use default font
+    import ffmpeg
+    
+    # The output profile is fixed, so the caption can be sized without probing
+    width, height = OUTPUT_WIDTH, OUTPUT_HEIGHT
+    
+    # Base font size as percentage of video height
+    base_fontsize = int(height * 0.05)  # 5% of video height
+    
+    # Adjust font size based on text length to ensure it fits
+    # Calculate approximate character width (varies by font)
+    char_width_factor = 0.6  # Approximate width of a character relative to font size
+    
+    # Estimate width of text in pixels
+    estimated_text_width = len(text) * base_fontsize * char_width_factor
+    
+    # If estimated width is too large, scale down the font size
+    if estimated_text_width > width * 0.85:  # Allow text to use 85% of width
+        fontsize = int(base_fontsize * (width * 0.85) / estimated_text_width)
+    else:
+        fontsize = base_fontsize
+    
+    # Scale shadow size based on resolution
+    shadowx = max(2, int(width * 0.002))
+    shadowy = max(2, int(height * 0.002))
+    
+    # Calculate position from bottom as percentage of height
+    bottom_margin = int(height * 0.08)  # 8% from bottom
+    y_position = f"h-{bottom_margin}"
+    
+    font_path = find_font_path()
     
     # Text with enhanced shadow for better readability
     text_params = {
@@ -796,20 +2059,35 @@ def add_text_overlay(input_clip, output_clip, text):
     if font_path:
         text_params['fontfile'] = font_path
     
-    # Apply text filter with shadow
-    ffmpeg.input(input_clip).filter(
-        'drawtext', **text_params
-    ).output(
-        output_clip, 
-        vcodec=SELECTED_CODEC, 
-        acodec="aac", 
-        audio_bitrate="192k", 
-        map="0:a", 
-        preset="slow"
-    ).run()
-
-def update_video():
-    """Allow user to replace incorrect videos before final merge."""
+    # Seek on the input so only the clip window gets decoded
+    input_args = {}
+    if start_time is not None:
+        input_args['ss'] = start_time
+    if duration is not None:
+        input_args['t'] = duration
+    
+    video, audio = normalize_streams(ffmpeg.input(input_clip, **input_args))
+    video = video.filter('drawtext', **text_params)
+    
+    ffmpeg_jobs.run(ffmpeg.output(
+        video,
+        audio,
+        output_clip,
+        **encoder_args(default_preset=SEGMENT_PRESET),
+        acodec="aac",
+        audio_bitrate="192k",
+        ac=2,
+        pix_fmt="yuv420p"
+    ).overwrite_output(), f"Rendering {os.path.basename(output_clip)}", duration=duration, timeout=FFMPEG_TIMEOUT)
+
+def update_video(songs, video_clips, run=None):
+    """Allow user to replace incorrect videos before final merge.
+    
+    Args:
+        songs: List of (artist, title) tuples, most played first
+        video_clips: List of clip paths in compilation order, updated in place
+        run: Run ID whose manifest is updated with the replacements
+    """
     while True:
         replace = input("\n❓ Do you need to replace any videos? (yes/no): ").strip().lower()
         if replace != "yes":
@@ -821,16 +2099,17 @@ def update_video():
             print(f"  {i+1}. {artist} - {title}")
         
         try:
-            index = int(input("\nEnter the song number to replace (1-50): ")) - 1
-            if index < 0 or index >= len(video_clips):
+            index = int(input(f"\nEnter the song number to replace (1-{len(songs)}): ")) - 1
+            if index < 0 or index >= len(songs):
                 print("❌ Invalid song number. Try again.")
                 continue
 
             artist, title = songs[index]
-            print(f"🔄 Replacing: {artist} - {title}") 
-
-            # Rest of your replacement code...
-
+            rank = index + 1
+            position = clip_position(songs, video_clips, index, run)
+            if position is None:
+                print(f"❌ {artist} - {title} has no clip in the compilation to replace.")
+                continue
             print(f"🔄 Replacing: {artist} - {title}")
 
             # Ask for a new YouTube URL
@@ -840,43 +2119,41 @@ def update_video():
                 continue
 
             # Define file paths
-            clip_path = os.path.join(VIDEO_OUTPUT_DIR, f"clip_{index}.mp4")
-            final_clip_path = os.path.join(VIDEO_OUTPUT_DIR, f"final_{index}.mp4")
+            overlay_text = f"{rank}. {artist} - {title}"
+            source_path, final_clip_path = clip_paths(new_video_url, overlay_text)
 
             # Delete old files to prevent conflicts
-            for file in [clip_path, final_clip_path]:
+            for file in [source_path, final_clip_path]:
                 if os.path.exists(file):
                     os.remove(file)
 
             try:
-                # Get video metadata
-                with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                    info = ydl.extract_info(new_video_url, download=False)
-                    duration = info.get('duration')
-                    
-                    # Determine start time
-                    start_time_seconds = sum(int(x) * 60 ** i for i, x in enumerate(reversed(CHORUS_START.split(":"))))
-                    
-                    # Adjust if needed
-                    if duration and start_time_seconds + CLIP_DURATION > duration:
-                        print(f"⚠️ Video too short ({duration}s). Adjusting start time.")
-                        start_time_seconds = max(0, duration - CLIP_DURATION)
+                # Get video metadata and determine start time
+                start_time_seconds = find_clip_start(new_video_url)
                 
-                # Download and extract clip
-                download_video(new_video_url, clip_path, start_time=start_time_seconds, duration=CLIP_DURATION)
+                # Download the clip window
+                seek_seconds = download_video(new_video_url, source_path, start_time=start_time_seconds, duration=CLIP_DURATION)
+                if seek_seconds is None:
+                    print("❌ Download failed. Please try again.")
+                    continue
                 
-                # Add text overlay
-                add_text_overlay(clip_path, final_clip_path, f"{len(songs)-index}. {artist} - {title}")
+                # Cut, normalize and add text overlay in one pass
+                add_text_overlay(source_path, final_clip_path, overlay_text,
+                                 start_time=seek_seconds, duration=CLIP_DURATION)
+                if run is not None:
+                    save_checkpoint(run, artist, title, rank, url=new_video_url,
+                                    start=start_time_seconds,
+                                    source=artifact_record(source_path, seek=seek_seconds),
+                                    clip=artifact_record(final_clip_path))
 
                 # Update cached YouTube links
                 query = f"{artist} - {title}"
-                video_cache[query] = new_video_url
-                save_cache(video_cache, "video_cache.json")
-                progress[query] = new_video_url
-                save_cache(progress, "progress.json")
+                with cache_batch():
+                    save_resolution(artist, title, new_video_url, tier="manual", confidence=1.0, ttl=None)
+                    cache_set("progress.json", query, new_video_url)
 
                 # Replace the incorrect video in the final list
-                video_clips[index] = final_clip_path
+                video_clips[position] = final_clip_path
 
                 print(f"✅ Successfully replaced {artist} - {title}!")
                 
@@ -887,21 +2164,130 @@ def update_video():
         except ValueError:
             print("❌ Invalid input. Please enter a valid number.")
 
-def merge_videos(video_list, output_file):
+def clip_position(songs, video_clips, index, run=None):
+    """Find where a song's clip is in the compilation.
+    
+    The compilation counts down, so the most played song's clip comes last.
+    Skipped songs have no clip, so the song's checkpointed clip is looked up
+    first and the position is only derived from the rank when every song
+    made it in.
+    
+    Args:
+        songs: List of (artist, title) tuples, most played first
+        video_clips: List of clip paths in compilation order
+        index: Position of the song in songs
+        run: Run ID whose manifest records the song's clip
+        
+    Returns:
+        int: Position in video_clips, or None if the song has no clip
+    """
+    artist, title = songs[index]
+    clip = load_checkpoint(run, artist, title, index + 1).get("clip")
+    if clip and clip["path"] in video_clips:
+        return video_clips.index(clip["path"])
+    if len(video_clips) == len(songs):
+        return len(video_clips) - 1 - index
+    return None
+
+def stream_signature(probe):
+    """Get the codec parameters that must match for a stream-copy concat.
+    
+    Args:
+        probe: ffprobe result for the video file
+        
+    Returns:
+        dict: Video and audio stream parameters, or None if a stream is missing
+    """
+    video = next((st for st in probe["streams"] if st.get("codec_type") == "video"), None)
+    audio = next((st for st in probe["streams"] if st.get("codec_type") == "audio"), None)
+    if not video or not audio:
+        return None
+    
+    return {
+        "vcodec": video.get("codec_name"),
+        "profile": video.get("profile"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "pix_fmt": video.get("pix_fmt"),
+        "fps": video.get("r_frame_rate"),
+        "time_base": video.get("time_base"),
+        "acodec": audio.get("codec_name"),
+        "sample_rate": audio.get("sample_rate"),
+        "channels": audio.get("channels"),
+    }
+
+def conform_clip(input_clip, output_clip):
+    """Re-encode a clip to the output profile so it can be stream-copied.
+    
+    Args:
+        input_clip: Path to the clip that doesn't match the profile
+        output_clip: Path to save the conformed clip
+    """
+    import ffmpeg
+    video, audio = normalize_streams(ffmpeg.input(input_clip))
+    ffmpeg_jobs.run(ffmpeg.output(
+        video,
+        audio,
+        output_clip,
+        **encoder_args(default_preset=SEGMENT_PRESET),
+        acodec="aac",
+        audio_bitrate="192k",
+        ac=2,
+        pix_fmt="yuv420p"
+    ).overwrite_output(), f"Conforming {os.path.basename(input_clip)}", duration=get_video_duration(input_clip),
+        timeout=FFMPEG_TIMEOUT)
+
+def describe_segment(video_path, previous=None):
+    """Build the manifest entry for one segment of the compilation.
+    
+    Entries from the previous merge are reused as long as the file's size and
+    modification time haven't changed, so unchanged segments are never
+    re-encoded again. Durations and stream signatures come from the media
+    index, so a clip shared by several compilations is probed once.
+    
+    Args:
+        video_path: Path to the segment
+        previous: Manifest entry for the same path from the last merge, if any
+        
+    Returns:
+        dict: Segment entry with size, mtime, duration, signature and the
+            path that actually gets stitched
+    """
+    stat = os.stat(video_path)
+    if (previous and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime
+            and os.path.exists(previous.get("stitched", ""))):
+        return previous
+    
+    metadata = probe_file(video_path)
+    return {"path": video_path, "size": stat.st_size, "mtime": stat.st_mtime, "stitched": video_path,
+            "duration": metadata["duration"], "signature": metadata["signature"]}
+
+def merge_videos(video_list, output_file, title):
     """Merge all video clips into a single video file.
     
+    The compilation is tracked as an ordered manifest of segments (with their
+    start times in the stitched stream). Clips that share the
+    title card's codec parameters are joined with a stream copy, and only
+    clips that don't match are re-encoded first. After a replacement only the
+    swapped segment is looked at again, so a re-merge is just a remux.
+    
     Args:
         video_list: List of video files to merge
         output_file: Path to save the final merged video
+        title: Title shown on the black screen, from compilation_title()
     """
-    # Save cache before merging
-    save_cache(video_cache, "video_cache.json")
+    with tracing.span("merge", output=os.path.basename(output_file), segments=len(video_list) + 1):
+        stitch_videos(video_list, output_file, title)
+
+def stitch_videos(video_list, output_file, title):
+    """Merge the clips behind the title card, see merge_videos()."""
+    import ffmpeg
     
     # Prepare the black screen with text and audio
-    black_screen = prepare_black_screen()
+    black_screen = prepare_black_screen(title)
     
     # Verify the black screen exists
-    if not os.path.exists(black_screen):
+    if not black_screen or not os.path.exists(black_screen):
         print(f"❌ Fatal error: Black screen {black_screen} not found. Cannot merge videos.")
         return
     
@@ -911,93 +2297,1137 @@ def merge_videos(video_list, output_file):
         print(f"❌ Missing files: {missing_files}")
         return
     
+    # Load the manifest from the previous merge of this compilation
+    manifest_key = os.path.abspath(output_file)
+    previous = {
+        segment["path"]: segment
+        for segment in (cache_get("compilation_manifest.json", manifest_key) or {}).get("segments", [])
+    }
+    
+    # Every segment must match the title card for a stream copy
+    card = describe_segment(black_screen, previous.get(black_screen))
+    reference = card["signature"]
+    segments = [card]
+    reused = 0
+    for video in video_list:
+        segment = describe_segment(video, previous.get(video))
+        if segment is previous.get(video):
+            reused += 1
+        if reference and segment["signature"] != reference:
+            conformed = video.replace(".mp4", "_conformed.mp4")
+            print(f"🔧 Re-encoding {video} to match the output profile...")
+            try:
+                conform_clip(video, conformed)
+                segment["stitched"] = conformed
+                segment["signature"] = reference
+            except FFmpegJobError as e:
+                print(f"⚠️ Could not conform {video}: {e}")
+                reference = None  # Fall back to re-encoding the whole merge
+        segments.append(segment)
+    
+    tracing.annotate(reused=reused)
+    if reused:
+        print(f"♻️ Reusing {reused} unchanged segments from the previous merge")
+    
+    # Record when each segment starts in the stitched stream
+    start = 0.0
+    for segment in segments:
+        segment["start"] = start
+        segment.pop("offset", None)  # Written by earlier versions, it was never a position in the output
+        start += segment["duration"] or 0
+    
     # Create a text file for FFmpeg concat
     FILE_LIST_PATH = os.path.abspath(os.path.join(CACHE_DIR, "file_list.txt"))
     os.makedirs(CACHE_DIR, exist_ok=True)
     
     with open(FILE_LIST_PATH, "w") as f:
-        # Add the black screen first
-        f.write(f"file '{os.path.abspath(black_screen)}'\n")
-        # Add all the video clips
-        for video in video_list:
-            f.write(f"file '{os.path.abspath(video)}'\n")
+        # The black screen is the first segment, followed by all the clips
+        for segment in segments:
+            f.write(f"file '{os.path.abspath(segment['stitched'])}'\n")
     
     print("✅ All files found, proceeding with FFmpeg merge...")
     
+    merged = False
+    
+    # Fast path: all segments share codec parameters, so just remux them
+    if reference:
+        try:
+            ffmpeg_jobs.run(ffmpeg.input(FILE_LIST_PATH, format="concat", safe=0).output(
+                os.path.abspath(output_file),
+                c="copy",
+                movflags="+faststart",
+                format="mp4"
+            ).overwrite_output(), "Merging (stream copy)", duration=start, heavy=False)
+            merged = True
+            tracing.annotate(mode="stream copy")
+        except FFmpegJobError as e:
+            print(f"⚠️ Stream copy merge failed, re-encoding instead: {e}")
+    
     # Merge using FFmpeg
-    try:
-        ffmpeg.input(FILE_LIST_PATH, format="concat", safe=0).output(
-            os.path.abspath(output_file),
-            vcodec=SELECTED_CODEC,
-            acodec="aac",
-            audio_bitrate="192k",
-            r=30,
-            format="mp4"
-        ).run()
+    if not merged:
+        try:
+            # A full re-encode scales with the compilation's length, so it gets no timeout
+            ffmpeg_jobs.run(ffmpeg.input(FILE_LIST_PATH, format="concat", safe=0).output(
+                os.path.abspath(output_file),
+                **encoder_args(),
+                acodec="aac",
+                audio_bitrate="192k",
+                r=OUTPUT_FPS,
+                format="mp4"
+            ).overwrite_output(), "Merging (re-encode)", duration=start)
+            merged = True
+            tracing.annotate(mode="re-encode")
+        except FFmpegJobError as e:
+            print(f"❌ Error during merge: {e}")
+    
+    if merged:
         print("🎬 Merging Complete! Final video saved at:", output_file)
-    except ffmpeg.Error as e:
-        print(f"❌ Error during merge: {e}")
+        cache_set("compilation_manifest.json", manifest_key, {"segments": segments, "duration": start})
 
-if __name__ == "__main__":
-    os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
-    songs = get_top_songs()  # Fetches from cache OR API
-    video_clips = []
+def youtube_video_id(video_url):
+    """Get the video ID from a YouTube watch URL.
+    
+    Args:
+        video_url: YouTube URL
+        
+    Returns:
+        str: Video ID, or None if the URL has none
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(video_url).query)
+    return query.get("v", [None])[0]
+
+def fetch_video_info(video_url):
+    """Get the metadata of a YouTube video without downloading it.
+    
+    The info dict is fetched once and kept in memory until the video is
+    downloaded, so the metadata and download stages share one request.
+    
+    Args:
+        video_url: YouTube URL
+        
+    Returns:
+        dict: yt-dlp info dict
+    """
+    import yt_dlp
+    video_id = youtube_video_id(video_url)
+    with media_lock:
+        info = video_infos.get(video_id)
+    if info is not None:
+        return info
+    
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        info = ydl.extract_info(video_url, download=False)
+    
+    video_id = video_id or info.get('id')
+    with media_lock:
+        video_infos[video_id] = info
+    cache_set("media_index.json", f"video:{video_id}", {"duration": info.get('duration')}, ttl=MEDIA_INDEX_TTL)
+    return info
+
+def index_file(path, **metadata):
+    """Record what is known about a local media file in the media index.
+    
+    Entries are keyed by the absolute path and only trusted while the file's
+    size and modification time are unchanged.
+    
+    Args:
+        path: Path to the file
+        **metadata: Values to store, merged into any existing entry
+    """
+    stat = os.stat(path)
+    key = f"file:{os.path.abspath(path)}"
+    entry = file_metadata(path) or {}
+    entry.update(metadata, size=stat.st_size, mtime=stat.st_mtime)
+    cache_set("media_index.json", key, entry, ttl=MEDIA_INDEX_TTL)
+
+def file_metadata(path):
+    """Get the media index entry of a local file.
+    
+    Args:
+        path: Path to the file
+        
+    Returns:
+        dict: Indexed metadata, or None if the file isn't indexed or changed since
+    """
+    entry = cache_get("media_index.json", f"file:{os.path.abspath(path)}")
+    if not entry:
+        return None
+    stat = os.stat(path)
+    if entry.get("size") != stat.st_size or entry.get("mtime") != stat.st_mtime:
+        return None
+    return entry
+
+def probe_file(path):
+    """Get the duration and stream signature of a local file.
+    
+    The file is only probed if the media index doesn't know them yet.
+    
+    Args:
+        path: Path to the file
+        
+    Returns:
+        dict: Metadata with "duration" and "signature" (None if unreadable)
+    """
+    import ffmpeg
+    entry = file_metadata(path)
+    if entry and "signature" in entry:
+        return entry
+    
+    try:
+        probe = ffmpeg.probe(path)
+        duration, signature = float(probe["format"]["duration"]), stream_signature(probe)
+    except (ffmpeg.Error, KeyError, ValueError):
+        return {"duration": None, "signature": None}
+    
+    index_file(path, duration=duration, signature=signature)
+    return file_metadata(path)
+
+def smallest_audio_format(info):
+    """Get the lowest-bitrate audio-only format with a direct URL.
+    
+    Args:
+        info: yt-dlp info dict
+        
+    Returns:
+        dict: yt-dlp format with the stream URL and the HTTP headers it must
+            be requested with, or None if there is no plain HTTP audio format
+    """
+    formats = [
+        f for f in info.get('formats') or []
+        if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+        and f.get('url') and f.get('protocol') in ('http', 'https')
+    ]
+    if not formats:
+        return None
+    return min(formats, key=lambda f: f.get('abr') or f.get('tbr') or float('inf'))
+
+def detect_chorus(info):
+    """Find where the chorus of a video starts, cached per video ID.
+    
+    The audio is decoded at a low sample rate straight from the cheapest
+    audio stream, so this costs a small fraction of the track's length.
+    
+    Args:
+        info: yt-dlp info dict
+        
+    Returns:
+        float: Chorus start in seconds, or None if it couldn't be detected
+    """
+    video_id = info.get('id')
+    cached = cache_get("chorus.json", video_id) if video_id else None
+    if cached is not None:
+        return cached["start"]
+    
+    with tracing.span("chorus", video_id=video_id) as span:
+        span["start"] = analyze_chorus(info)
+    return span["start"]
+
+def analyze_chorus(info):
+    """Decode a video's audio and find its chorus, see detect_chorus().
+    
+    Args:
+        info: yt-dlp info dict
+        
+    Returns:
+        float: Chorus start in seconds, or None if it couldn't be detected
+    """
+    audio = smallest_audio_format(info)
+    try:
+        # Without the format's headers (User-Agent, Referer...) YouTube often refuses the stream
+        samples = chorus.decode_audio(audio['url'], headers=audio.get('http_headers')) if audio else None
+    except ImportError:
+        return None  # numpy is optional - fall back to CHORUS_START
+    if samples is None:
+        return None  # Not cached - the stream may work next time
+    
+    start = chorus.find_chorus(samples, CLIP_DURATION)
+    if info.get('id'):
+        cache_set("chorus.json", info['id'], {"start": start})
+    return start
+
+def find_clip_start(video_url):
+    """Pick the clip start time for a YouTube video.
+    
+    Args:
+        video_url: YouTube URL
+        
+    Returns:
+        float: Start time in seconds
+    """
+    # On a rerun, both the duration and the chorus are usually in the index already
+    video_id = youtube_video_id(video_url)
+    summary = cache_get("media_index.json", f"video:{video_id}") if video_id else None
+    chorus_start = cache_get("chorus.json", video_id) if video_id and CHORUS_DETECTION else None
+    if summary and (chorus_start or not CHORUS_DETECTION):
+        tracing.annotate(source="media index")
+        return clip_start_seconds(summary["duration"], chorus_start and chorus_start["start"])
+    
+    info = fetch_video_info(video_url)
+    chorus_start = detect_chorus(info) if CHORUS_DETECTION else None
+    return clip_start_seconds(info.get('duration'), chorus_start)
+
+def clip_start_seconds(duration, chorus_start=None):
+    """Pick the clip start time for a video, keeping the clip inside the video.
+    
+    Args:
+        duration: Video duration in seconds, or None if unknown
+        chorus_start: Detected chorus start in seconds, CHORUS_START is used if None
+        
+    Returns:
+        float: Start time in seconds
+    """
+    if chorus_start is not None:
+        start_time_seconds = chorus_start
+    else:
+        # Convert CHORUS_START to seconds
+        start_time_seconds = sum(int(x) * 60 ** i for i, x in enumerate(reversed(CHORUS_START.split(":"))))
+    
+    # Adjust start time if video is too short
+    if duration and start_time_seconds + CLIP_DURATION > duration:
+        print(f"⚠️ Video too short ({duration}s). Adjusting start time.")
+        start_time_seconds = max(0, duration - CLIP_DURATION)
+    
+    return start_time_seconds
+
+def create_stage_pools():
+    """Create one bounded worker pool per pipeline stage.
+    
+    Returns:
+        dict: Stage name -> ThreadPoolExecutor
+    """
+    return {
+        "search": ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search"),
+        "metadata": ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix="metadata"),
+        "download": ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download"),
+        "encode": ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode"),
+    }
+
+def run_stage(pools, stage, fn, *args):
+    """Run a function on a stage's pool and wait for the result.
+    
+    The pool size caps how many songs can be in that stage at once, so songs
+    queue up at a busy stage while the other stages keep working.
+    """
+    return pools[stage].submit(fn, *args).result()
+
+def run_shared_stage(pools, shared, stage, key, fn, *args):
+    """Like run_stage(), but identical work is only done once.
+    
+    The first caller for a (stage, key) pair submits the work, later callers
+    wait on the same future. With a batch of compilations this means a song
+    that appears in several top lists is resolved, downloaded and cut once.
+    
+    Args:
+        pools: Stage pools from create_stage_pools()
+        shared: Dict of (stage, key) -> Future, shared by every job of a run
+        stage: Stage name
+        key: Identifies the work within the stage
+        fn: Function to run
+        
+    Returns:
+        The function's result
+    """
+    with shared_work_lock:
+        future = shared.get((stage, key))
+        if future is None:
+            future = pools[stage].submit(traced_stage, stage, key, fn, *args)
+            shared[(stage, key)] = future
+        else:
+            tracing.count(f"shared.{stage}.reused")
+    return future.result()
+
+def traced_stage(stage, key, fn, *args):
+    """Run a stage function inside a trace span named after the stage."""
+    with tracing.span(stage, key=str(key)):
+        return fn(*args)
+
+def clip_paths(video_url, overlay_text):
+    """Get the file paths for a video's downloaded source and rendered clip.
+    
+    Names are derived from the URL (and the overlay for the clip), so the
+    same video always maps to the same files, whichever job needs it.
+    
+    Args:
+        video_url: YouTube URL
+        overlay_text: Text burned into the clip
+        
+    Returns:
+        tuple: (source path, clip path)
+    """
+    source_id = hashlib.sha1(video_url.encode("utf-8")).hexdigest()[:16]
+    clip_id = hashlib.sha1(f"{video_url}\n{overlay_text}".encode("utf-8")).hexdigest()[:16]
+    return (os.path.join(VIDEO_OUTPUT_DIR, f"source_{source_id}.mp4"),
+            os.path.join(VIDEO_OUTPUT_DIR, f"final_{clip_id}.mp4"))
+
+def song_key(artist, title, rank):
+    """Identify a song at its chart position, e.g. in run manifests and queue tasks."""
+    return f"{rank}\t{resolution_key(artist, title)}"
+
+def run_id(user, year, month, num_songs, output, artist=None):
+    """Identify a run by its parameters, so a re-run finds its manifest.
+    
+    Everything that changes the song list or how clips are rendered is part
+    of the identity, so runs that differ in any of it never share clips.
+    
+    Returns:
+        str: Run ID
+    """
+    codec, preset = resolve_encoder()
+    render = [codec, preset or SEGMENT_PRESET, OUTPUT_WIDTH, OUTPUT_HEIGHT, OUTPUT_FPS,
+              OUTPUT_SAMPLE_RATE, CLIP_DURATION, CHORUS_DETECTION, CHORUS_START]
+    params = json.dumps([user, int(year), month and int(month), int(num_songs), os.path.abspath(output),
+                         artist and artist.casefold(), render])
+    return hashlib.sha1(params.encode("utf-8")).hexdigest()[:16]
+
+def file_checksum(path):
+    """Get the SHA-256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def artifact_record(path, **details):
+    """Describe a finished file for the run manifest, see artifact_intact()."""
+    return {"path": path, "size": os.path.getsize(path), "sha256": file_checksum(path), **details}
+
+def artifact_intact(record):
+    """Check that a file recorded in the run manifest still has its recorded contents.
+    
+    Args:
+        record: Record from artifact_record(), or None
+        
+    Returns:
+        bool: True if the file exists with the same size and checksum
+    """
+    if not record or not os.path.exists(record["path"]):
+        return False
+    return os.path.getsize(record["path"]) == record["size"] and file_checksum(record["path"]) == record["sha256"]
 
-    print(f"\n🎵 Processing your top {NUM_SONGS} songs for {calendar.month_name[int(TARGET_MONTH)]} {TARGET_YEAR}...")
+def load_checkpoint(run, artist, title, rank):
+    """Get the stages a song has completed in an earlier attempt at the same run.
     
-    for i, song_data in enumerate(reversed(songs)):
-        artist, title = song_data
-        print(f"\n🎵 Processing {i+1}/{NUM_SONGS}: {artist} - {title}")
-        query = f"{artist} {title}"
-        video_url = search_youtube_video(artist, title)
+    Args:
+        run: Run ID from run_id(), or None to not track the run
+        artist: Artist name
+        title: Song title
+        rank: Chart position
+        
+    Returns:
+        dict: Completed stages: "url", "start", "source" and "clip" records
+    """
+    if run is None:
+        return {}
+    manifest = cache_get("run_manifest.json", run) or {}
+    return manifest.get("songs", {}).get(song_key(artist, title, rank), {})
+
+def save_checkpoint(run, artist, title, rank, **stages):
+    """Record completed stages of a song in the run manifest, see load_checkpoint()."""
+    if run is None:
+        return
+    with manifest_lock:
+        manifest = cache_get("run_manifest.json", run) or {"songs": {}}
+        manifest["songs"].setdefault(song_key(artist, title, rank), {}).update(stages)
+        cache_set("run_manifest.json", run, manifest)
+
+def process_song(pools, shared, index, total, artist, title, rank, run=None):
+    """Take one song through search, metadata, download and encode.
+    
+    Args:
+        pools: Stage pools from create_stage_pools()
+        shared: Memoized stage results, see run_shared_stage()
+        index: Position of the song in the compilation
+        total: Number of songs in the compilation
+        artist: Artist name
+        title: Song title
+        rank: Chart position shown in the overlay
+        run: Run ID whose manifest records the song's progress, see run_id()
+        
+    Returns:
+        str: Path to the finished clip, or None if the song was skipped
+    """
+    print(f"\n🎵 Processing {index+1}/{total}: {artist} - {title}")
+    with tracing.span("song", "song", song=f"{artist} - {title}", rank=rank) as span:
+        clip = render_song(pools, shared, artist, title, rank, run)
+        span["finished"] = clip is not None
+    return clip
+
+def render_song(pools, shared, artist, title, rank, run=None):
+    """Run the stages of one song, see process_song().
+    
+    Every finished stage is checkpointed in the run manifest. When the same
+    run is started again (after a crash, say), stages whose results are
+    recorded - and whose files are still intact - are skipped.
+    
+    Returns:
+        str: Path to the finished clip, or None if the song was skipped
+    """
+    checkpoint = load_checkpoint(run, artist, title, rank)
+    if artifact_intact(checkpoint.get("clip")):
+        print(f"⏩ Resuming: {artist} - {title} was already rendered")
+        tracing.count("resume.clip")
+        return checkpoint["clip"]["path"]
+    
+    try:
+        video_url = checkpoint.get("url") or run_shared_stage(pools, shared, "search", resolution_key(artist, title),
+                                                              search_youtube_video, artist, title)
         if not video_url:
-            continue
+            return None
+        if "url" not in checkpoint:
+            save_checkpoint(run, artist, title, rank, url=video_url)
+        
+        # Define file paths - the downloaded source and the rendered clip
+        overlay_text = f"{rank}. {artist} - {title}"
+        source_path, final_clip_path = clip_paths(video_url, overlay_text)
+        
+        # Get video metadata first to determine optimal start time
+        start_time_seconds = checkpoint.get("start")
+        if start_time_seconds is None:
+            start_time_seconds = run_shared_stage(pools, shared, "metadata", video_url, find_clip_start, video_url)
+            save_checkpoint(run, artist, title, rank, start=start_time_seconds)
+        
+        # Download only the segment we need directly
+        source = checkpoint.get("source")
+        if source and source["path"] == source_path and artifact_intact(source):
+            print(f"⏩ Resuming: reusing the downloaded source of {artist} - {title}")
+            tracing.count("resume.source")
+            seek_seconds = source["seek"]
+        else:
+            seek_seconds = run_shared_stage(pools, shared, "download", source_path, download_video,
+                                            video_url, source_path, start_time_seconds, CLIP_DURATION)
+            if seek_seconds is None:
+                print(f"❌ Download failed for {artist} - {title}")
+                return None
+            if run is not None:
+                save_checkpoint(run, artist, title, rank, source=artifact_record(source_path, seek=seek_seconds))
         
-        # Define file paths - we now only need two files per song
-        clip_path = os.path.join(VIDEO_OUTPUT_DIR, f"clip_{i}.mp4")
-        final_clip_path = os.path.join(VIDEO_OUTPUT_DIR, f"final_{i}.mp4")
+        # Cut, normalize and add text overlay in a single encode
+        run_shared_stage(pools, shared, "encode", final_clip_path, add_text_overlay,
+                         source_path, final_clip_path, overlay_text, seek_seconds, CLIP_DURATION)
+        if run is not None:
+            save_checkpoint(run, artist, title, rank, clip=artifact_record(final_clip_path))
+        return final_clip_path
+    
+    except Exception as e:
+        print(f"❌ Error processing {artist} - {title}: {e}")
+        return None
+
+def process_songs(songs, pools=None, shared=None, run=None):
+    """Process all songs through the staged pipeline concurrently.
+    
+    Every song gets its own lightweight driver thread that hands it from
+    stage to stage, so a 50-song run takes roughly as long as its slowest
+    stage instead of the sum of all stages.
+    
+    Args:
+        songs: List of (artist, title) tuples, most played first
+        pools: Stage pools to use, a private set is created if None
+        shared: Memoized stage results to share with other jobs
+        run: Run ID to checkpoint progress under, so a re-run resumes (see run_id())
         
+    Returns:
+        list: Paths of the finished clips in compilation order
+    """
+    os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+    own_pools = pools is None
+    if own_pools:
+        pools = create_stage_pools()
+    if shared is None:
+        shared = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(songs)), thread_name_prefix="song") as drivers:
+            futures = [
+                drivers.submit(process_song, pools, shared, i, len(songs), artist, title, len(songs) - i, run)
+                for i, (artist, title) in enumerate(reversed(songs))
+            ]
+            # Collect in submission order so clips stay in rank order
+            try:
+                results = [future.result() for future in futures]
+            except KeyboardInterrupt:
+                # Stop running ffmpeg jobs so the workers can wind down
+                ffmpeg_jobs.cancel_all()
+                raise
+    finally:
+        if own_pools:
+            for pool in pools.values():
+                pool.shutdown(cancel_futures=ffmpeg_jobs.cancel_event.is_set())
+    
+    return [clip for clip in results if clip]
+
+def load_jobs(job_file):
+    """Load a batch job file.
+    
+    The file is a JSON list of jobs, for example
+    [{"user": "alice", "year": 2024, "month": 5, "num_songs": 10}].
+    Leaving out "month" compiles the whole year, "artist" limits the
+    compilation to one artist, and "user" may be a list of users whose
+    plays are added up. A job may also set "output" to choose the final
+    video path.
+    
+    Args:
+        job_file: Path to the job file
+        
+    Returns:
+        list: Validated job dicts
+    """
+    with open(job_file, "r") as f:
+        entries = json.load(f)
+    
+    jobs = []
+    for number, entry in enumerate(entries, 1):
         try:
-            # Get video metadata first to determine optimal start time
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = ydl.extract_info(video_url, download=False)
-                duration = info.get('duration')
-                
-                # Convert CHORUS_START to seconds
-                start_time_seconds = sum(int(x) * 60 ** i for i, x in enumerate(reversed(CHORUS_START.split(":"))))
-                
-                # Adjust start time if video is too short
-                if duration and start_time_seconds + CLIP_DURATION > duration:
-                    print(f"⚠️ Video too short ({duration}s). Adjusting start time.")
-                    start_time_seconds = max(0, duration - CLIP_DURATION)
-            
-            # Download only the segment we need directly
-            download_video(video_url, clip_path, start_time=start_time_seconds, duration=CLIP_DURATION)
-            
-            # Add text overlay
-            add_text_overlay(clip_path, final_clip_path, f"{len(songs)-i}. {artist} - {title}")
-            video_clips.append(final_clip_path)
-            
+            users = entry["user"] if isinstance(entry["user"], list) else [entry["user"]]
+            job = {
+                "user": ",".join(split_users(",".join(map(str, users)))),
+                "year": int(entry["year"]),
+                "month": int(entry["month"]) if entry.get("month") is not None else None,
+                "num_songs": int(entry.get("num_songs", 10)),
+                "artist": str(entry.get("artist") or "").strip() or None,
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"❌ Job {number} in {job_file} is invalid: {e}")
+            sys.exit(1)
+        
+        if not job["user"] or not 1 <= (job["month"] or 1) <= 12 or not 1 <= job["num_songs"] <= 50:
+            print(f"❌ Job {number} in {job_file} needs a user, a month between 1 and 12 (or none) and 1-50 songs.")
+            sys.exit(1)
+        
+        job["output"] = entry.get("output") or default_output(
+            job["user"], job["num_songs"], job["year"], job["month"], job["artist"]
+        )
+        jobs.append(job)
+    return jobs
+
+def run_job(pools, shared, job):
+    """Build one compilation of a batch.
+    
+    Args:
+        pools: Stage pools shared by the whole batch
+        shared: Memoized stage results shared by the whole batch
+        job: Job dict from load_jobs()
+        
+    Returns:
+        str: Path of the final video, or None if nothing could be compiled
+    """
+    label = f"{job['user']} {period_name(job['year'], job['month'])}"
+    try:
+        songs = get_top_songs(job["user"], job["year"], job["month"], job["num_songs"], job["artist"])
+        run = run_id(job["user"], job["year"], job["month"], job["num_songs"], job["output"], job["artist"])
+        video_clips = process_songs(songs, pools, shared, run)
+        if not video_clips:
+            print(f"❌ [{label}] No videos were successfully processed.")
+            return None
+        
+        title = compilation_title(job["user"], job["num_songs"], job["year"], job["month"], job["artist"])
+        with merge_lock:
+            merge_videos(video_clips, job["output"], title)
+        return job["output"] if os.path.exists(job["output"]) else None
+    
+    except Exception as e:
+        print(f"❌ [{label}] Job failed: {e}")
+        return None
+
+def run_batch(jobs):
+    """Build every compilation of a batch on one shared set of stage pools.
+    
+    Args:
+        jobs: Job dicts from load_jobs()
+        
+    Returns:
+        list: (job, final video path or None) pairs in job order
+    """
+    os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+    pools = create_stage_pools()
+    shared = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(jobs)), thread_name_prefix="job") as drivers:
+            futures = [drivers.submit(run_job, pools, shared, job) for job in jobs]
+            try:
+                results = [(job, future.result()) for job, future in zip(jobs, futures)]
+            except KeyboardInterrupt:
+                ffmpeg_jobs.cancel_all()
+                raise
+    finally:
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=ffmpeg_jobs.cancel_event.is_set())
+    
+    stage_counts = Counter(stage for stage, _ in shared)
+    print(f"\n📦 Batch finished: {sum(1 for _, output in results if output)}/{len(jobs)} compilations "
+          f"from {stage_counts['search']} searches, {stage_counts['download']} downloads "
+          f"and {stage_counts['encode']} renders")
+    return results
+
+def song_tasks(songs):
+    """Turn a top list into queue tasks in compilation order (lowest rank first).
+    
+    Args:
+        songs: List of (artist, title) tuples, most played first
+        
+    Returns:
+        list: (key, payload) pairs for WorkQueue.add_compilation()
+    """
+    return [
+        (song_key(artist, title, len(songs) - i), {"artist": artist, "title": title, "rank": len(songs) - i})
+        for i, (artist, title) in enumerate(reversed(songs))
+    ]
+
+def publish_artifact(clip, artifact_dir):
+    """Copy a finished clip into the shared artifact directory.
+    
+    The copy is written under a temporary name and renamed into place, so
+    the coordinator never sees a partial file.
+    
+    Args:
+        clip: Path of the rendered clip
+        artifact_dir: Shared artifact directory
+        
+    Returns:
+        str: File name of the clip within the artifact directory
+    """
+    import shutil
+    name = os.path.basename(clip)
+    destination = os.path.join(artifact_dir, name)
+    if not os.path.exists(destination):
+        partial = f"{destination}.{platform.node()}.{os.getpid()}.part"
+        shutil.copyfile(clip, partial)
+        os.replace(partial, destination)
+    return name
+
+def run_task(queue, worker, pools, shared, task, artifact_dir, untrack):
+    """Render the song of one queue task and report the result.
+    
+    Args:
+        queue: WorkQueue the task was claimed from
+        worker: Name of this worker
+        pools: Stage pools of this worker
+        shared: Memoized stage results of this worker
+        task: Task from WorkQueue.claim()
+        artifact_dir: Shared artifact directory
+        untrack: Called with the task ID before the result is reported, so its lease stops being renewed
+    """
+    song = task["payload"]
+    artist, title = song["artist"], song["title"]
+    print(f"\n🎵 Task {task['id']} (attempt {task['attempts']}): {artist} - {title}")
+    try:
+        with tracing.span("song", "song", song=f"{artist} - {title}", rank=song["rank"]) as span:
+            clip = render_song(pools, shared, artist, title, song["rank"])
+            span["finished"] = clip is not None
+        if ffmpeg_jobs.cancel_event.is_set():
+            # The worker is stopping, so the render may have been cut short
+            untrack(task["id"])
+            queue.release(task["id"], worker)
+            return
+        artifact = publish_artifact(clip, artifact_dir) if clip else None
+    except Exception as e:
+        print(f"❌ Task {task['id']} failed: {e}")
+        untrack(task["id"])
+        queue.fail(task["id"], worker, e)
+        return
+    
+    untrack(task["id"])
+    if not queue.complete(task["id"], worker, artifact):
+        print(f"⚠️ Lost the lease on task {task['id']}, another worker is redoing it")
+
+def renew_leases(queue, worker, running, running_lock, stop):
+    """Keep renewing the leases of a worker's running tasks until stop is set."""
+    while not stop.wait(work_queue.LEASE_SECONDS / 3):
+        with running_lock:
+            task_ids = list(running)
+        for task_id in task_ids:
+            if not queue.renew(task_id, worker):
+                with running_lock:
+                    finished = task_id not in running  # Reported while this renewal was under way
+                if not finished:
+                    print(f"⚠️ Lease on task {task_id} expired before it could be renewed")
+
+def run_worker(queue_path, artifact_dir, exit_when_idle=False):
+    """Work on songs from a shared queue until interrupted.
+    
+    Up to WORKER_TASKS songs are taken through the stage pools at once.
+    Sources and clips are made in a scratch directory private to this
+    process, and only finished clips are copied to the artifact directory.
+    Tasks still running when the worker is interrupted go back on the queue.
+    
+    Args:
+        queue_path: Path of the queue database
+        artifact_dir: Shared artifact directory
+        exit_when_idle: Stop once the queue has no waiting or running tasks
+    """
+    global VIDEO_OUTPUT_DIR
+    import shutil
+    queue = work_queue.WorkQueue(queue_path)
+    worker = f"{platform.node()}:{os.getpid()}"
+    VIDEO_OUTPUT_DIR = os.path.join(VIDEO_OUTPUT_DIR, f"worker_{os.getpid()}")
+    os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+    os.makedirs(artifact_dir, exist_ok=True)
+    
+    pools = create_stage_pools()
+    shared = {}
+    running = set()  # IDs of the tasks whose leases are renewed
+    running_lock = threading.Lock()
+    stop = threading.Event()
+    threading.Thread(target=renew_leases, args=(queue, worker, running, running_lock, stop),
+                     name="lease", daemon=True).start()
+    
+    done = 0
+    def untrack(task_id):
+        nonlocal done
+        with running_lock:
+            running.discard(task_id)
+            done += 1
+    
+    print(f"👷 Worker {worker} taking songs from {queue_path}")
+    try:
+        with ThreadPoolExecutor(max_workers=WORKER_TASKS, thread_name_prefix="task") as drivers:
+            try:
+                while True:
+                    with running_lock:
+                        busy = len(running)
+                    
+                    task = queue.claim(worker) if busy < WORKER_TASKS else None
+                    if task is not None:
+                        with running_lock:
+                            running.add(task["id"])
+                        drivers.submit(run_task, queue, worker, pools, shared, task, artifact_dir, untrack)
+                        continue
+                    if exit_when_idle and not busy and queue.idle():
+                        break
+                    time.sleep(work_queue.POLL_SECONDS)
+            except KeyboardInterrupt:
+                ffmpeg_jobs.cancel_all()
+                raise
+    finally:
+        stop.set()
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=ffmpeg_jobs.cancel_event.is_set())
+        shutil.rmtree(VIDEO_OUTPUT_DIR, ignore_errors=True)
+    
+    print(f"👷 Worker {worker} finished after {done} songs")
+
+def spawn_local_workers(count, queue_path, artifact_dir, codec):
+    """Start worker processes on this machine that exit once the queue is done.
+    
+    Returns:
+        list: The worker processes
+    """
+    args = [sys.executable, os.path.abspath(__file__), "--worker", "--exit-when-idle",
+            "--queue", queue_path, "--artifacts", artifact_dir, "--codec", codec]
+    return [subprocess.Popen(args) for _ in range(count)]
+
+def merge_compilation(queue, name, job, artifact_dir):
+    """Merge a compilation whose songs have all been handled by workers.
+    
+    Returns:
+        str: Path of the final video, or None if nothing could be compiled
+    """
+    clips = [os.path.join(artifact_dir, artifact) for artifact in queue.results(name) if artifact]
+    missing = [clip for clip in clips if not os.path.exists(clip)]
+    if missing:
+        # The songs would silently drop out of the compilation, so rather fail and let a re-run redo them
+        print(f"❌ [{name}] {len(missing)} finished clips are missing from {artifact_dir}: "
+              f"{', '.join(os.path.basename(clip) for clip in missing)}. Run the batch again to render them again.")
+        return None
+    if not clips:
+        print(f"❌ [{name}] No videos were successfully processed.")
+        return None
+    
+    title = compilation_title(job["user"], job["num_songs"], job["year"], job["month"], job.get("artist"))
+    try:
+        merge_videos(clips, job["output"], title)
+    except Exception as e:
+        print(f"❌ [{name}] Merge failed: {e}")
+        return None
+    return job["output"] if os.path.exists(job["output"]) else None
+
+def run_coordinator(jobs, queue_path, artifact_dir, local_workers=0, codec=SELECTED_CODEC):
+    """Build a batch of compilations with songs rendered by queue workers.
+    
+    The coordinator fetches the top lists, queues one task per song and
+    merges each compilation as soon as all of its songs are done. Workers
+    can run on any host that sees the queue and the artifact directory
+    (see run_worker()); local_workers of them are started here.
+    
+    Args:
+        jobs: Job dicts from load_jobs()
+        queue_path: Path of the queue database
+        artifact_dir: Shared artifact directory
+        local_workers: Number of worker processes to start on this machine
+        codec: Encoder setting handed to the local workers
+        
+    Returns:
+        list: (job, final video path or None) pairs in job order
+    """
+    queue = work_queue.WorkQueue(queue_path)
+    os.makedirs(artifact_dir, exist_ok=True)
+    outputs = {}
+    waiting = {}  # Compilation name -> job
+    for job in jobs:
+        name = os.path.abspath(job["output"])
+        try:
+            songs = get_top_songs(job["user"], job["year"], job["month"], job["num_songs"], job["artist"])
         except Exception as e:
-            print(f"❌ Error processing {artist} - {title}: {e}")
+            print(f"❌ [{name}] Could not get the top songs: {e}")
             continue
+        state = queue.add_compilation(
+            name, job, song_tasks(songs),
+            is_stale=lambda artifact: artifact is not None and not os.path.exists(os.path.join(artifact_dir, artifact)),
+            output_missing=lambda job: not os.path.exists(job["output"])
+        )
+        if state == "open":
+            waiting[name] = job
+        else:
+            print(f"♻️ [{name}] Already merged in {queue_path}")
+            outputs[name] = job["output"]
+    
+    workers = spawn_local_workers(local_workers, queue_path, artifact_dir, codec)
+    print(f"\n📋 Queued {len(waiting)} compilations in {queue_path}, {local_workers} local workers")
+    last_report = 0.0
+    try:
+        while waiting:
+            for name in queue.ready_compilations():
+                if name not in waiting or not queue.claim_merge(name):
+                    continue
+                outputs[name] = merge_compilation(queue, name, waiting.pop(name), artifact_dir)
+                queue.finish_compilation(name, "merged" if outputs[name] else "failed")
+            if not waiting:
+                break
+            
+            if workers and all(process.poll() is not None for process in workers) and not queue.idle():
+                print("❌ Every local worker exited with songs still queued, stopping.")
+                break
+            if time.monotonic() - last_report >= 30:
+                counts = queue.counts(list(waiting))
+                print(f"⏳ {len(waiting)} compilations waiting: " +
+                      ", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+                last_report = time.monotonic()
+            time.sleep(work_queue.POLL_SECONDS)
+    finally:
+        for process in workers:
+            try:
+                process.wait(timeout=work_queue.LEASE_SECONDS)
+            except (subprocess.TimeoutExpired, KeyboardInterrupt):
+                process.terminate()
+    
+    results = [(job, outputs.get(os.path.abspath(job["output"]))) for job in jobs]
+    print(f"\n📦 Queue batch finished: {sum(1 for _, output in results if output)}/{len(jobs)} compilations")
+    return results
+
+def clean_up(final_videos, runs=()):
+    """Remove the run's temporary files once its compilations exist.
+    
+    Args:
+        final_videos: Paths of the final videos (None for failed ones)
+        runs: Run IDs whose manifests are dropped along with the clips
+    """
+    # Clear the run's progress after successful completion
+    cache_clear("progress.json")
+    print("✅ Temporary progress cleaned up.")
+    
+     # Delete requirements.txt after successful completion
+    file_list = os.path.join(CACHE_DIR, "file_list.txt")
+    if os.path.exists(file_list):
+        os.remove(file_list)
+    
+    # Delete the video folder with all intermediate clips
+    if os.path.exists(VIDEO_OUTPUT_DIR) and os.path.isdir(VIDEO_OUTPUT_DIR):
+        print("🧹 Cleaning up temporary video files...")
+        # Make sure every final video exists before deleting source files
+        if all(video and os.path.exists(video) and os.path.getsize(video) > 0 for video in final_videos):
+            import shutil
+            try:
+                # Move final videos to the current directory if they're in the video folder
+                for final_video in final_videos:
+                    if os.path.dirname(os.path.abspath(final_video)) == os.path.abspath(VIDEO_OUTPUT_DIR):
+                        shutil.copy(final_video, os.path.basename(final_video))
+                        print(f"✅ Copied final video to current directory: {os.path.basename(final_video)}")
+                
+                # Delete the entire video folder
+                shutil.rmtree(VIDEO_OUTPUT_DIR)
+                for run in runs:
+                    cache_delete("run_manifest.json", run)
+                print("✅ Temporary video folder cleaned up. May have been moved to Recycle Bin/Trash.")
+            except Exception as e:
+                print(f"⚠️ Could not remove video folder: {e}. Manually it youxrself")
+        else:
+            print("⚠️ Final video not found or empty. Keeping temporary files for troubleshooting.")
+
+def parse_args(argv=None):
+    """Parse command-line arguments.
+    
+    Anything not given on the command line is asked for interactively.
+    
+    Args:
+        argv: Argument list, defaults to sys.argv
+        
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Create video compilations of your top songs from Last.fm.")
+    parser.add_argument("-u", "--user", help="Last.fm username, or several separated by commas to add up their plays")
+    parser.add_argument("-p", "--period", help="Month to compile as YYYY-MM, or a whole year as YYYY")
+    parser.add_argument("-a", "--artist", help="Only include songs by this artist")
+    parser.add_argument("-n", "--num-songs", type=int, help="Number of top songs to include (1-50)")
+    parser.add_argument("-c", "--codec", default=SELECTED_CODEC,
+                        help=f"Video encoder, or auto to benchmark the available ones (default: {SELECTED_CODEC})")
+    parser.add_argument("-o", "--output", help="Path of the final video")
+    parser.add_argument("--manual-urls", action=argparse.BooleanOptionalAction, default=None,
+                        help="Ask for a YouTube URL when a search finds nothing (default: ask whether to when run in a terminal)")
+    parser.add_argument("--review", action=argparse.BooleanOptionalAction, default=None,
+                        help="Offer to replace clips after the first merge (default: only when run in a terminal)")
+    parser.add_argument("--batch", metavar="JOB_FILE",
+                        help="Build every compilation listed in a JSON job file, without prompts")
+    parser.add_argument("--queue", metavar="QUEUE_DB",
+                        help="With --batch, render songs through worker processes sharing this queue database")
+    parser.add_argument("--worker", action="store_true",
+                        help="Run as a worker taking songs from the --queue database")
+    parser.add_argument("--artifacts", default=ARTIFACT_DIR,
+                        help=f"Shared directory workers publish clips to (default: {ARTIFACT_DIR})")
+    parser.add_argument("--local-workers", type=int, default=0,
+                        help="With --batch and --queue, number of worker processes to start on this machine")
+    parser.add_argument("--exit-when-idle", action="store_true",
+                        help="Stop the worker once the queue has no songs left")
+    parser.add_argument("--trace", metavar="TRACE_FILE",
+                        help="Record per-stage timings to a Chrome trace JSON file and print a metrics summary")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Run a compilation from the command line."""
+    args = parse_args(argv)
+    if args.trace:
+        tracing.enable()
+    try:
+        run_cli(args)
+    except LastfmAPIError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    finally:
+        print_download_savings()
+        if args.trace:
+            tracing.print_summary()
+            tracing.export_chrome_trace(args.trace)
+            print(f"📊 Trace saved to {args.trace} (open it in chrome://tracing or ui.perfetto.dev)")
+
+def run_cli(args):
+    """Run the compilation described by the command-line arguments.
+    
+    Args:
+        args: Parsed arguments from parse_args()
+    """
+    global SELECTED_CODEC, ALLOW_MANUAL_YOUTUBE
+    load_environment()
+    ensure_ffmpeg()
+    check_api_keys()
+    ffmpeg_jobs.configure(ENCODE_WORKERS, FFMPEG_THREADS)
+    
+    # Create necessary directories
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+    
+    SELECTED_CODEC = args.codec
+    resolve_encoder()
+    
+    if args.worker:
+        if not args.queue:
+            print("❌ --worker needs the --queue database to take songs from.")
+            sys.exit(1)
+        print(f"\n🎬 Using video codec: {SELECTED_CODEC}")
+        ALLOW_MANUAL_YOUTUBE = False
+        run_worker(args.queue, args.artifacts, args.exit_when_idle)
+        return
+    
+    if args.batch:
+        print(f"\n🎬 Using video codec: {SELECTED_CODEC}")
+        ALLOW_MANUAL_YOUTUBE = False
+        jobs = load_jobs(args.batch)
+        if args.queue:
+            results = run_coordinator(jobs, args.queue, args.artifacts, args.local_workers, args.codec)
+        else:
+            results = run_batch(jobs)
+        clean_up([output for _, output in results],
+                 [run_id(job["user"], job["year"], job["month"], job["num_songs"], job["output"], job["artist"])
+                  for job in jobs])
+        return
+    
+    # Get Last.fm username
+    user = args.user or input("Enter your Last.fm username: ").strip()
+    
+    # Get target year and month (no month compiles the whole year)
+    if args.period:
+        year_text, _, month_text = args.period.partition("-")
+    else:
+        year_text = input("Enter the target year (YYYY): ").strip()
+        month_text = input("Enter the target month (MM, or leave empty for the whole year): ").strip()
+    
+    # Get number of songs to include
+    num_songs = args.num_songs
+    if num_songs is not None and not 1 <= num_songs <= 50:
+        print("❌ Please enter a number between 1 and 50.")
+        sys.exit(1)
+    while num_songs is None:
+        num_songs_input = input("Enter the number of top songs to include (1-50): ").strip()
+        
+        if num_songs_input.isdigit():
+            if 1 <= int(num_songs_input) <= 50:
+                num_songs = int(num_songs_input)
+            else:
+                print("❌ Please enter a number between 1 and 50.")
+        else:
+            print("❌ Invalid input. Please enter a valid number.")
+    
+    # Display the selected codec to the user
+    print(f"\n🎬 Using video codec: {SELECTED_CODEC}")
+    
+    # Ask if user wants to manually input YouTube URLs for missing videos - unattended runs can't answer
+    if args.manual_urls is None and sys.stdin.isatty():
+        manual_youtube_input = input(
+            "❓ Do you want to manually input YouTube URLs if a search fails? (yes/no): "
+        ).strip().lower()
+        ALLOW_MANUAL_YOUTUBE = manual_youtube_input == "yes"
+    else:
+        ALLOW_MANUAL_YOUTUBE = bool(args.manual_urls)
+    
+    # Validate inputs
+    if not year_text.isdigit() or len(year_text) != 4:
+        print("❌ Invalid year format. Please enter a valid year (YYYY).")
+        sys.exit(1)
+    
+    if month_text and (not month_text.isdigit() or not (1 <= int(month_text) <= 12)):
+        print("❌ Invalid month format. Please enter a number between 1 and 12.")
+        sys.exit(1)
+    
+    year, month = int(year_text), int(month_text) if month_text else None
+    artist = args.artist.strip() if args.artist else None
+    
+    # Set up final video filename
+    final_video = args.output or default_output(user, num_songs, year, month, artist)
+    title = compilation_title(user, num_songs, year, month, artist)
+    run = run_id(user, year, month, num_songs, final_video, artist)
+    
+    songs = get_top_songs(user, year, month, num_songs, artist)  # Fetches from cache OR API
+
+    print(f"\n🎵 Processing your top {num_songs} songs for {period_name(year, month)}...")
+    
+    video_clips = process_songs(songs, run=run)
 
     # Merge the initial version of the final video
     if video_clips:
-        merge_videos(video_clips, FINAL_VIDEO)
+        merge_videos(video_clips, final_video, title)
 
         print("\n🎬 Initial Video Created Successfully!")
-        print("📌 Please review the final video and confirm if any clips need replacement.")
+        # Only offer the review when someone is there to answer
+        review = args.review if args.review is not None else sys.stdin.isatty()
+        if review:
+            print("📌 Please review the final video and confirm if any clips need replacement.")
         
         # Track if replacements happen
         need_replacement = False
 
         # Allow user to manually replace videos after watching
-        while True:
+        while review:
             choice = input("❓ Do you need to replace any videos? (yes/no): ").strip().lower()
             if choice == "yes":
                 need_replacement = True  # Mark that replacements happened
-                update_video()
+                update_video(songs, video_clips, run)
             elif choice == "no":
                 break
             else:
@@ -1006,41 +3436,19 @@ if __name__ == "__main__":
         # Merge Final Video Again only if replacements were made
         if need_replacement:
             print("🔄 Merging the final version after replacements...")
-            merge_videos(video_clips, FINAL_VIDEO)
-            print(f"✨ Final video saved as: {FINAL_VIDEO}")
+            merge_videos(video_clips, final_video, title)
+            print(f"✨ Final video saved as: {final_video}")
         else:
-            print(f"✨ Video compilation complete! Saved as: {FINAL_VIDEO}")
+            print(f"✨ Video compilation complete! Saved as: {final_video}")
     else:
         print("❌ No videos were successfully processed. Cannot create compilation.")
 
-    # Delete progress.json after successful completion
-    progress_path = os.path.join(CACHE_DIR, "progress.json")
-    if os.path.exists(progress_path):
-        os.remove(progress_path)
-        print("✅ Temporary progress file cleaned up.")
-    
-     # Delete requirements.txt after successful completion
-    file_list = os.path.join(CACHE_DIR, "file_list.txt")
-    if os.path.exists(file_list):
-        os.remove(file_list)
-    
-    # Delete the video folder with all intermediate clips
-    if os.path.exists(VIDEO_OUTPUT_DIR) and os.path.isdir(VIDEO_OUTPUT_DIR):
-        print("🧹 Cleaning up temporary video files...")
-        # Make sure final video exists before deleting source files
-        if os.path.exists(FINAL_VIDEO) and os.path.getsize(FINAL_VIDEO) > 0:
-            import shutil
-            try:
-                # Move the final video to the current directory if it's in the video folder
-                if os.path.dirname(os.path.abspath(FINAL_VIDEO)) == os.path.abspath(VIDEO_OUTPUT_DIR):
-                    import shutil
-                    shutil.copy(FINAL_VIDEO, os.path.basename(FINAL_VIDEO))
-                    print(f"✅ Copied final video to current directory: {os.path.basename(FINAL_VIDEO)}")
-                
-                # Delete the entire video folder
-                shutil.rmtree(VIDEO_OUTPUT_DIR)
-                print("✅ Temporary video folder cleaned up. May have been moved to Recycle Bin/Trash.")
-            except Exception as e:
-                print(f"⚠️ Could not remove video folder: {e}. Manually it youxrself")
-        else:
-            print("⚠️ Final video not found or empty. Keeping temporary files for troubleshooting.")
\ No newline at end of file
+    clean_up([final_video], [run])
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        ffmpeg_jobs.cancel_all()
+        print("\n🛑 Cancelled.")
+        sys.exit(130)
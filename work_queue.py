@@ -0,0 +1,261 @@
+'''
+VFM - VideoFM
+Durable SQLite work queue with leases, shared by a coordinator and any number of workers.
+'''
+
+import json
+import time
+import sqlite3
+import threading
+import contextlib
+
+LEASE_SECONDS = 120  # A claimed task goes back on the queue if its lease isn't renewed in time
+MAX_ATTEMPTS = 3     # Claims per task before it is given up on
+POLL_SECONDS = 2     # How often idle workers and the coordinator look at the queue
+
+class WorkQueue:
+    """Task queue for building compilations on several processes or hosts.
+
+    A compilation is a list of tasks (one per song). Tasks are keyed, so a
+    song that appears in several compilations is only worked on once.
+    Workers claim tasks with a lease they keep renewing while they work; a
+    task whose lease runs out (the worker crashed or lost the queue) is
+    claimed again by the next worker, up to MAX_ATTEMPTS times.
+
+    The database uses SQLite's rollback journal instead of WAL, because WAL
+    needs shared memory and so only works when every process is on one
+    host. For workers on several hosts, put it on storage with working file
+    locks.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS task_state ON tasks (state, lease_until);
+        CREATE TABLE IF NOT EXISTS compilations (
+            name TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'open',
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            compilation TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            PRIMARY KEY (compilation, position)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Autocommit, so every statement outside transaction() is atomic on its own
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run statements under the database write lock."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def add_compilation(self, name, payload, tasks, is_stale=None, output_missing=None):
+        """Queue a compilation and its tasks, unless it is already merged.
+
+        Tasks that earlier compilations already queued are shared. Tasks that
+        failed before, and finished tasks whose result is_stale() rejects (for
+        example because their artifact was deleted), get a fresh set of
+        attempts. A compilation that failed, whose merge was interrupted, or
+        whose merged output output_missing() reports as gone is opened again
+        with the given tasks, so a changed song list replaces the old one.
+
+        Args:
+            name: Unique compilation name, e.g. its output path
+            payload: JSON-serializable compilation details
+            tasks: (key, payload) pairs in compilation order
+            is_stale: Called with the result of each finished task, True if it has to be redone
+            output_missing: Called with the payload of a merged compilation, True if it has to be built again
+
+        Returns:
+            str: State of the compilation ("open" or "merged")
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT state FROM compilations WHERE name = ?", (name,)).fetchone()
+            if row and row[0] == "merged" and not (output_missing and output_missing(payload)):
+                return "merged"
+
+            conn.execute(
+                "INSERT INTO compilations (name, payload, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET payload = excluded.payload, state = 'open', "
+                "updated_at = excluded.updated_at", (name, json.dumps(payload), now)
+            )
+            conn.execute("DELETE FROM members WHERE compilation = ?", (name,))
+            for position, (key, task_payload) in enumerate(tasks):
+                conn.execute("INSERT OR IGNORE INTO tasks (key, payload, updated_at) VALUES (?, ?, ?)",
+                             (key, json.dumps(task_payload), now))
+                task_id = conn.execute("SELECT id FROM tasks WHERE key = ?", (key,)).fetchone()[0]
+                conn.execute("INSERT INTO members (compilation, position, task_id) VALUES (?, ?, ?)",
+                             (name, position, task_id))
+            # Songs that dropped out of every list aren't worth rendering anymore
+            conn.execute("DELETE FROM tasks WHERE state = 'pending' AND id NOT IN (SELECT task_id FROM members)")
+
+            rows = conn.execute(
+                "SELECT t.id, t.state, t.result FROM members m JOIN tasks t ON t.id = m.task_id "
+                "WHERE m.compilation = ?", (name,)
+            ).fetchall()
+            for task_id, state, result in rows:
+                if state == "failed" or (state == "done" and is_stale and is_stale(json.loads(result or "null"))):
+                    conn.execute(
+                        "UPDATE tasks SET state = 'pending', attempts = 0, result = NULL, error = NULL, "
+                        "updated_at = ? WHERE id = ?", (now, task_id)
+                    )
+        return "open"
+
+    def claim(self, worker, lease_seconds=None):
+        """Lease the oldest task that is waiting or whose lease ran out.
+
+        Args:
+            worker: Name of the claiming worker
+            lease_seconds: How long the lease lasts without renew(), defaults to LEASE_SECONDS
+
+        Returns:
+            dict: Task with id, payload and attempts (including this one), or None
+        """
+        lease_seconds = lease_seconds or LEASE_SECONDS
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET state = 'failed', error = 'lease expired on every attempt', updated_at = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, MAX_ATTEMPTS)
+            )
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM tasks "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?", (worker, now + lease_seconds, now, row[0])
+            )
+        return {"id": row[0], "payload": json.loads(row[1]), "attempts": row[2] + 1}
+
+    def update_leased(self, task_id, worker, assignments, *values):
+        """Update a task only while the worker still holds its lease.
+
+        Returns:
+            bool: False if the lease was lost (it expired and someone else claimed the task)
+        """
+        cursor = self.connection().execute(
+            f"UPDATE tasks SET {assignments}, updated_at = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (*values, time.time(), task_id, worker)
+        )
+        return cursor.rowcount == 1
+
+    def renew(self, task_id, worker, lease_seconds=None):
+        """Extend a task's lease, see update_leased()."""
+        return self.update_leased(task_id, worker, "lease_until = ?", time.time() + (lease_seconds or LEASE_SECONDS))
+
+    def complete(self, task_id, worker, result):
+        """Mark a task as done with a JSON-serializable result, see update_leased()."""
+        return self.update_leased(task_id, worker, "state = 'done', lease_until = NULL, result = ?",
+                                  json.dumps(result))
+
+    def fail(self, task_id, worker, error):
+        """Put a failed task back on the queue, or give up on it after MAX_ATTEMPTS."""
+        return self.update_leased(
+            task_id, worker,
+            "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, "
+            "lease_until = NULL, error = ?", MAX_ATTEMPTS, str(error)
+        )
+
+    def release(self, task_id, worker):
+        """Hand an unfinished task back without using up an attempt."""
+        return self.update_leased(task_id, worker,
+                                  "state = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1")
+
+    def idle(self):
+        """Check whether no task is waiting or being worked on."""
+        row = self.connection().execute(
+            "SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'leased')"
+        ).fetchone()
+        return row[0] == 0
+
+    def counts(self, names=None):
+        """Count tasks per state.
+
+        Args:
+            names: Only count the tasks of these compilations
+
+        Returns:
+            dict: State -> number of tasks
+        """
+        if names is None:
+            rows = self.connection().execute("SELECT state, COUNT(*) FROM tasks GROUP BY state")
+        else:
+            placeholders = ",".join("?" * len(names))
+            rows = self.connection().execute(
+                f"SELECT state, COUNT(*) FROM tasks WHERE id IN "
+                f"(SELECT task_id FROM members WHERE compilation IN ({placeholders})) GROUP BY state", list(names)
+            )
+        return dict(rows.fetchall())
+
+    def ready_compilations(self):
+        """Get the open compilations whose tasks have all finished."""
+        rows = self.connection().execute(
+            """SELECT name FROM compilations c WHERE state = 'open' AND NOT EXISTS (
+                SELECT 1 FROM members m JOIN tasks t ON t.id = m.task_id
+                WHERE m.compilation = c.name AND t.state IN ('pending', 'leased')
+            )"""
+        )
+        return [name for name, in rows]
+
+    def claim_merge(self, name):
+        """Take a ready compilation for merging.
+
+        Returns:
+            bool: False if another coordinator already took it
+        """
+        cursor = self.connection().execute(
+            "UPDATE compilations SET state = 'merging', updated_at = ? WHERE name = ? AND state = 'open'",
+            (time.time(), name)
+        )
+        return cursor.rowcount == 1
+
+    def results(self, name):
+        """Get the task results of a compilation in order (None for failed tasks)."""
+        rows = self.connection().execute(
+            "SELECT t.state, t.result FROM members m JOIN tasks t ON t.id = m.task_id "
+            "WHERE m.compilation = ? ORDER BY m.position", (name,)
+        )
+        return [json.loads(result) if state == "done" and result else None for state, result in rows]
+
+    def finish_compilation(self, name, state):
+        """Record that a compilation was merged ("merged") or could not be ("failed")."""
+        self.connection().execute(
+            "UPDATE compilations SET state = ?, updated_at = ? WHERE name = ?", (state, time.time(), name)
+        )